@@ -1,27 +1,280 @@
+import argparse
+import errno
+import glob
+import hashlib
+import json
 import os.path
 import re
 import subprocess
+import sys
+import time
 
+# Status lines are appended to STATUS_FILE, which the dispatcher follows over
+# SSH so it knows as soon as we finish. The dispatcher starts us with nohup
+# and follows the file on a channel of its own, so the install carries on if
+# the dispatcher goes away or its connection drops.
+STATUS_PREFIX = "AWS_RUNNER_STATUS"
+STATUS_FILE = "install_status.txt"
 
-def main():
+# INSTALL.sh can be split into named steps with lines like
+#   ### STEP julia_packages timeout=600
+# Each step is run (and retried) on its own, and steps that have already
+# finished are skipped when INSTALL.py is run again. A step with a cache
+# option, like
+#   ### STEP julia_packages timeout=900 cache=~/.julia,~/R
+# has the folders it lists shared between instances (see depot_cache.py).
+STEP_MARKER = re.compile(r"^### STEP\s+([A-Za-z0-9_.-]+)((?:\s+\S+)*)\s*$")
+STEP_TIMEOUT = 360  # Default seconds each attempt at a step may take
+STEP_RETRY_START = 5  # Seconds to wait before retrying a step, doubling
+STEP_RETRY_MAX = 120
+STEP_MAX_ATTEMPTS = 10
+STEPS_FILE = "INSTALL_STEPS.json"  # The steps that have finished
+STEPS_FOLDER = "install_steps"  # The script and log of each step
+
+
+def report(state, detail=""):
+    line = "%s %s %s\n" % (STATUS_PREFIX, state, detail)
+    with open(STATUS_FILE, "a") as f:
+        f.write(line)
+    # Also to stdout when run by hand, which may have gone away
+    try:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+
+
+def fail(message):
+    with open("failure.txt", "w") as f:
+        f.write(message + "\n")
+    report("failed", message)
+    exit(1)
+
+
+def latest_progress_step(iteration):
+    """
+    The most recent step INSTALL.sh has started on this iteration, going by
+    the progress_<step>_<iteration>.txt files it writes.
+    """
+    files = glob.glob("progress_*_%d.txt" % iteration)
+    if not files:
+        return None
+    latest = max(files, key=os.path.getmtime)
+    match = re.match(r"progress_(.*)_%d\.txt$" % iteration, latest)
+    return match.group(1) if match else None
+
+
+def parse_steps(script):
+    """
+    Split INSTALL.sh into the lines before the first step (the shebang,
+    set -e, exports...), which are run at the start of every step, and the
+    steps. Each step is (name, timeout, cache, body), where cache is the list
+    of folders to share for the step.
+    Returns (prelude, steps), with no steps if there are no step markers.
+    """
+    prelude = []
+    steps = []
+    for line in script.splitlines(True):
+        match = STEP_MARKER.match(line)
+        if match:
+            name = match.group(1)
+            if name in [step[0] for step in steps]:
+                fail("INSTALL.sh has more than one step called %s" % name)
+            timeout = STEP_TIMEOUT
+            cache = []
+            for option in match.group(2).split():
+                if option.startswith("timeout="):
+                    timeout = int(option[len("timeout="):])
+                elif option.startswith("cache="):
+                    cache = option[len("cache="):].split(",")
+            steps.append((name, timeout, cache, []))
+        elif steps:
+            steps[-1][3].append(line)
+        else:
+            prelude.append(line)
+    return "".join(prelude), [(name, timeout, cache, "".join(body))
+                              for name, timeout, cache, body in steps]
+
+
+def load_completed():
+    try:
+        with open(STEPS_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_completed(completed):
+    with open(STEPS_FILE + ".tmp", "w") as f:
+        json.dump(completed, f, indent=2, sort_keys=True)
+    os.rename(STEPS_FILE + ".tmp", STEPS_FILE)
+
+
+def run_step(name, timeout, script_path, attempt):
+    """
+    Run one attempt at a step, appending its output to the step's log.
+    Returns whether it succeeded.
+    """
+    log_path = os.path.join(STEPS_FOLDER, "%s.log" % name)
+    with open(log_path, "a") as log:
+        log.write("### Attempt %d, %s\n" % (attempt, time.ctime()))
+        log.flush()
+        p = subprocess.Popen(
+            ["timeout", str(timeout), "bash", script_path, str(attempt)],
+            stdout=log, stderr=subprocess.STDOUT
+        )
+        return p.wait() == 0
+
+
+class Depot(object):
+    """
+    The depot_cache backend for steps with a cache option, if the dispatcher
+    gave us somewhere to keep them. It is only set up when the first such
+    step is reached, as it needs boto, which INSTALL.sh may install itself.
+    If it can't be set up the steps just run as normal.
+    """
+
+    def __init__(self, bucket_name=None, local_path=None):
+        self.bucket_name = bucket_name
+        self.local_path = local_path
+        self.backend = None
+        self.broken = not (bucket_name or local_path)
+
+    def _call(self, function, *args):
+        """
+        Call a depot_cache function with the backend, setting it up first.
+        Returns False if the depot can't be used.
+        """
+        try:
+            if self.backend is None and not self.broken:
+                import depot_cache
+                self.depot_cache = depot_cache
+                self.backend = depot_cache.get_backend(self.bucket_name,
+                                                       self.local_path)
+            if self.backend is None:
+                return False
+            return getattr(self.depot_cache, function)(self.backend, *args)
+        except Exception as e:
+            # Carry on without it, another instance can still store the step
+            report("depot_unavailable", str(e).replace("\n", " "))
+            self.broken = self.backend is None
+            return False
+
+    def restore(self, name, step_hash):
+        return self._call("restore", name, step_hash)
+
+    def save(self, name, step_hash, paths):
+        return self._call("save", name, step_hash, paths)
+
+
+def run_steps(prelude, steps, depot=None):
+    """
+    Run each step in turn, retrying a step that fails (after a growing
+    delay) without running the steps before it again. A step is skipped if
+    it finished on an earlier run of INSTALL.py and neither it, the prelude
+    nor any step before it has changed since. A step with a cache option is
+    restored from the depot instead of being run if another instance has
+    stored what it made, and stored in the depot once it has run otherwise.
+    """
+    if not os.path.isdir(STEPS_FOLDER):
+        os.mkdir(STEPS_FOLDER)
+    completed = load_completed()
+    depot = depot or Depot()
+    chain = ""
+    for name, timeout, cache, body in steps:
+        # Each step's hash covers everything that runs before it too
+        chain = hashlib.sha1(chain + prelude + name + body).hexdigest()
+        if completed.get(name, {}).get("hash") == chain:
+            report("step_skipped", name)
+            continue
+
+        start = time.time()
+        if cache and depot.restore(name, chain):
+            seconds = time.time() - start
+            completed[name] = {"hash": chain, "seconds": round(seconds, 1),
+                               "attempts": 0}
+            save_completed(completed)
+            report("step_restored", "%s %.1f" % (name, seconds))
+            continue
+
+        script_path = os.path.join(STEPS_FOLDER, "%s.sh" % name)
+        with open(script_path, "w") as f:
+            f.write(prelude)
+            f.write(body)
+        delay = STEP_RETRY_START
+        attempt = 1
+        while True:
+            report("step", "%s %d" % (name, attempt))
+            if run_step(name, timeout, script_path, attempt):
+                break
+            if attempt == STEP_MAX_ATTEMPTS:
+                fail("step %s failed %d times, see %s" % (
+                    name, attempt, os.path.join(STEPS_FOLDER,
+                                                "%s.log" % name)))
+            time.sleep(delay)
+            delay = min(2 * delay, STEP_RETRY_MAX)
+            attempt += 1
+
+        seconds = time.time() - start
+        completed[name] = {"hash": chain, "seconds": round(seconds, 1),
+                           "attempts": attempt}
+        save_completed(completed)
+        report("step_done", "%s %.1f %d" % (name, seconds, attempt))
+        if cache and depot.save(name, chain, cache):
+            report("step_stored", name)
+
+    # Nothing else needs to be done by INSTALL.sh to count as ready
+    open("READY", "a").close()
+    report("ready")
+
+
+def run_whole_script():
     # Run installation script until it works (sometimes it takes more than once
     # due to apt-get servers not working, etc.)
     iteration = 0
     while True:
         iteration += 1
-        try:
-            p = subprocess.Popen(
-                ["timeout", "360", "./INSTALL.sh", str(iteration)],
-                stdout=None, stderr=None
-            )
-            p.wait()
-        except:
-            with open("failure.txt", "w") as f:
-                f.write("INSTALL.py exited in failure\n")
-            exit(1)
+        report("attempt", iteration)
+        p = subprocess.Popen(
+            ["timeout", "360", "./INSTALL.sh", str(iteration)],
+            stdout=None, stderr=None
+        )
+        step = None
+        while p.poll() is None:
+            time.sleep(2)
+            latest = latest_progress_step(iteration)
+            if latest != step:
+                step = latest
+                report("progress", step)
 
         if os.path.isfile("READY"):
+            report("ready", iteration)
             break
 
+
+def main():
+    parser = argparse.ArgumentParser(description="Run INSTALL.sh")
+    parser.add_argument("--depot_bucket", type=str, default=None,
+                        help="S3 bucket to share the folders of steps with "
+                             "a cache option through.")
+    parser.add_argument("--depot_folder", type=str, default=None,
+                        help="Local folder to share them through instead, "
+                             "for trying it out.")
+    args = parser.parse_args()
+
+    try:
+        with open("INSTALL.sh") as f:
+            prelude, steps = parse_steps(f.read())
+        if steps:
+            run_steps(prelude, steps, Depot(args.depot_bucket,
+                                            args.depot_folder))
+        else:
+            run_whole_script()
+    except SystemExit:
+        raise
+    except:
+        fail("INSTALL.py exited in failure")
+
 if __name__ == '__main__':
     main()
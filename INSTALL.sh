@@ -2,8 +2,18 @@
 # INSTALL.sh
 # Install the dependencies required to run on a Gurobi-Ubuntu EC2 instance
 
+# INSTALL.py runs each "### STEP" below on its own, retrying a step that
+# fails without rerunning the ones before it. Everything above the first
+# step is run at the start of every step. The output of each step is in
+# ~/install_steps/<step>.log, and INSTALL.py creates READY once every step
+# has finished.
+# Steps with a cache option have the folders they list shared between the
+# instances when the dispatcher is run with --depot_cache: the first
+# instance to finish the step uploads them, and the rest download them
+# instead of running the step.
+
 # Args:
-# $1: iteration number
+# $1: attempt number of the step being run
 
 # Exit on any error, INSTALL.py will retry again later
 set -e
@@ -12,35 +22,44 @@ set -e
 export GUROBI_HOME="/opt/gurobi651/linux64"
 
 ###############################################################################
-### APT--GET-CONFIG
+### STEP apt_config
 
 # Julia apt-get config
-sudo add-apt-repository ppa:staticfloat/juliareleases --yes > progress_A_3_$1.txt 2>&1
-sudo add-apt-repository ppa:staticfloat/julia-deps --yes > progress_A_4_$1.txt 2>&1
+sudo add-apt-repository ppa:staticfloat/juliareleases --yes
+sudo add-apt-repository ppa:staticfloat/julia-deps --yes
 
 # R apt-get config
-sudo su -c "echo 'deb http://cran.case.edu/bin/linux/ubuntu trusty/' >> /etc/apt/sources.list" > progress_A_1_$1.txt 2>&1
-sudo apt-key adv --keyserver keyserver.ubuntu.com --recv-keys E084DAB9 > progress_A_2_$1.txt 2>&1
+grep -q "cran.case.edu" /etc/apt/sources.list || \
+    sudo su -c "echo 'deb http://cran.case.edu/bin/linux/ubuntu trusty/' >> /etc/apt/sources.list"
+sudo apt-key adv --keyserver keyserver.ubuntu.com --recv-keys E084DAB9
 
 ###############################################################################
-### APT-GET-EVERYTHING
+### STEP apt_update
+
+sudo apt-get update --yes
 
-sudo apt-get update --yes > progress_B_1_$1.txt 2>&1
+### STEP apt_base
 
 # Base things
-sudo apt-get -y --force-yes install git python-pip python-paramiko > progress_B_2_$1.txt 2>&1
+sudo apt-get -y --force-yes install git python-pip python-paramiko
+
+### STEP apt_julia
 
 # Julia
-sudo apt-get -y --force-yes install julia > progress_B_3_$1.txt 2>&1
+sudo apt-get -y --force-yes install julia
+
+### STEP apt_r timeout=900
 
 # R
-sudo apt-get -y --force-yes install r-base r-recommended r-base-dev r-base-core r-cran-randomforest > progress_B_4_$1.txt 2>&1
+sudo apt-get -y --force-yes install r-base r-recommended r-base-dev r-base-core r-cran-randomforest
 
 ###############################################################################
-### LANGUAGE PACKAGE CONFIG
+### STEP pip_packages
 
 # Add base packages
-sudo pip install boto > progress_C_1_$1.txt 2>&1
+sudo pip install boto
+
+### STEP packages timeout=1200 cache=~/.julia,~/R
 
 # Add Julia packages
 julia -e 'Pkg.update(); \
@@ -49,16 +68,15 @@ julia -e 'Pkg.update(); \
     Pkg.add("MLBase"); \
     Pkg.add("JuMP"); \
     Pkg.add("Gurobi"); \
-println("Done")' > progress_C_2_$1.txt 2>&1
+println("Done")'
+julia -e 'Pkg.build("Gurobi")'
 
 # Add R packages
-#   already installed with apt-get
+#   already installed with apt-get, any added with install.packages() go in
+#   ~/R and are cached along with the Julia packages
 
 ###############################################################################
-### CHECK EVERYTHING IS WORKING
-julia -e 'Pkg.build("Gurobi")' > progress_D_1_$1.txt 2>&1
-julia -e 'using Gurobi; println(Gurobi.version)' > GUROBI_VERSION
+### STEP check_gurobi
 
-###############################################################################
-### READY FOR JOB
-touch READY
+# Check everything is working
+julia -e 'using Gurobi; println(Gurobi.version)' > GUROBI_VERSION
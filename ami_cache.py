@@ -0,0 +1,76 @@
+# Caches fully installed instances as private AMIs, keyed by a hash of the
+# install script and the base Gurobi AMI, so later runs with the same setup
+# can launch straight from the cached AMI and skip INSTALL entirely.
+import hashlib
+import time
+
+import boto.ec2
+import boto.exception
+
+import cloud_setup
+
+HASH_TAG = "aws-runner-install-hash"
+
+
+def install_hash(install_file, base_ami):
+    """
+    Hash of everything that determines what an installed instance looks like.
+    """
+    sha = hashlib.sha1()
+    for filename in [install_file, "INSTALL.py"]:
+        with open(filename, "rb") as f:
+            sha.update(f.read())
+        sha.update("\0")
+    sha.update(base_ami)
+    return sha.hexdigest()
+
+
+class EC2AMIBackend(object):
+    """
+    Stores cached AMIs as private images in the account, tagged with the
+    install hash.
+    """
+
+    def __init__(self):
+        self.ec2 = boto.ec2.connect_to_region(cloud_setup.AWS_REGION)
+
+    def find_image(self, hash_value):
+        """
+        Returns (image_id, state) of the cached image for the hash, or
+        (None, None) if there isn't one. Prefers available images to ones
+        that are still being created.
+        """
+        images = self.ec2.get_all_images(
+            owners=["self"], filters={"tag:" + HASH_TAG: hash_value})
+        images = [image for image in images
+                  if image.state in ["available", "pending"]]
+        if not images:
+            return None, None
+        images.sort(key=lambda image: image.state != "available")
+        return images[0].id, images[0].state
+
+    def create_image(self, instance_id, hash_value):
+        """
+        Snapshot a running instance into a new image. The instance isn't
+        rebooted so it can carry on and run its job.
+        """
+        name = "aws-runner-%s-%d" % (hash_value[:12], int(time.time()))
+        image_id = self.ec2.create_image(
+            instance_id, name,
+            description="aws-runner install cache %s" % hash_value,
+            no_reboot=True)
+        # The image may not be visible to tag straight away
+        for attempt in range(10):
+            try:
+                self.ec2.create_tags([image_id], {HASH_TAG: hash_value})
+                break
+            except boto.exception.EC2ResponseError:
+                time.sleep(5)
+        return image_id
+
+    def delete_image(self, image_id):
+        self.ec2.deregister_image(image_id, delete_snapshot=True)
+
+
+def get_backend():
+    return EC2AMIBackend()
@@ -0,0 +1,723 @@
+# Offline benchmark of the dispatcher. EC2, S3 and the SSH/SFTP connections
+# to instances are replaced by in-process fakes with configurable latency and
+# failure rates, and the launch, connect, setup and dispatch phases are timed
+# for several numbers of tags (or with --pipeline, the time until the first
+# and last tags are dispatched when pipelining). Nothing is launched and nothing is spent, so
+# this can be run before and after a change to the dispatcher to see how it
+# affects each phase.
+#
+#   python benchmark.py --sizes 10,100,1000
+import argparse
+import contextlib
+import csv
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import boto.ec2
+import boto.exception
+import boto.manage.cmdshell
+import boto.s3
+import boto.s3.key
+
+import cloud_setup
+import dispatcher
+import ledger
+import spot
+import ssh_pool
+
+PHASES = ["launch", "connect", "setup", "dispatch"]
+
+
+class FakeConfig(object):
+    """
+    How the fake cloud behaves. Latencies are in seconds, failure rates are
+    the probability that each call fails.
+    """
+
+    def __init__(self, api_latency=0.05, boot_time=1.0, ssh_ready_delay=0.0,
+                 ssh_latency=0.1, command_latency=0.02, sftp_latency=0.01,
+                 bandwidth=50e6, install_time=1.0, api_failure_rate=0.0,
+                 ssh_failure_rate=0.0, sftp_failure_rate=0.0,
+                 install_failure_rate=0.0, ssh_drop_rate=0.0,
+                 spot_fraction=None, seed=0):
+        self.api_latency = api_latency
+        self.boot_time = boot_time
+        self.ssh_ready_delay = ssh_ready_delay
+        self.ssh_latency = ssh_latency
+        self.command_latency = command_latency
+        self.sftp_latency = sftp_latency
+        self.bandwidth = bandwidth  # Bytes per second for uploads
+        self.install_time = install_time
+        self.api_failure_rate = api_failure_rate
+        self.ssh_failure_rate = ssh_failure_rate
+        self.sftp_failure_rate = sftp_failure_rate
+        self.install_failure_rate = install_failure_rate
+        self.ssh_drop_rate = ssh_drop_rate
+        # Fraction of spot requests that are fulfilled, or None to launch
+        # everything on-demand
+        self.spot_fraction = spot_fraction
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+    def fails(self, rate):
+        with self.random_lock:
+            return self.random.random() < rate
+
+
+class FakeInstance(object):
+    def __init__(self, cloud, instance_id):
+        self.cloud = cloud
+        self.id = instance_id
+        self.launched = time.time()
+        self.terminated = False
+        self.tags = {}
+        self.files = {}  # Remote path -> contents (or size for uploads)
+        self.installed = False
+        self.install_output = ""  # What INSTALL.py writes to its status file
+        self.install_done_at = None  # When INSTALL.py exits
+
+    @property
+    def state(self):
+        if self.terminated:
+            return "terminated"
+        if time.time() - self.launched < self.cloud.config.boot_time:
+            return "pending"
+        return "running"
+
+    def add_tag(self, key, value):
+        self.tags[key] = value
+
+    def terminate(self):
+        self.terminated = True
+
+
+class FakeReservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class FakeEC2Connection(object):
+    """
+    Just the EC2 calls cloud_setup makes while launching and looking up
+    instances.
+    """
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def run_instances(self, ami_name, min_count=1, max_count=1, **kwargs):
+        time.sleep(self.cloud.config.api_latency)
+        return FakeReservation([self.cloud.new_instance()
+                                for i in range(max_count)])
+
+    def create_tags(self, instance_ids, tags):
+        time.sleep(self.cloud.config.api_latency)
+        if self.cloud.config.fails(self.cloud.config.api_failure_rate):
+            raise boto.exception.EC2ResponseError(400, "InvalidID")
+        for instance_id in instance_ids:
+            self.cloud.instances[instance_id].tags.update(tags)
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        time.sleep(self.cloud.config.api_latency)
+        instances = self.cloud.instances.values()
+        if instance_ids is not None:
+            instances = [inst for inst in instances if inst.id in instance_ids]
+        for name, values in (filters or {}).items():
+            if not isinstance(values, list):
+                values = [values]
+            if name == "tag:tag":
+                # Only lookups by tag fail, the callers of the other
+                # lookups don't expect to have to retry
+                if self.cloud.config.fails(self.cloud.config.api_failure_rate):
+                    raise boto.exception.EC2ResponseError(503, "Unavailable")
+                instances = [inst for inst in instances
+                             if inst.tags.get("tag") in values]
+            elif name == "instance-state-name":
+                instances = [inst for inst in instances
+                             if inst.state in values]
+            elif name == "instance-id":
+                instances = [inst for inst in instances if inst.id in values]
+        return [FakeReservation([inst]) for inst in instances]
+
+
+class FakeChannel(object):
+    """
+    A channel following INSTALL.py's status file: silent until the install
+    finishes, then its status lines for a single step. The connection may
+    drop while it is open, which closes the channel, as it does in paramiko.
+    """
+
+    def __init__(self, output, ready_at, ssh_client):
+        self.output = output
+        self.ready_at = ready_at
+        self.ssh_client = ssh_client
+
+    def get_transport(self):
+        return self.ssh_client.transport
+
+    def recv_ready(self):
+        self.ssh_client.may_drop()
+        return (self.ssh_client.transport.active and bool(self.output) and
+                time.time() >= self.ready_at)
+
+    def recv(self, size):
+        data, self.output = self.output[:size], self.output[size:]
+        return data
+
+    def exit_status_ready(self):
+        if not self.ssh_client.transport.active:
+            return True
+        return not self.output and time.time() >= self.ready_at
+
+
+class FakeStdout(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        pass
+
+
+class FakeSSHClient(object):
+    """
+    Stand-in for the paramiko client inside a cmdshell, for exec_command.
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.transport = FakeTransport()
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.transport.active = False
+
+    def use(self):
+        """
+        Called before each command or SFTP operation, and may drop the
+        connection instead.
+        """
+        if not self.transport.active:
+            raise EOFError("Connection closed")
+        if self.may_drop():
+            raise EOFError("Connection dropped")
+
+    def may_drop(self):
+        """
+        Drop the connection with probability ssh_drop_rate. Returns whether
+        it did.
+        """
+        config = self.instance.cloud.config
+        if self.transport.active and config.fails(config.ssh_drop_rate):
+            self.transport.active = False
+            return True
+        return False
+
+    def exec_command(self, command):
+        config = self.instance.cloud.config
+        self.use()
+        time.sleep(config.command_latency)
+        if command.startswith("tail") and self.instance.install_done_at:
+            # Following INSTALL.py's status file from the given line
+            first_line = int(re.search(r"-n \+(\d+)", command).group(1))
+            output = "".join(self.instance.install_output.splitlines(True)
+                             [first_line - 1:])
+            channel = FakeChannel(output, self.instance.install_done_at,
+                                  self)
+        else:
+            channel = FakeChannel("", time.time(), self)
+        return None, FakeStdout(channel), None
+
+
+class FakeRemoteFile(object):
+    def __init__(self, instance, path, contents=None):
+        self.instance = instance
+        self.path = path
+        self.contents = contents
+        self.written = []
+
+    def read(self):
+        return self.contents
+
+    def write(self, data):
+        self.written.append(data)
+
+    def close(self):
+        if self.contents is None:
+            self.instance.files[self.path] = "".join(self.written)
+
+
+class FakeSFTP(object):
+    def __init__(self, instance, ssh_client):
+        self.instance = instance
+        self.ssh_client = ssh_client
+
+    def put(self, localpath, remotepath):
+        config = self.instance.cloud.config
+        self.ssh_client.use()
+        size = os.path.getsize(localpath)
+        time.sleep(config.sftp_latency + size / config.bandwidth)
+        if config.fails(config.sftp_failure_rate):
+            raise IOError("Connection reset copying %s" % localpath)
+        self.instance.files[remotepath] = size
+
+    def open(self, path, mode="r"):
+        self.ssh_client.use()
+        time.sleep(self.instance.cloud.config.sftp_latency)
+        if "w" in mode:
+            return FakeRemoteFile(self.instance, path)
+        if path not in self.instance.files:
+            raise IOError("No such file: %s" % path)
+        return FakeRemoteFile(self.instance, path, self.instance.files[path])
+
+    def stat(self, path):
+        if path not in self.instance.files:
+            raise IOError("No such file: %s" % path)
+
+    def mkdir(self, path):
+        self.instance.files[path] = ""
+
+    def chmod(self, path, mode):
+        pass
+
+    def remove(self, path):
+        if self.instance.files.pop(path, None) is None:
+            raise IOError("No such file: %s" % path)
+
+    def close(self):
+        pass
+
+
+class FakeCmdShell(object):
+    """
+    Stand-in for the cmdshell.SSHClient returned by sshclient_from_instance.
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        self._ssh_client = FakeSSHClient(instance)
+
+    def run(self, command):
+        config = self.instance.cloud.config
+        self._ssh_client.use()
+        time.sleep(config.command_latency)
+        if "nohup python -u INSTALL.py" in command:
+            # Starting INSTALL.py in the background
+            failed = config.fails(config.install_failure_rate)
+            self.instance.installed = not failed
+            output = "%s step install 1\n" % dispatcher.INSTALL_STATUS_PREFIX
+            if failed:
+                output += "%s failed step install failed\n" % (
+                    dispatcher.INSTALL_STATUS_PREFIX)
+            else:
+                output += "%s step_done install %.1f 1\n%s ready\n" % (
+                    dispatcher.INSTALL_STATUS_PREFIX, config.install_time,
+                    dispatcher.INSTALL_STATUS_PREFIX)
+            self.instance.install_output = output
+            self.instance.install_done_at = time.time() + config.install_time
+            return 0, "4242\n", ""
+        if command.startswith("ls"):
+            listing = "\n".join(sorted(self.instance.files))
+            # INSTALL.py only creates READY once it has finished
+            if (self.instance.installed and
+                    time.time() >= self.instance.install_done_at):
+                listing += "\nREADY"
+            return 0, listing, ""
+        return 0, "", ""
+
+    def open_sftp(self):
+        self._ssh_client.use()
+        time.sleep(self.instance.cloud.config.sftp_latency)
+        return FakeSFTP(self.instance, self._ssh_client)
+
+
+class FakeBucket(object):
+    def __init__(self, cloud, name):
+        self.cloud = cloud
+        self.name = name
+        self.keys = {}
+
+    def get_key(self, name):
+        time.sleep(self.cloud.config.api_latency)
+        return self.keys.get(name)
+
+
+class FakeKey(object):
+    """
+    Stand-in for boto.s3.key.Key, for staging code bundles in S3.
+    """
+
+    def __init__(self, bucket=None, name=None):
+        self.bucket = bucket
+        self.key = name
+        self.size = 0
+
+    def set_contents_from_filename(self, filename):
+        config = self.bucket.cloud.config
+        self.size = os.path.getsize(filename)
+        time.sleep(config.api_latency + self.size / config.bandwidth)
+        self.bucket.keys[self.key] = self
+
+    def generate_url(self, expires_in):
+        return "https://%s.s3.amazonaws.com/%s" % (self.bucket.name, self.key)
+
+
+class FakeS3Connection(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get_bucket(self, name, validate=True):
+        time.sleep(self.cloud.config.api_latency)
+        with self.cloud.lock:
+            if name not in self.cloud.buckets:
+                raise boto.exception.S3ResponseError(404, "NoSuchBucket")
+            return self.cloud.buckets[name]
+
+    def create_bucket(self, name):
+        time.sleep(self.cloud.config.api_latency)
+        with self.cloud.lock:
+            return self.cloud.buckets.setdefault(name,
+                                                 FakeBucket(self.cloud, name))
+
+
+class FakeCloud(object):
+    """
+    Shared state behind the fake connections: every instance and bucket.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.instances = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def new_instance(self):
+        with self.lock:
+            self.next_id += 1
+            instance = FakeInstance(self, "i-%08x" % self.next_id)
+            self.instances[instance.id] = instance
+        return instance
+
+    def connect_ssh(self, instance, key_file, user_name="ubuntu"):
+        config = self.config
+        time.sleep(config.ssh_latency)
+        if (instance is None or instance.state != "running" or
+                time.time() < (instance.launched + config.boot_time +
+                               config.ssh_ready_delay) or
+                config.fails(config.ssh_failure_rate)):
+            raise IOError("Connection refused")
+        return FakeCmdShell(instance)
+
+    @contextlib.contextmanager
+    def installed(self):
+        """
+        Swap the boto calls cloud_setup makes for this fake cloud while in
+        the with block, starting with no instances looked up or connected
+        to.
+        """
+        originals = (boto.ec2.connect_to_region, boto.s3.connect_to_region,
+                     boto.s3.key.Key,
+                     boto.manage.cmdshell.sshclient_from_instance,
+                     cloud_setup.INSTANCE_INDEX, ssh_pool.POOL)
+        boto.ec2.connect_to_region = lambda *args, **kwargs: \
+            FakeEC2Connection(self)
+        boto.s3.connect_to_region = lambda *args, **kwargs: \
+            FakeS3Connection(self)
+        boto.s3.key.Key = FakeKey
+        boto.manage.cmdshell.sshclient_from_instance = self.connect_ssh
+        cloud_setup.INSTANCE_INDEX = cloud_setup.InstanceIndex()
+        ssh_pool.POOL = ssh_pool.SSHPool()
+        try:
+            yield
+        finally:
+            (boto.ec2.connect_to_region, boto.s3.connect_to_region,
+             boto.s3.key.Key, boto.manage.cmdshell.sshclient_from_instance,
+             cloud_setup.INSTANCE_INDEX, ssh_pool.POOL) = originals
+
+
+def make_workspace(num_files, file_size):
+    """
+    A temporary folder laid out like the aws-runner folder, with a synthetic
+    code folder, for the dispatcher to run in.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    workspace = tempfile.mkdtemp(prefix="aws-runner-benchmark-")
+    for helper_file in dispatcher.HELPER_FILES:
+        shutil.copy(os.path.join(here, helper_file), workspace)
+    with open(os.path.join(workspace, ".boto"), "w") as f:
+        f.write("[Credentials]\n")
+    with open(os.path.join(workspace, "INSTALL.sh"), "w") as f:
+        f.write("#!/bin/bash\ntouch READY\n")
+    os.mkdir(os.path.join(workspace, "config"))
+    with open(os.path.join(workspace, "config", "GUROBI_CLOUD_KEY.txt"),
+              "w") as f:
+        f.write("benchmark-key\n")
+    code_folder = os.path.join(workspace, "code")
+    os.mkdir(code_folder)
+    rng = random.Random(0)
+    for i in range(num_files):
+        with open(os.path.join(code_folder, "file%04d.dat" % i), "wb") as f:
+            f.write("".join(chr(rng.randint(0, 255))
+                            for j in range(file_size)))
+    return workspace
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Hide the dispatcher's progress output while a phase is timed.
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def spot_options(cloud, instance_type):
+    """
+    Arguments for dispatcher.create_instances and request_instances that
+    request the instances as spot instances first if cloud's config says
+    to, through a spot.FakeSpotBackend that makes them in cloud. The
+    requests that aren't fulfilled straight away are cancelled and launched
+    on-demand instead.
+    """
+    if cloud.config.spot_fraction is None:
+        return {}
+    return {"spot_prices": {instance_type: 0.1}, "spot_wait": 0,
+            "spot_backend": spot.FakeSpotBackend(
+                fulfil_fraction=cloud.config.spot_fraction,
+                new_instance=cloud.new_instance)}
+
+
+def run_benchmark(num_tags, config, num_workers=32, stage_s3=False):
+    """
+    Run the dispatcher phases for num_tags synthetic tags against a fresh
+    fake cloud. Must be run from a workspace made by make_workspace.
+    Returns a dictionary of phase -> (seconds, number of tags that failed).
+    """
+    cloud = FakeCloud(config)
+    job = "benchmark"
+    tags = ["%s%d" % (job, i) for i in range(num_tags)]
+    instance_types = ["c4.large"] * num_tags
+    commands = [["python run.py %d" % i] for i in range(num_tags)]
+    job_ledger = ledger.JobLedger(job, path=os.path.join(os.getcwd(),
+                                                         "ledger.sqlite"))
+    job_ledger.record_plan(tags, instance_types, commands)
+
+    timings = {}
+    with cloud.installed():
+        start = time.time()
+        with quiet():
+            dispatcher.create_instances(job, tags, "ami-benchmark", "",
+                                        instance_types, False, job_ledger,
+                                        **spot_options(cloud, "c4.large"))
+        timings["launch"] = (time.time() - start, 0)
+
+        start = time.time()
+        with quiet():
+            insts, cmds, failed = dispatcher.connect_instances(
+                job, tags, False, num_workers, 600, job_ledger)
+        timings["connect"] = (time.time() - start, len(failed))
+        tags = [tag for tag in tags if tag in cmds]
+
+        start = time.time()
+        with quiet():
+            failed, fresh = dispatcher.setup_instances(
+                tags, cmds, insts, "INSTALL.sh", ["code"], ["code"], False,
+                num_workers, (), job if stage_s3 else None, True, job_ledger)
+        timings["setup"] = (time.time() - start, len(failed))
+        tags = [tag for tag in tags if tag not in failed]
+
+        start = time.time()
+        with quiet():
+            failed = dispatcher.dispatch_and_run(
+                job, tags, cmds, [commands[int(tag[len(job):])]
+                                  for tag in tags],
+                "results.csv", [], False, job_ledger)
+        timings["dispatch"] = (time.time() - start, len(failed))
+
+    job_ledger.close()
+    os.remove(os.path.join(os.getcwd(), "ledger.sqlite"))
+    return timings
+
+
+def run_pipeline_benchmark(num_tags, config, num_workers=32, stage_s3=False):
+    """
+    As run_benchmark, but with every tag going through the steps on its own
+    (see dispatcher.run_pipeline).
+    Returns (seconds until the first tag was dispatched, seconds until the
+    last one was, number of tags that failed).
+    """
+    cloud = FakeCloud(config)
+    job = "benchmark"
+    tags = ["%s%d" % (job, i) for i in range(num_tags)]
+    instance_types = ["c4.large"] * num_tags
+    commands = [["python run.py %d" % i] for i in range(num_tags)]
+    job_ledger = ledger.JobLedger(job, path=os.path.join(os.getcwd(),
+                                                         "ledger.sqlite"))
+    job_ledger.record_plan(tags, instance_types, commands)
+
+    with cloud.installed():
+        start = time.time()
+        with quiet():
+            dispatcher.request_instances(job, tags, "ami-benchmark", "",
+                                         instance_types, False, job_ledger,
+                                         **spot_options(cloud, "c4.large"))
+            phases = dict((tag, "launched") for tag in tags)
+            dispatched_at, failed = dispatcher.run_pipeline(
+                job, tags, commands, phases, "INSTALL.sh", ["code"],
+                ["code"], "results.csv", [], True, True, False, num_workers,
+                600, (), job if stage_s3 else None, True, job_ledger)
+
+    job_ledger.close()
+    os.remove(os.path.join(os.getcwd(), "ledger.sqlite"))
+    if not dispatched_at:
+        return None, None, len(failed)
+    return (min(dispatched_at.values()) - start,
+            max(dispatched_at.values()) - start, len(failed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the dispatcher's phases against a fake cloud, "
+                    "without launching anything.")
+    parser.add_argument("--sizes", type=str, default="10,100,1000",
+                        help="Comma-separated numbers of tags to run with. "
+                             "Defaults to 10,100,1000.")
+    parser.add_argument("-w", "--workers", type=int, default=32,
+                        help="Number of instances to connect to or set up "
+                             "at once, as for dispatcher.py. Defaults to 32.")
+    parser.add_argument("--stage_s3", action="store_true",
+                        help="Stage the code folder in (fake) S3, as "
+                             "dispatcher.py --stage_s3 does.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Time dispatcher.py --pipeline instead, "
+                             "reporting when the first and last tags were "
+                             "dispatched.")
+    parser.add_argument("--code_files", type=int, default=50,
+                        help="Number of files in the synthetic code folder.")
+    parser.add_argument("--code_file_size", type=int, default=10000,
+                        help="Size in bytes of each synthetic code file.")
+    parser.add_argument("--api_latency", type=float, default=0.05,
+                        help="Seconds each EC2 or S3 call takes.")
+    parser.add_argument("--boot_time", type=float, default=1.0,
+                        help="Seconds from launch until an instance is "
+                             "running.")
+    parser.add_argument("--ssh_ready_delay", type=float, default=0.0,
+                        help="Seconds from running until SSH connections "
+                             "are accepted.")
+    parser.add_argument("--ssh_latency", type=float, default=0.1,
+                        help="Seconds each SSH connection takes to open.")
+    parser.add_argument("--command_latency", type=float, default=0.02,
+                        help="Seconds each remote command takes.")
+    parser.add_argument("--sftp_latency", type=float, default=0.01,
+                        help="Seconds each SFTP operation takes, before "
+                             "transferring any data.")
+    parser.add_argument("--bandwidth", type=float, default=50e6,
+                        help="Bytes per second for each upload.")
+    parser.add_argument("--install_time", type=float, default=1.0,
+                        help="Seconds INSTALL.py takes on each instance.")
+    parser.add_argument("--api_failure_rate", type=float, default=0.0,
+                        help="Probability that tagging or looking up "
+                             "instances by tag fails.")
+    parser.add_argument("--ssh_failure_rate", type=float, default=0.0,
+                        help="Probability that an SSH connection fails.")
+    parser.add_argument("--sftp_failure_rate", type=float, default=0.0,
+                        help="Probability that an SFTP upload fails.")
+    parser.add_argument("--install_failure_rate", type=float, default=0.0,
+                        help="Probability that INSTALL.py fails.")
+    parser.add_argument("--ssh_drop_rate", type=float, default=0.0,
+                        help="Probability that an SSH connection drops "
+                             "before each command or SFTP operation.")
+    parser.add_argument("--spot_fraction", type=float, default=None,
+                        help="Request the instances as spot instances, "
+                             "with this fraction of the requests "
+                             "fulfilled and the rest launched on-demand.")
+    parser.add_argument("--csv", type=str, default=None,
+                        help="Also append the timings to this CSV file.")
+    args = parser.parse_args()
+
+    config = FakeConfig(
+        api_latency=args.api_latency, boot_time=args.boot_time,
+        ssh_ready_delay=args.ssh_ready_delay, ssh_latency=args.ssh_latency,
+        command_latency=args.command_latency,
+        sftp_latency=args.sftp_latency, bandwidth=args.bandwidth,
+        install_time=args.install_time,
+        api_failure_rate=args.api_failure_rate,
+        ssh_failure_rate=args.ssh_failure_rate,
+        sftp_failure_rate=args.sftp_failure_rate,
+        install_failure_rate=args.install_failure_rate,
+        ssh_drop_rate=args.ssh_drop_rate, spot_fraction=args.spot_fraction)
+
+    here = os.getcwd()
+    workspace = make_workspace(args.code_files, args.code_file_size)
+    os.chdir(workspace)
+    rows = []
+    try:
+        if args.pipeline:
+            print "%s%s%s%s" % ("tags".ljust(8), "first".rjust(12),
+                                "last".rjust(12), "failed".rjust(12))
+        else:
+            print "%s%s%s%s%s%s" % ("tags".ljust(8), "launch".rjust(12),
+                                    "connect".rjust(12), "setup".rjust(12),
+                                    "dispatch".rjust(12), "total".rjust(12))
+        for size in [int(size) for size in args.sizes.split(",")]:
+            if args.pipeline:
+                first, last, num_failed = run_pipeline_benchmark(
+                    size, config, args.workers, args.stage_s3)
+                cells = ["-" if seconds is None else "%.2f" % seconds
+                         for seconds in [first, last]]
+                print "%s%s%s%s" % (str(size).ljust(8), cells[0].rjust(12),
+                                    cells[1].rjust(12),
+                                    str(num_failed).rjust(12))
+                rows.append([time.strftime("%Y-%m-%d %H:%M:%S"), size] +
+                            cells + [num_failed])
+                continue
+            timings = run_benchmark(size, config, args.workers, args.stage_s3)
+            total = sum(timings[phase][0] for phase in PHASES)
+            line = str(size).ljust(8)
+            for phase in PHASES:
+                seconds, num_failed = timings[phase]
+                cell = "%.2f" % seconds
+                if num_failed:
+                    cell += " (%d!)" % num_failed
+                line += cell.rjust(12)
+            print line + ("%.2f" % total).rjust(12)
+            rows.append([time.strftime("%Y-%m-%d %H:%M:%S"), size] +
+                        ["%.3f" % timings[phase][0] for phase in PHASES] +
+                        ["%.3f" % total] +
+                        [timings[phase][1] for phase in PHASES])
+    finally:
+        os.chdir(here)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    if args.csv:
+        write_header = not os.path.exists(args.csv)
+        with open(args.csv, "a") as f:
+            writer = csv.writer(f)
+            if write_header:
+                if args.pipeline:
+                    writer.writerow(["time", "tags", "first", "last",
+                                     "failed"])
+                else:
+                    writer.writerow(["time", "tags"] + PHASES + ["total"] +
+                                    ["%s_failed" % phase for phase in PHASES])
+            writer.writerows(rows)
@@ -0,0 +1,171 @@
+# Packs a code folder into a single compressed archive so it can be copied
+# to an instance in one transfer instead of one SFTP round trip per file.
+# Archives are cached locally under the hash of their contents, so an
+# unchanged folder is only packed once.
+import fnmatch
+import hashlib
+import json
+import os
+import tarfile
+
+CACHE_FOLDER = os.path.expanduser("~/.aws-runner/bundles")
+IGNORE_FILE = ".awsignore"  # .gitignore-style rules in the code folder
+# Records what was copied into a remote code folder, for incremental syncs
+MANIFEST_FILE = ".aws_runner_manifest.json"
+DEFAULT_EXCLUDES = [".git/objects/", "/" + MANIFEST_FILE]
+
+
+def parse_rules(lines):
+    """
+    Turn .gitignore-style lines into (pattern, negate, dir_only, anchored)
+    rules. Blank lines and comments are dropped.
+    """
+    rules = []
+    for line in lines:
+        line = line.rstrip("\n").rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        # A pattern with a slash in it is relative to the folder root
+        anchored = "/" in line
+        line = line.lstrip("/")
+        rules.append((line, negate, dir_only, anchored))
+    return rules
+
+
+def load_rules(localpath, extra_excludes=()):
+    lines = list(DEFAULT_EXCLUDES)
+    ignore_path = os.path.join(localpath, IGNORE_FILE)
+    if os.path.exists(ignore_path):
+        with open(ignore_path, "r") as f:
+            lines += f.readlines()
+    lines += list(extra_excludes)
+    return parse_rules(lines)
+
+
+def is_excluded(relpath, is_dir, rules):
+    """
+    Check a path (relative to the folder root, using /) against the rules.
+    As with .gitignore, the last matching rule wins.
+    """
+    excluded = False
+    name = relpath.split("/")[-1]
+    for pattern, negate, dir_only, anchored in rules:
+        if dir_only and not is_dir:
+            continue
+        if anchored:
+            matched = fnmatch.fnmatch(relpath, pattern)
+        else:
+            matched = fnmatch.fnmatch(name, pattern)
+        if matched:
+            excluded = not negate
+    return excluded
+
+
+def list_files(localpath, rules):
+    """
+    Every file in the folder that isn't excluded, as sorted relative paths.
+    Excluded folders are not descended into.
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(localpath):
+        reldir = os.path.relpath(dirpath, localpath).replace(os.sep, "/")
+        if reldir == ".":
+            reldir = ""
+        prefix = reldir + "/" if reldir else ""
+        dirnames[:] = sorted(d for d in dirnames
+                             if not is_excluded(prefix + d, True, rules))
+        for filename in filenames:
+            if not is_excluded(prefix + filename, False, rules):
+                files.append(prefix + filename)
+    return sorted(files)
+
+
+def hash_file(path):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_files(localpath, files):
+    """
+    Hash the files' names, permissions and contents together, reading each
+    file once. Returns (content hash, manifest), with the manifest as
+    build_manifest describes it.
+    """
+    sha = hashlib.sha1()
+    manifest = {}
+    for relpath in files:
+        path = os.path.join(localpath, relpath)
+        st = os.stat(path)
+        file_hash = hash_file(path)
+        manifest[relpath] = [st.st_size, int(st.st_mtime), file_hash]
+        sha.update(relpath + "\0")
+        sha.update(str(st.st_mode & 0777) + "\0")
+        sha.update(file_hash + "\0")
+    return sha.hexdigest(), manifest
+
+
+def build_manifest(localpath, extra_excludes=()):
+    """
+    Describe every file that would be copied from the folder as
+    relative path -> [size, mtime, sha1].
+    """
+    localpath = os.path.abspath(localpath)
+    rules = load_rules(localpath, extra_excludes)
+    return hash_files(localpath, list_files(localpath, rules))[1]
+
+
+def dump_manifest(manifest):
+    return json.dumps(manifest, sort_keys=True)
+
+
+def load_manifest(text):
+    return json.loads(text)
+
+
+def build_bundle(localpath, extra_excludes=(), cache_folder=CACHE_FOLDER):
+    """
+    Pack the folder into a .tar.gz, reusing a cached archive if the contents
+    haven't changed. Returns (bundle_path, content_hash, manifest), with the
+    manifest of the files packed (see build_manifest).
+    """
+    localpath = os.path.abspath(localpath)
+    rules = load_rules(localpath, extra_excludes)
+    files = list_files(localpath, rules)
+    content_hash, manifest = hash_files(localpath, files)
+
+    bundle_path = os.path.join(cache_folder, content_hash + ".tar.gz")
+    if os.path.exists(bundle_path):
+        return bundle_path, content_hash, manifest
+
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+    # Write to a temporary name first so a half-written archive is never
+    # mistaken for a cached one
+    tmp_path = bundle_path + ".tmp%d" % os.getpid()
+    tar = tarfile.open(tmp_path, "w:gz")
+    for relpath in files:
+        tar.add(os.path.join(localpath, relpath), arcname=relpath,
+                recursive=False)
+    tar.close()
+    os.rename(tmp_path, bundle_path)
+    return bundle_path, content_hash, manifest
+
+
+def unpack_command(remote_bundle, remotepath):
+    """
+    Shell command to unpack an uploaded bundle into remotepath on the
+    instance and then remove it.
+    """
+    return "mkdir -p %s && tar -xzf %s -C %s && rm -f %s" % (
+        remotepath, remote_bundle, remotepath, remote_bundle)
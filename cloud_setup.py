@@ -1,15 +1,81 @@
 # These are the run-once tasks to get AWS ready-for-use, in addition to
 # utilities used by our scripts to access AWS.
+import binascii
+import gzip
+import hashlib
+import json
 import os
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 import boto.ec2
 import boto.exception
 import boto.manage.cmdshell
+import boto.s3
+import boto.s3.key
+import boto.s3.multipart
 import boto.sdb
+import boto.utils
 import pprint
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # Only needed for zstd-compressed results
+
 SSH_FOLDER = os.path.expanduser("~/.ssh/")
 AWS_REGION = "us-east-1"  # US East (Virginia)
+# Prefix for the files the dispatcher keeps in a job's S3 bucket, as opposed
+# to results uploaded by the instances
+S3_STAGING_PREFIX = "_aws_runner/"
+
+# Objects bigger than this are downloaded in ranged parts of this size
+DOWNLOAD_PART_SIZE = 64 * 1024 * 1024
+# SimpleDB requests are retried this many times, with exponential backoff,
+# if the service is throttling us
+SDB_RETRIES = 8
+SDB_RETRY_START = 0.5
+SDB_THROTTLE_CODES = ["ServiceUnavailable", "RequestThrottled"]
+
+# Files bigger than this are uploaded with S3 multipart uploads, in parts of
+# this size (S3 needs parts to be at least 5MB)
+UPLOAD_PART_SIZE = 64 * 1024 * 1024
+# Suffixes added to the S3 keys of compressed results
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+# Where download_s3_bucket remembers the ETags of what it has downloaded
+DOWNLOAD_ETAGS_FILE = ".s3_etags.json"
+
+# How long (seconds) looked up instances are cached for, and the most tags to
+# put in one filtered lookup
+INDEX_TTL = 30
+INDEX_FILTER_SIZE = 195
+
+# Number of instances to tag at once after launching them
+TAG_WORKERS = 8
+
+# (vCPUs, memory in GiB) for the instance types we commonly pack jobs onto.
+# Extend this if you want to pack onto a type that isn't listed.
+INSTANCE_SPECS = {
+    "t2.micro": (1, 1.0),
+    "t2.small": (1, 2.0),
+    "t2.medium": (2, 4.0),
+    "t2.large": (2, 8.0),
+    "m4.large": (2, 8.0),
+    "m4.xlarge": (4, 16.0),
+    "m4.2xlarge": (8, 32.0),
+    "m4.4xlarge": (16, 64.0),
+    "m4.10xlarge": (40, 160.0),
+    "c4.large": (2, 3.75),
+    "c4.xlarge": (4, 7.5),
+    "c4.2xlarge": (8, 15.0),
+    "c4.4xlarge": (16, 30.0),
+    "c4.8xlarge": (36, 60.0),
+    "r3.large": (2, 15.25),
+    "r3.xlarge": (4, 30.5),
+    "r3.2xlarge": (8, 61.0),
+    "r3.4xlarge": (16, 122.0),
+    "r3.8xlarge": (32, 244.0),
+}
 
 
 def create_keypair(key_name):
@@ -49,20 +115,45 @@ def launch_instance(tag, key_name, group_name, inst_type, ami_name, user_data,
     Launch a testing instance. Doesn't actually attempt to connect as
     it can take quite a while between 'running' and connectability
     """
+    instances = launch_instances([tag], key_name, group_name, inst_type,
+                                 ami_name, user_data, wait)
+    if not instances:
+        return None
+    if returninfo:
+        returninfo.put(tag)
+    return instances[0]
+
+
+def launch_instances(tags, key_name, group_name, inst_type, ami_name,
+                     user_data, wait=True):
+    """
+    Launch one instance of the same type for each tag, asking for as many as
+    possible in each run_instances call rather than one call per instance.
+    Doesn't actually attempt to connect as it can take quite a while between
+    'running' and connectability.
+    Returns the list of instances, in the same order as tags. If they could
+    not all be launched, the ones that were are still tagged and returned,
+    for the first tags, so that they can be found again.
+    """
     ec2 = boto.ec2.connect_to_region(AWS_REGION)
+    instances = []
     failures = 0
     max_failures = 10
-    while True:
+    while len(instances) < len(tags):
+        remaining = len(tags) - len(instances)
         try:
             reservation = ec2.run_instances(ami_name,
+                                            min_count=1,
+                                            max_count=remaining,
                                             key_name=key_name,
                                             security_groups=[group_name],
                                             instance_type=inst_type,
                                             user_data=None)
-            break
+            instances += reservation.instances
+            continue
         except Exception, err:
-            # Failed to get instance; wait 15 seconds and then try again (up to
-            # 10 total times)
+            # Failed to get instances; wait 15 seconds and then try again (up
+            # to 10 total times)
             errortext = str(err)
             if errortext.find("Not authorized for images") >= 0:
                 print "**************************************"
@@ -78,7 +169,7 @@ def launch_instance(tag, key_name, group_name, inst_type, ami_name, user_data,
                 print "* (Full text of error):"
                 print errortext
                 print "***************************************"
-                return None
+                break
             elif errortext.find("accept terms and subscribe") >= 0:
                 print "**************************************"
                 print "* Error from AWS suggests that you have never used this"
@@ -91,7 +182,7 @@ def launch_instance(tag, key_name, group_name, inst_type, ami_name, user_data,
                 print "* (Full text of error):"
                 print errortext
                 print "**************************************"
-                return None
+                break
             failures += 1
             if failures == max_failures:
                 print "**************************************"
@@ -99,49 +190,191 @@ def launch_instance(tag, key_name, group_name, inst_type, ami_name, user_data,
                 print "* (Full text of error):"
                 print errortext
                 print "**************************************"
-                return None
-            print "    ** ec2.run_instances failed for tag", tag, "; waiting 15"
+                break
+            print "    ** ec2.run_instances failed for %d %s; waiting 15" % (
+                remaining, inst_type)
             print "    ** seconds and then trying again..."
             time.sleep(15)
 
-    time.sleep(5)  # Slow things down -- they're never running super fast anyway
-    instance = reservation.instances[0]
-    time.sleep(5)  # Slow things down -- they're never running super fast anyway
-    instance.add_tag("tag", tag)
-    time.sleep(5)  # Slow things down -- they're never running super fast anyway
+    tag_instances(ec2, instances, tags[:len(instances)])
 
     if wait:
-        print "    Instance requested, waiting for 'running' for tag", tag
-        while instance.state != "running":
-            print "    %s ..." % tag
-            time.sleep(5)
-            try:
-                instance.update()
-            except boto.exception.EC2ResponseError as e:
-                print "******************"
-                print "Error caught in instance.update():"
-                print e.strerror
-                print "******************"
-        print "    %s done!" % tag
-    if returninfo:
-        returninfo.put(tag)
-    return instance
+        wait_for_running([instance.id for instance in instances], ec2=ec2)
+    return instances
+
+
+def tag_instances(ec2, instances, tags, num_workers=TAG_WORKERS):
+    """
+    Give each instance its tag. Each instance needs its own request, so up
+    to num_workers are tagged at once, each thread with its own connection
+    as boto connections can't be shared between threads.
+    """
+    items = zip(instances, tags)
+    if num_workers <= 1 or len(items) <= 1:
+        for instance, tag in items:
+            tag_instance(ec2, instance, tag)
+        return
+
+    local = threading.local()
+
+    def tag_with_local(item):
+        if not hasattr(local, "ec2"):
+            local.ec2 = boto.ec2.connect_to_region(AWS_REGION)
+        tag_instance(local.ec2, *item)
+
+    pool = ThreadPool(min(num_workers, len(items)))
+    try:
+        pool.map(tag_with_local, items)
+    finally:
+        pool.close()
+
+
+def tag_instance(ec2, instance, tag):
+    """
+    New instances can take a little while to be visible to the tagging API,
+    so retry with a growing delay.
+    """
+    delay = 1
+    while True:
+        try:
+            ec2.create_tags([instance.id], {"tag": tag})
+            instance.tags["tag"] = tag
+            return
+        except boto.exception.EC2ResponseError:
+            if delay > 60:
+                raise
+            time.sleep(delay)
+            delay *= 2
+
+
+def wait_for_running(instance_ids, verbose=True, ec2=None):
+    """
+    Wait until all the instances are 'running', checking on all of them with
+    a single request per round. Returns a dictionary of instance ID -> time
+    it was first seen running.
+    """
+    if ec2 is None:
+        ec2 = boto.ec2.connect_to_region(AWS_REGION)
+    pending = set(instance_ids)
+    running_at = {}
+    if verbose:
+        print "    Instances requested, waiting for 'running'"
+    while pending:
+        time.sleep(5)
+        try:
+            reservations = ec2.get_all_instances(instance_ids=list(pending))
+        except boto.exception.EC2ResponseError as e:
+            print "******************"
+            print "Error caught in get_all_instances():"
+            print e.strerror
+            print "******************"
+            continue
+        for res in reservations:
+            for inst in res.instances:
+                if inst.state == "running" and inst.id in pending:
+                    pending.discard(inst.id)
+                    running_at[inst.id] = time.time()
+        if verbose:
+            print "    %d/%d running" % (len(instance_ids) - len(pending),
+                                        len(instance_ids))
+    return running_at
+
+
+class InstanceIndex(object):
+    """
+    Short-lived cache of tag -> running instance, so that looking up many
+    tags doesn't list every instance in the account for each one. Lookups
+    use server-side filters on the tag, and refresh() fetches many tags in a
+    single request.
+    """
+
+    def __init__(self, ttl=INDEX_TTL):
+        self.ttl = ttl
+        self.instances = {}  # tag -> (instance or None, time fetched)
+        self.lock = threading.Lock()
+
+    def refresh(self, tags):
+        """
+        Fetch the running instances for all these tags in bulk.
+        """
+        tags = list(tags)
+        ec2 = boto.ec2.connect_to_region(AWS_REGION)
+        for start in range(0, len(tags), INDEX_FILTER_SIZE):
+            chunk = tags[start:start + INDEX_FILTER_SIZE]
+            reservations = ec2.get_all_instances(filters={
+                "tag:tag": chunk,
+                "instance-state-name": "running",
+            })
+            now = time.time()
+            with self.lock:
+                # Remember tags with no running instance too, so looking
+                # them up again straight away doesn't need another request
+                for tag in chunk:
+                    self.instances[tag] = (None, now)
+                for res in reservations:
+                    for inst in res.instances:
+                        self.instances[inst.tags["tag"]] = (inst, now)
+
+    def get(self, tag):
+        with self.lock:
+            entry = self.instances.get(tag)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            self.refresh([tag])
+            with self.lock:
+                entry = self.instances.get(tag)
+        return entry[0]
+
+    def forget(self, tag):
+        with self.lock:
+            self.instances.pop(tag, None)
+
+
+INSTANCE_INDEX = InstanceIndex()
 
 
 def get_instance(tag):
     """
     Get instance by tag
     """
+    inst = INSTANCE_INDEX.get(tag)
+    if inst is None:
+        print "Couldn't find instance"
+    return inst
+
+
+def get_instance_states(instance_ids):
+    """
+    Returns a dictionary of instance ID -> state for the instances that
+    still exist, using a single request.
+    """
     ec2 = boto.ec2.connect_to_region(AWS_REGION)
-    reservations = ec2.get_all_instances()
-    for res in reservations:
-        for inst in res.instances:
-            if "tag" in inst.tags.keys():
-                if inst.tags["tag"] == tag and inst.state == "running":
-                    #print "Found %s"%tag
-                    return inst
-    print "Couldn't find instance"
-    return None
+    states = {}
+    instance_ids = list(instance_ids)
+    for start in range(0, len(instance_ids), INDEX_FILTER_SIZE):
+        chunk = instance_ids[start:start + INDEX_FILTER_SIZE]
+        for res in ec2.get_all_instances(filters={"instance-id": chunk}):
+            for inst in res.instances:
+                states[inst.id] = inst.state
+    return states
+
+
+def find_instances_by_tag(tags):
+    """
+    Returns a dictionary of tag -> instance for the tags that have a pending
+    or running instance, a request per INDEX_FILTER_SIZE tags. Unlike
+    INSTANCE_INDEX this includes instances that are still starting up.
+    """
+    ec2 = boto.ec2.connect_to_region(AWS_REGION)
+    instances = {}
+    tags = list(tags)
+    for start in range(0, len(tags), INDEX_FILTER_SIZE):
+        chunk = tags[start:start + INDEX_FILTER_SIZE]
+        for res in ec2.get_all_instances(filters={
+                "tag:tag": chunk,
+                "instance-state-name": ["pending", "running"]}):
+            for inst in res.instances:
+                instances[inst.tags["tag"]] = inst
+    return instances
 
 
 def connect_instance(tag, key_name, user_name):
@@ -160,6 +393,7 @@ def connect_instance(tag, key_name, user_name):
 def terminate_instance(tag):
     inst = get_instance(tag)
     inst.terminate()
+    INSTANCE_INDEX.forget(tag)
 
 
 def add_tag(instance_tag, new_tag_key, new_tag_val):
@@ -185,17 +419,53 @@ def delete_sdb_domain(domain_name):
     sdb.delete_domain(domain_name)
 
 
+def is_sdb_throttled(err):
+    return err.status == 503 or err.error_code in SDB_THROTTLE_CODES
+
+
+def sdb_call(function, *args, **kwargs):
+    """
+    Make a SimpleDB request, retrying with backoff while it is throttled.
+    """
+    delay = SDB_RETRY_START
+    for attempt in range(SDB_RETRIES):
+        try:
+            return function(*args, **kwargs)
+        except boto.exception.SDBResponseError, err:
+            if not is_sdb_throttled(err) or attempt == SDB_RETRIES - 1:
+                raise
+            time.sleep(delay)
+            delay *= 2
+
+
+def sdb_select(sdb, dom, query, consistent_read=False):
+    """
+    Run a select one page at a time, yielding items as each page arrives
+    rather than collecting them all first. Each page is retried if
+    throttled.
+    """
+    next_token = None
+    while True:
+        rs = sdb_call(sdb.select, dom, query, next_token=next_token,
+                      consistent_read=consistent_read)
+        for item in rs:
+            yield item
+        next_token = getattr(rs, "next_token", None)
+        if not next_token:
+            break
+
+
 def dump_sdb_domain(domain_name):
     pp = pprint.PrettyPrinter(indent=2)
     sdb, dom = setup_sdb_domain(domain_name)
-    rs = dom.select('select * from `' + domain_name + '`')
+    rs = sdb_select(sdb, dom, 'select * from `' + domain_name + '`')
     for j in rs:
         pp.pprint(j)
 
 
 def get_sdb_domain_size(domain_name):
     sdb, dom = setup_sdb_domain(domain_name)
-    rs = dom.select('select count(*) from `' + domain_name + '`')
+    rs = sdb_select(sdb, dom, 'select count(*) from `' + domain_name + '`')
     ct = 0
     for res in rs:
         ct += int(res[u'Count'])
@@ -227,16 +497,245 @@ def add_file_to_s3_bucket(bucket, filekey, filename):
     key.set_contents_from_filename(filename)
 
 
-def download_s3_bucket(bucket_name, output_folder):
+def compress_file(filename, method, output_filename):
+    """
+    Compress a file with gzip or zstd (which needs the zstandard package).
+    """
+    with open(filename, "rb") as f_in:
+        if method == "gzip":
+            f_out = gzip.open(output_filename, "wb")
+            try:
+                while True:
+                    chunk = f_in.read(1 << 20)
+                    if not chunk:
+                        break
+                    f_out.write(chunk)
+            finally:
+                f_out.close()
+        elif method == "zstd":
+            if zstandard is None:
+                raise ValueError("zstd compression needs the zstandard "
+                                 "package")
+            with open(output_filename, "wb") as f_out:
+                zstandard.ZstdCompressor().copy_stream(f_in, f_out)
+        else:
+            raise ValueError("Unknown compression method %s" % method)
+
+
+def decompress_file(filename, method, output_filename):
+    """
+    Undo compress_file.
+    """
+    with open(output_filename, "wb") as f_out:
+        if method == "gzip":
+            f_in = gzip.open(filename, "rb")
+            try:
+                while True:
+                    chunk = f_in.read(1 << 20)
+                    if not chunk:
+                        break
+                    f_out.write(chunk)
+            finally:
+                f_in.close()
+        elif method == "zstd":
+            if zstandard is None:
+                raise ValueError("zstd decompression needs the zstandard "
+                                 "package")
+            with open(filename, "rb") as f_in:
+                zstandard.ZstdDecompressor().copy_stream(f_in, f_out)
+        else:
+            raise ValueError("Unknown compression method %s" % method)
+
+
+def split_compression_suffix(keyname):
+    """
+    Returns (key name without any compression suffix, compression method or
+    None).
+    """
+    for method, suffix in COMPRESSION_SUFFIXES.items():
+        if keyname.endswith(suffix):
+            return keyname[:-len(suffix)], method
+    return keyname, None
+
+
+def upload_file_to_s3(bucket_name, keyname, filename,
+                      part_size=UPLOAD_PART_SIZE, num_workers=4):
+    """
+    Upload a file, as a multipart upload with up to num_workers parts sent
+    at once if it is bigger than part_size. Every request carries the MD5 of
+    what it sends so S3 rejects anything corrupted on the way, and the ETag
+    of the finished object is checked against the file before returning.
+    Raises IOError if it doesn't match.
+    """
+    s3, bucket = setup_s3_bucket(bucket_name)
+    size = os.path.getsize(filename)
+
+    if size <= part_size:
+        key = boto.s3.key.Key(bucket)
+        key.key = keyname
+        with open(filename, "rb") as f:
+            md5 = boto.utils.compute_md5(f)
+            key.set_contents_from_file(f, md5=md5[:2])
+        expected_etag = md5[0]
+    else:
+        mp = bucket.initiate_multipart_upload(keyname)
+        parts = [(part_num + 1, offset, min(part_size, size - offset))
+                 for part_num, offset in enumerate(range(0, size, part_size))]
+
+        # boto connections can't be shared between threads
+        local = threading.local()
+
+        def upload_part(part):
+            part_num, offset, part_bytes = part
+            if not hasattr(local, "bucket"):
+                local.s3, local.bucket = setup_s3_bucket(bucket_name)
+            local_mp = boto.s3.multipart.MultiPartUpload(local.bucket)
+            local_mp.key_name = keyname
+            local_mp.id = mp.id
+            with open(filename, "rb") as f:
+                f.seek(offset)
+                md5 = boto.utils.compute_md5(f, size=part_bytes)
+                local_mp.upload_part_from_file(f, part_num, md5=md5[:2],
+                                               size=part_bytes)
+            return md5[0]
+
+        pool = ThreadPool(max(1, min(num_workers, len(parts))))
+        try:
+            part_md5s = pool.map(upload_part, parts)
+            mp.complete_upload()
+        except:
+            mp.cancel_upload()
+            raise
+        finally:
+            pool.close()
+        # S3's ETag for a multipart upload is the MD5 of the parts' MD5s
+        expected_etag = "%s-%d" % (
+            hashlib.md5("".join(binascii.unhexlify(part_md5)
+                                for part_md5 in part_md5s)).hexdigest(),
+            len(parts))
+
+    etag = bucket.get_key(keyname).etag.strip('"')
+    if etag != expected_etag:
+        raise IOError("Uploaded %s to %s but its ETag is %s, expected %s" %
+                      (filename, keyname, etag, expected_etag))
+
+
+def stage_file_in_s3_bucket(bucket_name, name, filename, expires_in=86400):
+    """
+    Upload a file for the instances to download, unless it is already there.
+    Returns a presigned URL the instances can fetch it from without needing
+    any AWS credentials.
+    """
+    s3, bucket = setup_s3_bucket(bucket_name)
+    keyname = S3_STAGING_PREFIX + name
+    key = bucket.get_key(keyname)
+    if key is None:
+        key = boto.s3.key.Key(bucket)
+        key.key = keyname
+        key.set_contents_from_filename(filename)
+    return key.generate_url(expires_in)
+
+
+def key_matches_local_file(key, filename, known_etag=None):
+    """
+    Whether a local file already has the contents of an S3 key, going by its
+    size and ETag. known_etag is the ETag recorded when the file was last
+    downloaded; without one we can still check keys that weren't uploaded
+    in parts, whose ETag is the MD5 of their contents.
+    """
+    if not os.path.exists(filename) or os.path.getsize(filename) != key.size:
+        return False
+    etag = key.etag.strip('"')
+    if known_etag is not None:
+        return known_etag == etag
+    if "-" in etag:
+        return False  # Multipart ETag, can't check it from the contents
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), ""):
+            md5.update(chunk)
+    return md5.hexdigest() == etag
+
+
+def download_s3_key(key, filename, part_size=DOWNLOAD_PART_SIZE):
+    """
+    Download a key to a file, a part at a time with ranged requests so large
+    objects never need to be held in memory. The file only appears once the
+    download is complete.
+    """
+    folder = os.path.dirname(filename)
+    if folder and not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass  # Another thread made it first
+    tmp_filename = filename + ".part"
+    with open(tmp_filename, "wb") as f:
+        if key.size <= part_size:
+            key.get_contents_to_file(f)
+        else:
+            for start in range(0, key.size, part_size):
+                end = min(start + part_size, key.size) - 1
+                key.get_contents_to_file(
+                    f, headers={"Range": "bytes=%d-%d" % (start, end)})
+    os.rename(tmp_filename, filename)
+
+
+def download_s3_bucket(bucket_name, output_folder, prefix="", tag=None,
+                       num_workers=16, part_size=DOWNLOAD_PART_SIZE):
+    """
+    Download the contents of a bucket, skipping files already downloaded.
+    Only keys starting with prefix are downloaded, and if tag is given only
+    results uploaded by that instance. Up to num_workers keys are downloaded
+    at once.
+    Returns (number downloaded, number skipped).
+    """
     s3, bucket = setup_s3_bucket(bucket_name)
 
     if not os.path.exists(output_folder):
         os.mkdir(output_folder)
 
-    bucket_list = bucket.list()
-    for key in bucket_list:
-      d = os.path.join(output_folder, key.key)
-      key.get_contents_to_filename(d)
+    # ETags of what we downloaded before, to tell when files are up to date
+    etags_filename = os.path.join(output_folder, DOWNLOAD_ETAGS_FILE)
+    etags = {}
+    if os.path.exists(etags_filename):
+        with open(etags_filename, "r") as f:
+            etags = json.load(f)
+    etags_lock = threading.Lock()
+
+    # boto connections can't be shared between threads
+    local = threading.local()
+
+    def download(key):
+        if not hasattr(local, "bucket"):
+            local.s3, local.bucket = setup_s3_bucket(bucket_name)
+        filename = os.path.join(output_folder, key.key)
+        if key_matches_local_file(key, filename, etags.get(key.key)):
+            return False
+        local_key = boto.s3.key.Key(local.bucket, key.key)
+        local_key.size = key.size
+        download_s3_key(local_key, filename, part_size)
+        with etags_lock:
+            etags[key.key] = key.etag.strip('"')
+        return True
+
+    keys = []
+    for key in bucket.list(prefix=prefix):
+        if key.key.startswith(S3_STAGING_PREFIX):
+            continue
+        if tag is not None and key.key.find("-%s-%s-" % (bucket_name,
+                                                          tag)) < 0:
+            continue
+        keys.append(key)
+
+    pool = ThreadPool(max(1, min(num_workers, len(keys))))
+    try:
+        downloaded = pool.map(download, keys)
+    finally:
+        pool.close()
+        with open(etags_filename, "w") as f:
+            json.dump(etags, f)
+    return downloaded.count(True), downloaded.count(False)
 
 
 ###############################################################################
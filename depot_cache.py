@@ -0,0 +1,144 @@
+# Shares what slow install steps produce, like the Julia package depot or an
+# R library, between the instances of a job. The first instance to finish
+# such a step packs the folders it names into a tarball and uploads it to
+# the job's S3 bucket, under the hash of the step and everything in
+# INSTALL.sh before it. The other instances download and unpack that instead
+# of resolving, downloading and compiling the same packages again. A local
+# folder can stand in for the bucket to try it out.
+import os
+import shutil
+import tarfile
+import tempfile
+
+# Where the tarballs go in the job's bucket. Under cloud_setup's staging
+# prefix, so they aren't downloaded along with the results.
+S3_PREFIX = "_aws_runner/depot/"
+
+
+def resolve_paths(paths):
+    """
+    Absolute paths of the folders to cache. Relative paths and ~ are taken
+    from the home folder, where INSTALL.py runs.
+    """
+    return [os.path.abspath(os.path.expanduser(path)) for path in paths]
+
+
+def pack(paths, tarball):
+    """
+    Pack the folders into a gzipped tarball, with their absolute paths so
+    they unpack back into the same place. Folders that don't exist are left
+    out. Returns the paths that were packed.
+    """
+    packed = []
+    with tarfile.open(tarball, "w:gz") as tar:
+        for path in resolve_paths(paths):
+            if os.path.exists(path):
+                tar.add(path, arcname=path.lstrip("/"))
+                packed.append(path)
+    return packed
+
+
+def unpack(tarball):
+    with tarfile.open(tarball, "r:gz") as tar:
+        tar.extractall("/")
+
+
+class S3DepotBackend(object):
+    """
+    Stores the tarballs in an S3 bucket.
+    """
+
+    def __init__(self, bucket_name):
+        # Imported here as boto is only installed part way through INSTALL.sh
+        import cloud_setup
+        self.cloud_setup = cloud_setup
+        self.bucket_name = bucket_name
+        self.s3, self.bucket = cloud_setup.setup_s3_bucket(bucket_name)
+
+    def exists(self, name):
+        return self.bucket.get_key(S3_PREFIX + name) is not None
+
+    def fetch(self, name, filename):
+        """
+        Download a tarball to filename. Returns False if there isn't one.
+        """
+        key = self.bucket.get_key(S3_PREFIX + name)
+        if key is None:
+            return False
+        self.cloud_setup.download_s3_key(key, filename)
+        return True
+
+    def store(self, name, filename):
+        self.cloud_setup.upload_file_to_s3(self.bucket_name, S3_PREFIX + name,
+                                           filename)
+
+
+class LocalDepotBackend(object):
+    """
+    Stores the tarballs in a local folder, as a stand-in for S3.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.path, name))
+
+    def fetch(self, name, filename):
+        if not self.exists(name):
+            return False
+        shutil.copyfile(os.path.join(self.path, name), filename)
+        return True
+
+    def store(self, name, filename):
+        # Copy then rename, so a tarball is never seen half written
+        target = os.path.join(self.path, name)
+        shutil.copyfile(filename, target + ".tmp")
+        os.rename(target + ".tmp", target)
+
+
+def get_backend(bucket_name=None, local_path=None):
+    if local_path:
+        return LocalDepotBackend(local_path)
+    return S3DepotBackend(bucket_name)
+
+
+def tarball_name(step, step_hash):
+    return "%s-%s.tar.gz" % (step, step_hash)
+
+
+def restore(backend, step, step_hash):
+    """
+    Unpack the tarball of a step with this hash, if an instance has stored
+    one. Returns whether it did.
+    """
+    handle, filename = tempfile.mkstemp(suffix=".tar.gz")
+    os.close(handle)
+    try:
+        if not backend.fetch(tarball_name(step, step_hash), filename):
+            return False
+        unpack(filename)
+        return True
+    finally:
+        os.remove(filename)
+
+
+def save(backend, step, step_hash, paths):
+    """
+    Pack and store the folders a step produced, unless another instance
+    already has. Returns whether this one did.
+    """
+    name = tarball_name(step, step_hash)
+    if backend.exists(name):
+        return False
+    handle, filename = tempfile.mkstemp(suffix=".tar.gz")
+    os.close(handle)
+    try:
+        if not pack(paths, filename):
+            return False
+        backend.store(name, filename)
+        return True
+    finally:
+        os.remove(filename)
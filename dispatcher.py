@@ -1,64 +1,140 @@
 import argparse
 import csv
-import multiprocessing
+import functools
 import os
 import sys
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
+import ami_cache
+import bundle
 import cloud_setup
 import gurobi_aws
+import ledger
+import orchestrator
+import spot
+import ssh_pool
+import tracing
+import work_queue
+
+# Seconds to wait between connection attempts to an instance, doubling
+# after each failed attempt
+CONNECT_BACKOFF_START = 5
+CONNECT_BACKOFF_MAX = 60
+
+# Number of EC2 requests to make at once
+EC2_WORKERS = 8
+
+# Seconds between checks on launched instances that aren't running yet
+RUNNING_POLL = 5
+
+# Seconds between checks for status lines from INSTALL.py
+INSTALL_POLL = 1
+
+# Seconds between checks on instances that are still booting when
+# pipelining
+PIPELINE_BOOT_POLL = 5
+
+# States of an instance that is never going to be running
+BOOT_FAILED_STATES = ["shutting-down", "terminated", "stopping", "stopped"]
+
+# What each tag can be doing when pipelining, in order
+PIPELINE_STATES = ["booting", "connecting", "setting_up", "installing",
+                   "dispatching", "done", "failed"]
+
+# Start of the status lines INSTALL.py writes back to us, to the status file
+# on the instance, and where its process ID is kept
+INSTALL_STATUS_PREFIX = "AWS_RUNNER_STATUS"
+INSTALL_STATUS_FILE = "install_status.txt"
+INSTALL_PID_FILE = "install.pid"
+# Where the markers run_once leaves on instances go
+STARTED_FOLDER = ".aws_runner_started"
+# Times in a row we follow INSTALL.py again after losing the connection,
+# without hearing anything from it in between, before giving up on it
+INSTALL_REATTACH_ATTEMPTS = 5
+
+# What setting up an instance leaves in its home folder besides the code
+# folders, which has no place in a cached AMI made from it
+SETUP_STATE_FILES = [".boto", "READY", INSTALL_STATUS_FILE, INSTALL_PID_FILE,
+                     "install_output.txt", "failure.txt",
+                     "INSTALL_STEPS.json", "install_steps", "progress_*_*.txt",
+                     STARTED_FOLDER]
+# Where those and the code folders are kept while the AMI is created. It is
+# in memory, so isn't part of the image.
+IMAGE_STASH = "/dev/shm/aws-runner-image.tar"
+
+# Helper scripts copied to the home folder of every instance
+HELPER_FILES = [
+    "INSTALL.py",  # Python script to run INSTALL.sh
+    "depot_cache.py",  # For sharing what install steps make
+    "update_tags.py",  # For updating tags and results
+    "save_results.py",
+    "self_terminate.py",
+    "queue_runner.py",  # For queue mode
+    "work_queue.py",
+    "spot.py",  # For noticing spot interruptions
+    "cloud_setup.py",
+    "results_db.py",
+]
 
 
 def create_instances(job, tags, ami_name, user_data, instance_types,
-                     verbose=True):
+                     verbose=True, job_ledger=None, spot_prices=None,
+                     spot_wait=300, spot_backend=None):
     """
-    Simply create an instance for each tag. Uses multiprocessing to create them
-    in parallel.
+    Simply create an instance for each tag. Instances of the same type are
+    requested together in batches, the types at the same time, and the
+    instances of each type are waited on to be running as soon as they have
+    been launched, checking on all of them with a single request per round.
+    Instance types with a maximum price in spot_prices are first requested
+    as spot instances, and any not fulfilled within spot_wait seconds are
+    launched on-demand instead.
     """
 
-    if verbose:
-        print "Launching instances... "
-    procs = []
-    returninfo = multiprocessing.Queue()
-    for tag, instance_type in zip(tags, instance_types):
-        if verbose:
-            print "  Launching %s ..." % tag
-
-        proc = multiprocessing.Process(
-            target=cloud_setup.launch_instance,
-            args=(),
-            kwargs={
-                "tag": tag,
-                "key_name": job,
-                "group_name": job,
-                "inst_type": instance_type,
-                "ami_name": ami_name,
-                "user_data": user_data,
-                "wait": True,
-                "returninfo": returninfo,
-            }
-        )
-        procs.append(proc)
-        proc.start()
-
-    # Wait for all instances to be launched
-    for proc in procs:
-        proc.join()
-
-    # Count number of processes that have launched
-    numstarted = 0
-    try:
-        while True:
-            returninfo.get(False)
-            numstarted += 1
-    except:
-        pass  # Queue is empty
-
-    # Check we all started correctly
-    if numstarted != len(tags):
-        print "Exiting because", numstarted, "instances started out of",
-        print len(tags)
-        exit(0)
+    loop = orchestrator.Orchestrator({"ec2": EC2_WORKERS})
+    launched_ids = []
+    pending = set()
+    running_at = {}
+
+    def launched(tag, instance):
+        if not pending:
+            loop.call_later(RUNNING_POLL, check_running)
+        launched_ids.append(instance.id)
+        pending.add(instance.id)
+
+    def check_running():
+        loop.submit("ec2", cloud_setup.get_instance_states, (list(pending),),
+                    checked)
+
+    def checked(states, error):
+        if error is not None:
+            print "    ** Looking up instances failed: %s" % error
+        else:
+            for instance_id, state in states.items():
+                if state == "running" and instance_id in pending:
+                    pending.discard(instance_id)
+                    running_at[instance_id] = time.time()
+            if verbose:
+                print "    %d/%d running" % (
+                    len(launched_ids) - len(pending), len(launched_ids))
+        if pending:
+            loop.call_later(RUNNING_POLL, check_running)
+
+    launcher = Launcher(loop, job, ami_name, user_data, verbose, job_ledger,
+                        spot_prices, spot_wait, spot_backend, launched)
+    launcher.start(tags, instance_types)
+    loop.run()
+    launcher.check()
+
+    for tag, instance_id in zip(launcher.tags_launched,
+                                launcher.instance_ids):
+        start, returned = launcher.requested[tag]
+        tracing.add_span("launch:request", start, returned, tag,
+                         instance_id=instance_id)
+        tracing.add_span("launch:wait_running", returned,
+                         running_at.get(instance_id, time.time()), tag,
+                         instance_id=instance_id)
 
     if verbose:
         print " All instances launched, but not necessarily ready for"
@@ -67,149 +143,1002 @@ def create_instances(job, tags, ami_name, user_data, instance_types,
         raw_input()
 
 
-def connect_instances(job, tags, verbose=True):
+def request_instances(job, tags, ami_name, user_data, instance_types,
+                      verbose=True, job_ledger=None, spot_prices=None,
+                      spot_wait=300, spot_backend=None):
+    """
+    Ask EC2 for an instance for each tag (see create_instances), without
+    waiting for them to be running.
+    Returns:
+      tags_launched  The tags, in the order they were launched
+      instance_ids   The instance ID for each of tags_launched
+      requested      Dictionary of tag -> (time requested, time the request
+                     returned)
+    """
+
+    loop = orchestrator.Orchestrator({"ec2": EC2_WORKERS})
+    launcher = Launcher(loop, job, ami_name, user_data, verbose, job_ledger,
+                        spot_prices, spot_wait, spot_backend)
+    launcher.start(tags, instance_types)
+    loop.run()
+    launcher.check()
+    return launcher.tags_launched, launcher.instance_ids, launcher.requested
+
+
+class Launcher(object):
+    """
+    Launches the instances for tags on an Orchestrator, with a call on an
+    EC2 worker for each instance type (see launch_instance_type), so that
+    waiting on the spot requests for one type doesn't hold up the others.
+    Launched instances are recorded in the ledger as soon as their type's
+    call returns, and on_launched(tag, instance) is called for each.
+    """
+
+    def __init__(self, loop, job, ami_name, user_data, verbose=True,
+                 job_ledger=None, spot_prices=None, spot_wait=300,
+                 spot_backend=None, on_launched=None):
+        self.loop = loop
+        self.job = job
+        self.ami_name = ami_name
+        self.user_data = user_data
+        self.verbose = verbose
+        self.job_ledger = job_ledger
+        self.spot_prices = spot_prices or {}
+        self.spot_wait = spot_wait
+        self.spot_backend = spot_backend
+        self.on_launched = on_launched
+        self.tags_launched = []
+        self.instance_ids = []
+        self.requested = {}  # tag -> (when requested, when request returned)
+        self.short = []  # (instance type, launched, asked for)
+
+    def start(self, tags, instance_types):
+        if self.verbose:
+            print "Launching instances... "
+        for instance_type in sorted(set(instance_types)):
+            type_tags = [tag for tag, inst_type in zip(tags, instance_types)
+                         if inst_type == instance_type]
+            self.loop.submit(
+                "ec2", launch_instance_type,
+                (self.job, type_tags, instance_type, self.ami_name,
+                 self.user_data, self.spot_prices.get(instance_type),
+                 self.spot_wait, self.spot_backend, self.verbose),
+                functools.partial(self._launched, instance_type, type_tags))
+
+    def _launched(self, instance_type, type_tags, result, error):
+        if error is not None:
+            print "    ** Launching %s instances failed: %s" % (
+                instance_type, error)
+            self.short.append((instance_type, 0, len(type_tags)))
+            return
+        launched, requested = result
+        self.requested.update(requested)
+        for tag, instance in launched:
+            self.tags_launched.append(tag)
+            self.instance_ids.append(instance.id)
+            if self.job_ledger:
+                self.job_ledger.set_phase(tag, "launched", instance.id)
+            if self.on_launched:
+                self.on_launched(tag, instance)
+        if len(launched) < len(type_tags):
+            self.short.append((instance_type, len(launched), len(type_tags)))
+
+    def check(self):
+        """
+        Exit if not every instance could be launched. Any that were are
+        tagged and in the ledger, so they can be picked up with --resume.
+        """
+        if not self.short:
+            return
+        for instance_type, num_launched, num_tags in self.short:
+            print "Only %d of the %d %s instances could be launched" % (
+                num_launched, num_tags, instance_type)
+        if self.tags_launched:
+            print "The %d instances that were launched are still" % (
+                len(self.tags_launched)),
+            print "running: carry on with --resume, or terminate them"
+        exit(1)
+
+
+def launch_instance_type(job, tags, instance_type, ami_name, user_data,
+                         spot_price=None, spot_wait=300, spot_backend=None,
+                         verbose=True):
+    """
+    Launch an instance of one type for each tag, as spot instances first if
+    there is a spot_price.
+    Returns:
+      launched   List of (tag, instance) for the instances launched, which
+                 may be fewer than the tags if EC2 wouldn't give us them all
+      requested  Dictionary of tag -> (time requested, time the request
+                 returned) for the tags in launched
+    """
+    launched = []
+    requested = {}
+
+    if spot_price is not None:
+        if verbose:
+            print "  Requesting %d %s spot instances at up to $%s ..." % (
+                len(tags), instance_type, spot_price)
+        if spot_backend is None:
+            spot_backend = spot.get_backend()
+        start = time.time()
+        with tracing.span("launch:spot_request", instance_type=instance_type,
+                          count=len(tags)) as attrs:
+            spot_instances, remaining = spot.launch_spot_instances(
+                spot_backend, tags, job, job, instance_type, ami_name,
+                spot_price, spot_wait)
+            attrs["fulfilled"] = len(spot_instances)
+        for tag in tags[:len(spot_instances)]:
+            requested[tag] = (start, time.time())
+        launched += zip(tags, spot_instances)
+        if remaining:
+            print "  %d %s spot requests weren't fulfilled in time," % (
+                len(remaining), instance_type),
+            print "launching them on-demand"
+        tags = remaining
+
+    if tags:
+        if verbose:
+            print "  Launching %d %s instances ..." % (len(tags),
+                                                     instance_type)
+        start = time.time()
+        with tracing.span("launch:run_instances", instance_type=instance_type,
+                          count=len(tags)):
+            instances = cloud_setup.launch_instances(
+                tags=tags,
+                key_name=job,
+                group_name=job,
+                inst_type=instance_type,
+                ami_name=ami_name,
+                user_data=user_data,
+                wait=False,
+            )
+        for tag in tags[:len(instances)]:
+            requested[tag] = (start, time.time())
+        launched += zip(tags, instances)
+
+    return launched, requested
+
+
+def connect_instances(job, tags, verbose=True, num_workers=32,
+                      timeout=1800, job_ledger=None):
     """
     Connect to the instances. Returns, for every tag, an instance handle and
-    a cmdshell handle through which we can execute commands and send and
-    receive files.
+    a shell (see ssh_pool.PooledShell) through which we can execute commands
+    and send and receive files.
+    Up to num_workers connection attempts run at once. A tag whose attempt
+    fails is retried after an exponentially increasing delay, and we give up
+    on tags that still can't be reached after timeout seconds.
     Returns:
       insts        Dictionary of tag -> instance
-      cmds         Dictionary of tag -> cmdshell
+      cmds         Dictionary of tag -> ssh_pool.PooledShell
+      failed       List of tags that could not be connected to
     """
 
     insts = {}
     cmds = {}
-    for tag in tags:
-        cmds[tag] = None
-    all_done = False
-    while not all_done:
-        print "Beginning round of connection attempts..."
-        all_done = True
-        for tag in tags:
-            if cmds[tag] is None:
-                if verbose:
-                    print "  %s" % tag
-                # Test if connected
-                try:
-                    insts[tag], cmds[tag] = cloud_setup.connect_instance(
-                        tag=tag,
-                        key_name=job,
-                        user_name=gurobi_aws.DEFAULT_USER,
-                    )
-                    cmds[tag].run("ls")
-                except:
-                    all_done = False
-                    cmds[tag] = None
 
+    def connected(tag, inst, cmd):
+        insts[tag], cmds[tag] = inst, cmd
+        if job_ledger:
+            job_ledger.advance(tag, "connected", inst.id)
+        if verbose:
+            print "  %s connected" % tag
+
+    def gave_up(tag):
+        if verbose:
+            print "  %s could not be connected to" % tag
+
+    if verbose:
+        print "Connecting to %d instances..." % len(tags)
+    loop = make_orchestrator(num_workers)
+    connector = Connector(loop, job, timeout, connected, gave_up)
+    for tag in tags:
+        connector.start(tag)
+    loop.run()
+    failed = [tag for tag in tags if tag not in cmds]
+
+    if failed:
+        print " Could not connect to %d instances after %d seconds:" % (
+            len(failed), timeout)
+        for tag in failed:
+            print "    %s" % tag
     if verbose:
-        print " All connections established, hit [RETURN]"
+        print " %d/%d connections established, hit [RETURN]" % (
+            len(cmds), len(tags))
         raw_input()
-    return insts, cmds
+    return insts, cmds, failed
+
+
+def make_orchestrator(num_workers=32):
+    """
+    An Orchestrator running up to num_workers SSH sessions and SFTP
+    transfers at once.
+    """
+    return orchestrator.Orchestrator({"ec2": EC2_WORKERS,
+                                      "ssh": num_workers,
+                                      "sftp": num_workers})
+
+
+class Connector(object):
+    """
+    Connects to the instances of tags on an Orchestrator. A tag whose
+    attempt fails is retried after an exponentially increasing delay, until
+    timeout seconds after it was started. Tags that are due at the same time
+    have their instances looked up with a single EC2 request first, so the
+    attempts hit the cache.
+    on_connected(tag, instance, shell) or on_failed(tag) is called for
+    each tag.
+    """
+
+    def __init__(self, loop, job, timeout, on_connected, on_failed):
+        self.loop = loop
+        self.job = job
+        self.timeout = timeout
+        self.on_connected = on_connected
+        self.on_failed = on_failed
+        self.started = {}
+        self.attempts = {}
+        self.delays = {}
+        self.due = []
+
+    def start(self, tag):
+        self.started[tag] = time.time()
+        self.attempts[tag] = 0
+        self.delays[tag] = CONNECT_BACKOFF_START
+        self._make_due(tag)
+
+    def _make_due(self, tag):
+        if not self.due:
+            self.loop.call_soon(self._look_up)
+        self.due.append(tag)
+
+    def _look_up(self):
+        tags, self.due = self.due, []
+        self.loop.submit("ec2", cloud_setup.INSTANCE_INDEX.refresh, (tags,),
+                         lambda result, error: self._attempt(tags, error))
+
+    def _attempt(self, tags, error):
+        if error is not None:
+            print "    ** Looking up instances failed: %s" % error
+        for tag in tags:
+            self.attempts[tag] += 1
+            # Connection attempts wait behind any other SSH work, so that
+            # instances that are ready aren't held up by those that aren't
+            self.loop.submit("ssh", try_connect, (self.job, tag),
+                             functools.partial(self._attempted, tag),
+                             priority=1)
+
+    def _attempted(self, tag, connection, error):
+        now = time.time()
+        if connection:
+            tracing.add_span("connect:ssh_ready", self.started[tag], now, tag,
+                             attempts=self.attempts[tag])
+            self.on_connected(tag, *connection)
+        elif now + self.delays[tag] > self.started[tag] + self.timeout:
+            self.on_failed(tag)
+        else:
+            self.loop.call_later(self.delays[tag], self._make_due, tag)
+            self.delays[tag] = min(2 * self.delays[tag], CONNECT_BACKOFF_MAX)
+
+
+def try_connect(job, tag):
+    """
+    Make one attempt at connecting to a tag's instance. Returns (instance,
+    ssh_pool.PooledShell), or None if it can't be reached (yet). The
+    connection is kept in ssh_pool.POOL, so a tag that is already connected
+    doesn't need a new one.
+    """
+    def connect():
+        return cloud_setup.connect_instance(
+            tag=tag,
+            key_name=job,
+            user_name=gurobi_aws.DEFAULT_USER,
+        )
+
+    with tracing.span("connect:attempt", tag) as attrs:
+        try:
+            cmd = ssh_pool.POOL.connect(tag, connect)
+            # Test if connected
+            cmd.run("ls")
+            attrs["ok"] = True
+            return cmd.instance, cmd
+        except:
+            attrs["ok"] = False
+            attrs["error"] = str(sys.exc_info()[1])
+            return None
 
 
 def setup_instances(tags, cmds, insts, install_file, localpaths, remotepaths,
-                    verbose=True):
+                    verbose=True, num_workers=32, excludes=(),
+                    stage_bucket=None, run_install=True, job_ledger=None,
+                    depot_bucket=None, resumed=()):
     """
     Install dependencies and build so it is ready for the run. This takes
     a while so after copying the files we just fire off a script.
-    multiprocessing didn't work nicely with this...
+    Up to num_workers instances are set up at once, each starting INSTALL as
+    soon as its own files are copied. An instance that fails to set up is
+    reported and left out rather than holding up the others.
+    If stage_bucket is given, the code folders are uploaded to that S3 bucket
+    once and every instance downloads them from there, instead of them being
+    copied from here to each instance.
+    If run_install is False the instances were launched from a cached AMI
+    that is already installed, so INSTALL.py isn't run again.
+    If depot_bucket is given, install steps with a cache option are shared
+    between the instances through that S3 bucket (see depot_cache.py).
+    Tags in resumed were set up by an earlier run, so INSTALL.py may still
+    be running on them (see Installer.start).
+    Returns:
+      failed       List of tags that could not be set up
+      fresh        List of tags that were set up and installed from scratch
     """
 
-    # Locate the .boto file
-    if os.path.exists(".boto"):
-        botoloc = ".boto"
-    elif os.path.exists(os.path.expanduser("~/.boto")):
-        botoloc = os.path.expanduser("~/.boto")
-    else:
-        print "Could not locate .boto file"
-        exit(1)
+    botoloc = find_boto_file()
+    cloudkey = gurobi_aws.get_cloudkey()
+    bundles = prepare_bundles(localpaths, excludes, stage_bucket, verbose)
 
     if verbose:
         print "Copying keys, etc. to all instances, running INSTALL... "
 
-    for tag in tags:
-        print "    Copying files to %s ..." % (tag)
-        f = cmds[tag].open_sftp()
-
-        # The install script
-        f.put(install_file, "INSTALL.sh")
-        # Python script to run INSTALL.sh
-        f.put("INSTALL.py", "INSTALL.py")
-        # For updating tags and results
-        f.put("update_tags.py", "update_tags.py")
-        f.put("save_results.py", "save_results.py")
-        f.put("cloud_setup.py", "cloud_setup.py")
-        f.put(botoloc, ".boto")
-        # Put the specified code folder
-        for localpath, remotepath in zip(localpaths, remotepaths):
-            put_all(f, localpath, remotepath)
+    ready = []
+    failed = []
 
-        f.close()
-
-        # Setting CLOUDKEY by user data doesn't seem to work
-        # Set it by curl instead
-        inst_id = insts[tag].id
-        cloudkey = gurobi_aws.get_cloudkey()
-        cmds[tag].run(
-            "curl --data \"type=CLOUDKEY&adminpassword=%s&data=%s\" "
-            "http://localhost/update_settings" % (inst_id, cloudkey))
+    def report():
+        print "      - Installation complete on %d / %d boxes" % (
+            len(ready), len(tags)),
+        print "(%d failed)" % len(failed)
 
-        # Make script executable
-        cmds[tag].run("chmod +x INSTALL.sh")
+    def installed(tag):
+        ready.append(tag)
+        report()
 
-        # Spawn the install runner (non-blocking)
-        print "    Launching INSTALL.py on %s ..." % (tag)
-        stdin, stdout, stderr = cmds[tag]._ssh_client.exec_command(
-            "python INSTALL.py")
+    def not_installed(tag):
+        failed.append(tag)
+        report()
 
+    loop = make_orchestrator(num_workers)
+    installer = Installer(loop, cmds, insts, install_file, botoloc, cloudkey,
+                          bundles, remotepaths, run_install, installed,
+                          not_installed, verbose=verbose,
+                          job_ledger=job_ledger, depot_bucket=depot_bucket)
+    for tag in tags:
+        installer.start(tag, tag in resumed)
     print "    Waiting for INSTALL.py to complete on all machines"
-    while True:
-        time.sleep(10)
-        done = [cmds[tag].run("ls .")[1].find("READY") >= 0 for tag in tags]
-        print "      - Installation complete on",
-        print sum(done), "/", len(done), "boxes"
-        if sum(done) == len(done):
-            break
-
+    loop.run()
+    failed = [tag for tag in tags if tag in failed]
+    fresh = [tag for tag in tags if tag in installer.fresh and
+             tag not in failed]
+
+    if failed:
+        print " Could not set up or install %d instances:" % len(failed)
+        for tag in failed:
+            print "    %s" % tag
     if verbose:
         print " Hit [RETURN] when ready to proceed."
         raw_input()
+    return failed, fresh
+
+
+def find_boto_file():
+    """
+    Locate the .boto file to copy to the instances.
+    """
+    if os.path.exists(".boto"):
+        return ".boto"
+    elif os.path.exists(os.path.expanduser("~/.boto")):
+        return os.path.expanduser("~/.boto")
+    print "Could not locate .boto file"
+    exit(1)
+
+
+def prepare_bundles(localpaths, excludes=(), stage_bucket=None, verbose=True):
+    """
+    Pack each code folder once, rather than copying it file by file, and
+    stage the archives in stage_bucket if given.
+    Returns a (path, url, manifest) for each folder, as setup_instance takes.
+    """
+    bundles = []
+    for localpath in localpaths:
+        bundle_path, content_hash, manifest = bundle.build_bundle(
+            localpath, excludes)
+        if verbose:
+            print "Packed %d files from %s (%s, %d bytes)" % (
+                len(manifest), localpath, content_hash[:12],
+                os.path.getsize(bundle_path))
+        url = None
+        if stage_bucket:
+            url = cloud_setup.stage_file_in_s3_bucket(
+                stage_bucket, os.path.basename(bundle_path), bundle_path)
+            if verbose:
+                print "Staged %s in S3 bucket %s" % (localpath, stage_bucket)
+        bundles.append((bundle_path, url, manifest))
+    return bundles
+
+
+def setup_instance(tag, cmd, inst, install_file, botoloc, cloudkey,
+                   bundles, remotepaths, run_install=True, depot_bucket=None):
+    """
+    Copy everything a single instance needs and start INSTALL.py on it.
+    bundles are (path, url, manifest) for the packed code folders to unpack
+    at remotepaths. Bundles with a url are downloaded by the instance itself,
+    the others are copied over SFTP. The manifest is left in each remote
+    folder so it can later be synced incrementally. Files listed in an
+    existing manifest (e.g. from a cached AMI) that are no longer part of
+    the code are removed. INSTALL.py is told to share cached install steps
+    through depot_bucket if given.
+    Returns the process ID of INSTALL.py (see start_install), or None if
+    it wasn't run.
+    """
+    print "    Copying files to %s ..." % (tag)
+    f = cmd.open_sftp()
+
+    def put(localpath, remotepath):
+        with tracing.span("setup:upload", tag, file=remotepath,
+                          size=os.path.getsize(localpath)):
+            f.put(localpath, remotepath)
+
+    # The install script
+    put(install_file, "INSTALL.sh")
+    for helper_file in HELPER_FILES:
+        put(helper_file, helper_file)
+    put(botoloc, ".boto")
+    # Put the specified code folders, one archive each
+    for (bundle_path, url, manifest), remotepath in zip(bundles, remotepaths):
+        remote_bundle = os.path.basename(bundle_path)
+        old_manifest = read_remote_manifest(f, remotepath)
+        if url is None:
+            put(bundle_path, remote_bundle)
+        else:
+            with tracing.span("setup:download", tag, file=remote_bundle):
+                status = cmd.run("curl -sSf --retry 5 -o %s '%s'" %
+                                 (remote_bundle, url))[0]
+            if status != 0:
+                raise Exception("could not download %s from S3" %
+                                remote_bundle)
+        with tracing.span("setup:unpack", tag, folder=remotepath):
+            status = cmd.run(bundle.unpack_command(remote_bundle,
+                                                   remotepath))[0]
+        if status != 0:
+            raise Exception("could not unpack code into %s" % remotepath)
+        for relpath in old_manifest:
+            if relpath not in manifest:
+                try:
+                    f.remove(os.path.join(remotepath, relpath))
+                except IOError:
+                    pass
+        write_remote_manifest(f, remotepath, manifest)
+        print "    Unpacked code to %s:%s" % (tag, remotepath)
+
+    f.close()
+
+    # Setting CLOUDKEY by user data doesn't seem to work
+    # Set it by curl instead
+    cmd.run(
+        "curl --data \"type=CLOUDKEY&adminpassword=%s&data=%s\" "
+        "http://localhost/update_settings" % (inst.id, cloudkey))
+
+    if not run_install:
+        print "    %s is already installed" % (tag)
+        return None
+
+    print "    Launching INSTALL.py on %s ..." % (tag)
+    return start_install(cmd, depot_bucket)
+
+
+def bake_image(ami_backend, tag, cmd, inst, install_hash, remotepaths):
+    """
+    Snapshot an instance that has just been installed into a cached AMI (see
+    ami_cache.py). Our AWS credentials in .boto, the code folders at
+    remotepaths and what setting it up left behind (SETUP_STATE_FILES) are
+    taken off its disk first, with .boto shredded rather than just deleted,
+    and put back once the image has been started. Returns the image ID.
+    """
+    paths = " ".join(SETUP_STATE_FILES + remotepaths)
+    # Only stashed once, in case this is run again after a dropped connection
+    status, output, error = cmd.run(
+        "test -e %s || { tar -cPf %s.tmp --ignore-failed-read %s && "
+        "mv %s.tmp %s; }; test -e %s && { shred -u -f .boto 2> /dev/null; "
+        "rm -rf %s && sync; }" % (IMAGE_STASH, IMAGE_STASH, paths,
+                                  IMAGE_STASH, IMAGE_STASH, IMAGE_STASH,
+                                  paths))
+    try:
+        if status != 0:
+            raise Exception("could not clear %s for its image: %s" % (
+                tag, error))
+        # The image is of the disk as it was when it was asked for, so the
+        # instance can have everything back straight after
+        return ami_backend.create_image(inst.id, install_hash)
+    finally:
+        cmd.run("if test -e %s; then tar -xPf %s && rm -f %s; fi" % (
+            IMAGE_STASH, IMAGE_STASH, IMAGE_STASH))
+
+
+def run_once(command):
+    """
+    Wrap a shell command that starts something so that running the wrapped
+    command again, when it is retried after the connection dropped, does
+    nothing if the first try got through. mkdir is atomic, so only one try
+    can make the marker folder.
+    """
+    # A newline rather than ";" ends the command, as it may end with "&"
+    return "mkdir -p %s && mkdir %s/%.6f 2> /dev/null && {\n%s\n}" % (
+        STARTED_FOLDER, STARTED_FOLDER, time.time(), command)
 
 
-def put_all(f, localpath, remotepath):
+def start_install(cmd, depot_bucket=None):
     """
-    Recursively uploads a full directory over an SFTP session.
+    Start INSTALL.py in the background with nohup, so it carries on however
+    long we stay connected. It appends its status lines to
+    INSTALL_STATUS_FILE, which follow_install reads.
+    Returns its process ID.
     """
+    install_command = "python -u INSTALL.py"
+    if depot_bucket:
+        install_command += " --depot_bucket %s" % depot_bucket
+    status, output, error = cmd.run(
+        run_once("chmod +x INSTALL.sh; rm -f %s; "
+                 "nohup %s &> install_output.txt < /dev/null & "
+                 "echo $! > %s" % (INSTALL_STATUS_FILE, install_command,
+                                   INSTALL_PID_FILE)) +
+        "; cat %s" % INSTALL_PID_FILE)
+    try:
+        return int(output.strip())
+    except ValueError:
+        raise Exception("could not start INSTALL.py: %s" % error)
+
+
+def follow_install(cmd, pid, lines_seen=0):
+    """
+    Open a channel that sends INSTALL.py's status lines after the first
+    lines_seen, as they are written, and closes once INSTALL.py has exited.
+    This can be done again whenever the connection is lost.
+    """
+    stdin, stdout, stderr = cmd.exec_command(
+        "tail -n +%d -F --pid=%d %s 2> /dev/null" % (
+            lines_seen + 1, pid, INSTALL_STATUS_FILE), retry=True)
+    return stdout.channel
+
+
+def record_install_change(watcher, tag, verbose=True, job_ledger=None):
+    """
+    Report a change in a tag's install state seen by an InstallWatcher, and
+    record it in the trace and the ledger. Returns the tag's new state.
+    """
+    state, detail = watcher.states[tag]
+    if verbose or state == "failed":
+        print "      - %s: %s %s" % (tag, state, detail)
+    if state == "installing":
+        tracing.event("install:status", tag, detail=detail)
+    elif tag in watcher.started:
+        tracing.add_span("install", watcher.started[tag], time.time(),
+                         tag, state=state,
+                         attempts=watcher.attempts.get(tag, 0))
+    if state == "ready" and verbose and watcher.steps.get(tag):
+        print "        %s's steps took %s" % (tag, ", ".join(
+            "%s %.0fs" % (name, seconds) +
+            (" (%d attempts)" % attempts if attempts > 1 else "") +
+            (" (restored)" if attempts == 0 else "")
+            for name, seconds, attempts in watcher.steps[tag]))
+    if state == "ready" and job_ledger:
+        job_ledger.advance(tag, "ready")
+    return state
+
+
+class Installer(object):
+    """
+    Sets up the instances of tags on an Orchestrator (see setup_instance),
+    and follows INSTALL.py on them with an InstallWatcher.
+    on_ready(tag) or on_failed(tag) is called for each tag, and
+    on_installing(tag) once INSTALL.py has been started on it.
+    """
+
+    def __init__(self, loop, cmds, insts, install_file, botoloc, cloudkey,
+                 bundles, remotepaths, run_install, on_ready, on_failed,
+                 on_installing=None, verbose=True, job_ledger=None,
+                 depot_bucket=None):
+        self.loop = loop
+        self.cmds = cmds
+        self.insts = insts
+        self.install_file = install_file
+        self.botoloc = botoloc
+        self.cloudkey = cloudkey
+        self.bundles = bundles
+        self.remotepaths = remotepaths
+        self.run_install = run_install
+        self.on_ready = on_ready
+        self.on_failed = on_failed
+        self.on_installing = on_installing
+        self.verbose = verbose
+        self.job_ledger = job_ledger
+        self.depot_bucket = depot_bucket
+        self.watcher = InstallWatcher()
+        self.polling = False
+        self.reattaching = 0  # Tags waiting for a new channel to follow them
+        self.fresh = set()  # Tags we set up and started INSTALL.py on
+
+    def start(self, tag, check_ready=False):
+        """
+        Set up a tag. With check_ready, an instance that an earlier run
+        already finished installing is left as it is, and one where
+        INSTALL.py is still running is followed rather than set up again.
+        """
+        self.loop.submit("sftp", self._setup, (tag, check_ready),
+                         functools.partial(self._copied, tag))
+
+    def _setup(self, tag, check_ready):
+        """
+        Returns (INSTALL.py's process ID, channel following it, whether we
+        started it), or None if the instance is already installed.
+        """
+        if check_ready:
+            if is_ready_on_instance(self.cmds[tag]):
+                return None
+            pid = running_install(self.cmds[tag])
+            if pid is not None:
+                # Starting it again would have two installs fighting over
+                # e.g. the apt-get lock
+                print "    INSTALL.py is still running on %s" % tag
+                return pid, follow_install(self.cmds[tag], pid), False
+        with tracing.span("setup:copy", tag):
+            pid = setup_instance(tag, self.cmds[tag], self.insts[tag],
+                                 self.install_file, self.botoloc,
+                                 self.cloudkey, self.bundles,
+                                 self.remotepaths, self.run_install,
+                                 self.depot_bucket)
+        if pid is None:
+            return None
+        return pid, follow_install(self.cmds[tag], pid), True
+
+    def _copied(self, tag, result, error):
+        if error is not None:
+            print "    ** Setting up %s failed: %s" % (tag, error)
+            self.on_failed(tag)
+            return
+        if result is None:
+            self.watcher.add(tag, None)
+        else:
+            self.watcher.add(tag, result[1], result[0])
+            if result[2]:
+                self.fresh.add(tag)
+        if result is None:
+            if self.job_ledger:
+                self.job_ledger.advance(tag, "ready")
+            self.on_ready(tag)
+            return
+        if self.job_ledger:
+            self.job_ledger.advance(tag, "setup")
+        if self.on_installing:
+            self.on_installing(tag)
+        self._start_polling()
+
+    def _start_polling(self):
+        if not self.polling:
+            self.polling = True
+            self.loop.call_later(INSTALL_POLL, self._poll)
+
+    def _poll(self):
+        for tag in self.watcher.poll():
+            self._changed(tag)
+        # Follow INSTALL.py again where the connection was lost
+        for tag, pid, lines_seen in self.watcher.take_detached():
+            self.reattaching += 1
+            self.loop.submit("ssh", follow_install,
+                             (self.cmds[tag], pid, lines_seen),
+                             functools.partial(self._reattached, tag))
+        if self.watcher.channels or self.reattaching:
+            self.loop.call_later(INSTALL_POLL, self._poll)
+        else:
+            self.polling = False
+
+    def _reattached(self, tag, channel, error):
+        self.reattaching -= 1
+        if error is not None:
+            self.watcher.give_up(tag, "lost connection: %s" % error)
+            self._changed(tag)
+            return
+        self.watcher.reattach(tag, channel)
+        self._start_polling()
+
+    def _changed(self, tag):
+        if self.watcher.states[tag][0] == "failed" and tag in self.cmds:
+            # An install that looks like it failed because the connection
+            # was lost is checked on the instance first
+            self.loop.submit("ssh", is_ready_on_instance, (self.cmds[tag],),
+                             functools.partial(self._checked, tag))
+            return
+        self._record(tag)
+
+    def _checked(self, tag, ready, error):
+        if ready:
+            # Lost the channel, but the install did finish
+            self.watcher.states[tag] = ("ready", "")
+        self._record(tag)
+
+    def _record(self, tag):
+        state = record_install_change(self.watcher, tag, self.verbose,
+                                      self.job_ledger)
+        if state == "ready":
+            self.on_ready(tag)
+        elif state == "failed":
+            self.on_failed(tag)
+
+
+def running_install(cmd):
+    """
+    The process ID of INSTALL.py if an earlier run started it on the
+    instance and it is still running, otherwise None.
+    """
+    output = cmd.run(
+        "pid=$(cat %s 2> /dev/null) && ps -p $pid -o args= | "
+        "grep -q INSTALL.py && echo $pid" % INSTALL_PID_FILE)[1]
+    try:
+        return int(output.strip())
+    except ValueError:
+        return None
 
-    cwd = os.getcwd()
 
+def is_ready_on_instance(cmd):
+    try:
+        return cmd.run("ls .")[1].find("READY") >= 0
+    except:
+        return False
+
+
+class InstallWatcher(object):
+    """
+    Follows INSTALL.py on many instances at once by reading its status lines
+    from a channel following its status file (see follow_install), so no
+    commands need to be run on the instances to find out when they are
+    ready. If a channel is lost along with its connection, the tag is
+    detached until it is followed again from the line it got up to.
+    Each tag is in state "installing", "ready" or "failed". When INSTALL.sh
+    is split into steps, how long each step took is recorded too, with 0
+    attempts for steps restored from the depot cache.
+    """
+
+    def __init__(self):
+        self.channels = {}
+        self.buffers = {}
+        self.pids = {}  # Process ID of INSTALL.py on each tag
+        self.lines = {}  # Number of status lines read from each tag
+        self.reattaches = {}  # Times in a row each tag has been reattached
+        self.detached = []  # Tags that need following again
+        self.states = {}
+        self.started = {}  # When INSTALL.py was started on each tag
+        # How many times INSTALL.sh (or when it has steps, a step) has been run
+        self.attempts = {}
+        self.steps = {}  # tag -> list of (step, seconds, attempts)
+        self.lock = threading.Lock()
+
+    def add(self, tag, channel, pid=None):
+        """
+        Start watching a tag, on a channel following INSTALL.py with
+        process ID pid. A channel of None means the instance is already
+        installed.
+        """
+        with self.lock:
+            if channel is None:
+                self.states[tag] = ("ready", "already installed")
+                return
+            self.channels[tag] = channel
+            self.buffers[tag] = ""
+            self.pids[tag] = pid
+            self.lines[tag] = 0
+            self.reattaches[tag] = 0
+            self.states[tag] = ("installing", "")
+            self.started[tag] = time.time()
+
+    def take_detached(self):
+        """
+        The tags whose connection was lost since the last call, as (tag,
+        process ID, number of lines read) to follow them again from.
+        """
+        with self.lock:
+            detached, self.detached = self.detached, []
+            return [(tag, self.pids[tag], self.lines[tag])
+                    for tag in detached]
+
+    def reattach(self, tag, channel):
+        with self.lock:
+            self.channels[tag] = channel
+            # The new channel starts again at the start of the line
+            self.buffers[tag] = ""
+
+    def give_up(self, tag, detail):
+        with self.lock:
+            self.states[tag] = ("failed", detail)
+
+    def poll(self):
+        """
+        Read whatever status has arrived on the channels without blocking.
+        Returns the tags whose state changed.
+        """
+        changed = []
+        with self.lock:
+            for tag, channel in self.channels.items():
+                try:
+                    while channel.recv_ready():
+                        data = channel.recv(4096)
+                        if not data:
+                            break
+                        self.buffers[tag] += data
+                    closed = channel.exit_status_ready()
+                    # Rather than INSTALL.py having exited
+                    dropped = closed and not (
+                        channel.get_transport().is_active())
+                except Exception:
+                    closed = dropped = True
+                lines = self.buffers[tag].split("\n")
+                self.buffers[tag] = lines.pop()
+                self.lines[tag] = self.lines.get(tag, 0) + len(lines)
+                if lines:
+                    self.reattaches[tag] = 0
+                for line in lines:
+                    parts = line.strip().split(" ", 2)
+                    if len(parts) < 2 or parts[0] != INSTALL_STATUS_PREFIX:
+                        continue
+                    if parts[1] == "attempt" and len(parts) > 2:
+                        try:
+                            self.attempts[tag] = int(parts[2])
+                        except ValueError:
+                            pass
+                    elif parts[1] == "step":
+                        self.attempts[tag] = self.attempts.get(tag, 0) + 1
+                    elif parts[1] == "step_done" and len(parts) > 2:
+                        self._record_step(tag, parts[2])
+                    elif parts[1] == "step_restored" and len(parts) > 2:
+                        self._record_step(tag, parts[2] + " 0")
+                    state = {"ready": "ready", "failed": "failed"}.get(
+                        parts[1], "installing")
+                    detail = " ".join(parts[1:])
+                    if state == "ready":
+                        detail = ""
+                    self.states[tag] = (state, detail)
+                    if tag not in changed:
+                        changed.append(tag)
+                if closed or self.states[tag][0] != "installing":
+                    del self.channels[tag]
+                    if self.states[tag][0] != "installing":
+                        continue
+                    if (dropped and self.pids.get(tag) is not None and
+                            self.reattaches[tag] < INSTALL_REATTACH_ATTEMPTS):
+                        # INSTALL.py carries on without us
+                        self.reattaches[tag] += 1
+                        self.detached.append(tag)
+                        continue
+                    self.states[tag] = ("failed", "lost connection"
+                                        if dropped else "INSTALL.py stopped")
+                    if tag not in changed:
+                        changed.append(tag)
+        return changed
+
+    def _record_step(self, tag, detail):
+        """
+        Note a "step_done <step> <seconds> <attempts>" status line.
+        Restored steps are noted with 0 attempts.
+        """
+        try:
+            name, seconds, attempts = detail.split()
+            seconds, attempts = float(seconds), int(attempts)
+        except ValueError:
+            return
+        self.steps.setdefault(tag, []).append((name, seconds, attempts))
+        now = time.time()
+        tracing.add_span("install:step", now - seconds, now, tag, step=name,
+                         attempts=attempts, restored=attempts == 0)
+
+    def summary(self, tags):
+        """
+        Returns (number ready, number failed) among the tags.
+        """
+        states = [self.states[tag][0] for tag in tags]
+        return states.count("ready"), states.count("failed")
+
+
+def read_remote_manifest(f, remotepath):
+    """
+    The manifest of what was last copied into a remote folder, or an empty
+    one if there isn't one (e.g. the folder doesn't exist yet).
+    """
+    try:
+        remote_file = f.open(os.path.join(remotepath, bundle.MANIFEST_FILE))
+        try:
+            return bundle.load_manifest(remote_file.read())
+        finally:
+            remote_file.close()
+    except (IOError, ValueError):
+        return {}
+
+
+def write_remote_manifest(f, remotepath, manifest):
+    remote_file = f.open(os.path.join(remotepath, bundle.MANIFEST_FILE), "w")
+    try:
+        remote_file.write(bundle.dump_manifest(manifest))
+    finally:
+        remote_file.close()
+
+
+def sync_all(f, localpath, remotepath, manifest, delete=False):
+    """
+    Incrementally update a remote folder over an SFTP session so it matches
+    the local manifest, uploading only files that are new or whose contents
+    changed since the last copy. With delete, files we copied before that no
+    longer exist locally are removed; files created on the instance (e.g.
+    results) are never touched.
+    Returns:
+      uploaded     List of relative paths uploaded
+      deleted      List of relative paths deleted
+    """
     localpath = os.path.abspath(localpath)
-    print "    Copying code folder to machine:"
-    print "        " + localpath
-
-    # First make the containing folder on the remote
-    print "    Making remote folder: %s" % remotepath
-    mkdir_p(f, remotepath)
-
-    os.chdir(os.path.split(localpath)[0])
-    parent = os.path.split(localpath)[1]
-    for walker in os.walk(parent):
-        remotename = walker[0][len(parent) + 1:]
-        # Skip git objects folder for speed
-        if remotename[:12] == ".git/objects":
+    remote_manifest = read_remote_manifest(f, remotepath)
+
+    uploaded = []
+    made_dirs = set()
+    for relpath in sorted(manifest):
+        old = remote_manifest.get(relpath)
+        if old is not None and old[2] == manifest[relpath][2]:
             continue
-        print "        Copying " + walker[0]
-        try:
-            f.mkdir(os.path.join(remotepath, remotename))
-        except:
-            pass
-        for file in walker[2]:
-            print "            " + os.path.join(walker[0], file),
-            print "> " + os.path.join(remotepath, remotename, file)
-            f.put(os.path.join(walker[0], file),
-                  os.path.join(remotepath, remotename, file))
+        local_file = os.path.join(localpath, relpath)
+        remote_file = os.path.join(remotepath, relpath)
+        remote_dir = os.path.dirname(remote_file)
+        if remote_dir not in made_dirs:
+            mkdir_p(f, remote_dir)
+            made_dirs.add(remote_dir)
+        f.put(local_file, remote_file)
+        f.chmod(remote_file, os.stat(local_file).st_mode & 0777)
+        uploaded.append(relpath)
+
+    deleted = []
+    if delete:
+        for relpath in sorted(remote_manifest):
+            if relpath in manifest:
+                continue
+            try:
+                f.remove(os.path.join(remotepath, relpath))
+                deleted.append(relpath)
+            except IOError:
+                pass  # Already gone
+
+    if uploaded or deleted or remote_manifest != manifest:
+        write_remote_manifest(f, remotepath, manifest)
+    return uploaded, deleted
+
+
+def sync_instances(tags, cmds, localpaths, remotepaths, verbose=True,
+                   num_workers=32, excludes=(), delete=False):
+    """
+    Push code changes to already set up instances, up to num_workers at a
+    time. Only changed files are copied (see sync_all).
+    Returns:
+      failed       List of tags that could not be synced
+    """
+    manifests = [bundle.build_manifest(localpath, excludes)
+                 for localpath in localpaths]
 
-    os.chdir(cwd)
+    if verbose:
+        print "Syncing code folders to all instances..."
+
+    def sync(tag):
+        try:
+            f = cmds[tag].open_sftp()
+            try:
+                for localpath, remotepath, manifest in zip(
+                        localpaths, remotepaths, manifests):
+                    uploaded, deleted = sync_all(f, localpath, remotepath,
+                                                 manifest, delete)
+                    print "    %s:%s - %d uploaded, %d deleted" % (
+                        tag, remotepath, len(uploaded), len(deleted))
+            finally:
+                f.close()
+            return True
+        except Exception, err:
+            print "    ** Syncing %s failed: %s" % (tag, err)
+            return False
+
+    pool = ThreadPool(max(1, min(num_workers, len(tags))))
+    succeeded = pool.map(sync, tags)
+    pool.close()
+    return [tag for tag, ok in zip(tags, succeeded) if not ok]
 
 
 def mkdir_p(sftp, remote, is_dir=True):
@@ -239,35 +1168,113 @@ def mkdir_p(sftp, remote, is_dir=True):
             sftp.mkdir(dir_)
 
 
+def write_runner(runner_path, job, tag, commands, results_file,
+                 extra_output_files, compress=None, sdb=False):
+    """
+    Write the shell script that runs the commands assigned to a tag and then
+    saves the results.
+    If commands is None the instance is in queue mode, and instead works
+    through the job's shared queue until it is empty.
+    A single command runs in the code folder and self-terminates through
+    save_results.py. Several (packed) commands each get their own copy of
+    the code folder so their results files don't collide, all run at once
+    (packing guarantees they fit within the core count), and the instance
+    terminates once the last one has saved its results.
+    compress (gzip or zstd) compresses the output files before uploading,
+    and sdb also writes the rows of the results file to SimpleDB.
+    """
+    save_args = "%s %s %s" % (job, tag, results_file)
+    if compress:
+        save_args = "--compress %s %s" % (compress, save_args)
+    if sdb:
+        save_args = "--sdb %s" % save_args
+    for extra_output_file in extra_output_files:
+        save_args += " %s" % extra_output_file
+
+    with open(runner_path, "w") as f:
+        f.write("export TAG=%s" % tag)  # Inject tag as environment var
+        f.write("\n")
+        if commands is None:
+            f.write("cd code")
+            f.write("\n")
+            f.write("python ~/queue_runner.py %s" % save_args)
+            return
+
+        if len(commands) == 1:
+            f.write("cd code")
+            f.write("\n")
+            f.write(commands[0])
+            f.write("\n")
+            f.write("python ~/save_results.py %s" % save_args)
+            return
+
+        for i, command in enumerate(commands):
+            f.write("rm -rf code_%d && cp -r code code_%d\n" % (i, i))
+            f.write("(cd code_%d && %s; "
+                    "python ~/save_results.py --no_terminate %s) "
+                    "&> screen_output_%d.txt &\n" %
+                    (i, command, save_args, i))
+        f.write("wait\n")
+        f.write("python ~/self_terminate.py")
+
+
 def dispatch_and_run(job, tags, cmds, commands, results_file,
-                     extra_output_files, verbose=True):
+                     extra_output_files, verbose=True, job_ledger=None,
+                     compress=None, sdb=False, num_workers=32):
     """
-    Spawn the relevant command on each instance
+    Spawn the relevant commands on each instance, up to num_workers at once.
+    `commands` has, for every tag, the list of commands to run on that
+    instance, or is None if the instances should pull their commands from
+    the job's queue.
+    Returns:
+      failed       List of tags the commands could not be started on
     """
     # Write out and copy to instances
     if verbose:
         print "Writing args file and starting run... "
 
-    for tag, command in zip(tags, commands):
+    if commands is None:
+        commands = [None] * len(tags)
+
+    failed = []
+
+    def started(tag, result, error):
+        if error is not None:
+            print "    ** Dispatching to %s failed: %s" % (tag, error)
+            failed.append(tag)
+            return
         if verbose:
             print " %s" % tag
+        if job_ledger:
+            job_ledger.advance(tag, "dispatched")
+
+    loop = make_orchestrator(num_workers)
+    for tag, tag_commands in zip(tags, commands):
+        loop.submit("ssh", start_runner,
+                    (job, tag, cmds[tag], tag_commands, results_file,
+                     extra_output_files, compress, sdb),
+                    functools.partial(started, tag))
+    loop.run()
+
+    if verbose:
+        print "\n  Computation started on all machines"
+    return [tag for tag in tags if tag in failed]
 
+
+def start_runner(job, tag, cmd, tag_commands, results_file,
+                 extra_output_files, compress=None, sdb=False):
+    """
+    Copy a tag's runner script (see write_runner) to its instance and start
+    it in the background.
+    """
+    with tracing.span("dispatch:start_runner", tag):
         # Make a shell script to run the command and then save the results
         runner_path = "runner_%s.sh" % tag
-        with open(runner_path, "w") as f:
-            f.write("export TAG=%s" % tag)  # Inject tag as environment var
-            f.write("\n")
-            f.write("cd code")
-            f.write("\n")
-            f.write(command)
-            f.write("\n")
-            f.write("python ~/save_results.py %s %s %s" %
-                    (job, tag, results_file))
-            for extra_output_file in extra_output_files:
-                f.write(" %s" % extra_output_file)
+        write_runner(runner_path, job, tag, tag_commands, results_file,
+                     extra_output_files, compress, sdb)
 
         # Put runner to server
-        f = cmds[tag].open_sftp()
+        f = cmd.open_sftp()
         f.put(runner_path, "runner.sh")
         f.close()
 
@@ -277,53 +1284,450 @@ def dispatch_and_run(job, tags, cmds, commands, results_file,
         except:
             pass
 
-        cmds[tag].run("chmod +x runner.sh")
+        cmd.exec_command(
+            run_once("chmod +x runner.sh && "
+                     "nohup bash runner.sh &> screen_output.txt &"),
+            retry=True)
 
-        cmds[tag]._ssh_client.exec_command(
-            "nohup bash runner.sh &> screen_output.txt &"
-        )
 
+def fill_queue(job, commands, verbose=True, resume=False):
+    """
+    Put all the commands in the job's shared queue. If the queue still has
+    commands waiting or running (e.g. we are adding instances to a running
+    job), or we are resuming a job, it is left alone so that nothing runs
+    twice. Commands left over from an earlier run of the job that have all
+    been run are cleared out first.
+    """
+    queue = work_queue.get_queue(job)
+    counts = queue.counts()
+    outstanding = counts["pending"] + counts["claimed"]
+    if outstanding or (resume and counts["done"]):
+        if verbose:
+            print ("Queue for %s already has %d commands waiting or "
+                   "running (%d done), not refilling" % (
+                       job, outstanding, counts["done"]))
+        return
+    if counts["done"]:
+        if verbose:
+            print "Clearing %d finished commands from an earlier run" % (
+                counts["done"])
+        queue.clear_done()
     if verbose:
-        print "\n  Computation started on all machines"
+        print "Putting %d commands in the queue for %s" % (len(commands), job)
+    queue.put_all(commands)
+
+
+def run_pipeline(job, tags, commands, phases, install_file, localpaths,
+                 remotepaths, results_file, extra_output_files, create=True,
+                 dispatch=True, verbose=True, num_workers=32,
+                 connect_timeout=1800, excludes=(), stage_bucket=None,
+                 run_install=True, job_ledger=None, compress=None, sdb=False,
+                 on_ready=None, depot_bucket=None):
+    """
+    Move each tag through booting -> connecting -> setting_up -> installing
+    -> dispatching on its own, instead of every tag waiting for all the
+    others at the end of each step, so the first instances start computing
+    while the slowest ones are still booting. Nothing asks for [RETURN].
+    Tags in the "launched" phase are watched until their instance is
+    running, and fail if it stops or goes away, or isn't running within
+    connect_timeout of being launched. The others are connected to straight
+    away. Set up (with
+    create) and dispatch (with dispatch) are skipped for tags whose phase
+    shows they were already done. `commands` has the commands for each tag,
+    or is None in queue mode.
+    Up to num_workers SSH sessions and SFTP transfers run at once, with
+    dispatches ahead of connection attempts. on_ready(tag, instance, shell)
+    is called on an EC2 worker for each tag that was set up and installed
+    from scratch by this run, before it is dispatched to.
+    Returns:
+      dispatched_at  Dictionary of tag -> time it was dispatched
+      failed         List of tags that could not be connected to, set up,
+                     installed or dispatched
+    """
+    if commands is None:
+        commands = [None] * len(tags)
+    tag_commands = dict(zip(tags, commands))
+    insts = {}
+    cmds = {}
+    states = {}
+    entered = {}  # When each tag entered its current state
+    counts = dict((state, 0) for state in PIPELINE_STATES)
+    last_report = [None, False]  # Last line printed, and if one is due
+    dispatched_at = {}
+    failed = []
+
+    loop = make_orchestrator(num_workers)
+
+    def report():
+        line = ", ".join("%d %s" % (counts[state], state)
+                         for state in PIPELINE_STATES if counts[state])
+        if line != last_report[0]:
+            print "    " + line
+        last_report[:] = [line, False]
+
+    def move(tag, state):
+        now = time.time()
+        if tag in states:
+            tracing.add_span("pipeline:%s" % states[tag], entered[tag], now,
+                             tag)
+            counts[states[tag]] -= 1
+        states[tag] = state
+        entered[tag] = now
+        counts[state] += 1
+        if state == "failed":
+            failed.append(tag)
+        # Print the counts at most once a second
+        if not last_report[1]:
+            last_report[1] = True
+            loop.call_later(1.0, report)
+
+    def check_booting():
+        booting = [tag for tag in tags if states[tag] == "booting"]
+        if booting:
+            loop.submit("ec2", look_up_booting, (booting, instance_ids),
+                        functools.partial(checked, booting))
+
+    def checked(booting, stopped, error):
+        if error is not None:
+            print "    ** Looking up instances failed: %s" % error
+        else:
+            for tag in booting:
+                if tag in stopped:
+                    print "  %s's instance is %s" % (tag, stopped[tag])
+                    move(tag, "failed")
+                elif cloud_setup.INSTANCE_INDEX.get(tag) is not None:
+                    move(tag, "connecting")
+                    connector.start(tag)
+        for tag in booting:
+            if (states[tag] == "booting" and
+                    time.time() > launched_at[tag] + connect_timeout):
+                print "  %s's instance wasn't running after %d seconds" % (
+                    tag, connect_timeout)
+                move(tag, "failed")
+        if any(states[tag] == "booting" for tag in booting):
+            loop.call_later(PIPELINE_BOOT_POLL, check_booting)
+
+    def connected(tag, inst, cmd):
+        insts[tag], cmds[tag] = inst, cmd
+        if job_ledger:
+            job_ledger.advance(tag, "connected", inst.id)
+        if verbose:
+            print "  %s connected" % tag
+        if create and not ledger.phase_reached(phases[tag], "ready"):
+            move(tag, "setting_up")
+            installer.start(tag, phases[tag] == "setup")
+        else:
+            installed(tag)
+
+    def gave_up(tag):
+        print "  %s could not be connected to" % tag
+        move(tag, "failed")
+
+    def installing(tag):
+        move(tag, "installing")
+
+    def installed(tag):
+        if on_ready and installer is not None and tag in installer.fresh:
+            # Before dispatching, so that e.g. a snapshot of the instance
+            # doesn't have the run in it
+            loop.submit("ec2", on_ready, (tag, insts[tag], cmds[tag]),
+                        functools.partial(readied, tag))
+        else:
+            start_dispatch(tag)
+
+    def readied(tag, result, error):
+        if error is not None:
+            print "    ** Handling %s being ready failed: %s" % (tag, error)
+        start_dispatch(tag)
+
+    def start_dispatch(tag):
+        if not dispatch:
+            move(tag, "done")
+            return
+        move(tag, "dispatching")
+        loop.submit("ssh", start_runner,
+                    (job, tag, cmds[tag], tag_commands[tag], results_file,
+                     extra_output_files, compress, sdb),
+                    functools.partial(dispatched, tag))
+
+    def dispatched(tag, result, error):
+        if error is not None:
+            print "    ** Dispatching to %s failed: %s" % (tag, error)
+            move(tag, "failed")
+            return
+        if job_ledger:
+            job_ledger.advance(tag, "dispatched")
+        dispatched_at[tag] = time.time()
+        if verbose:
+            print "  %s dispatched" % tag
+        move(tag, "done")
+
+    connector = Connector(loop, job, connect_timeout, connected, gave_up)
+    installer = None
+    if create and not all(ledger.phase_reached(phases[tag], "ready")
+                          for tag in tags):
+        installer = Installer(
+            loop, cmds, insts, install_file, find_boto_file(),
+            gurobi_aws.get_cloudkey(),
+            prepare_bundles(localpaths, excludes, stage_bucket, verbose),
+            remotepaths, run_install, installed,
+            lambda tag: move(tag, "failed"), installing, verbose, job_ledger,
+            depot_bucket)
+
+    # The launched instances, and when they were launched, to give up on
+    # those that don't start running within connect_timeout of it
+    instance_ids = {}
+    launched_at = dict((tag, time.time()) for tag in tags)
+    if job_ledger:
+        for row in job_ledger.get_all():
+            if row["phase"] == "launched" and row["tag"] in launched_at:
+                instance_ids[row["tag"]] = row["instance_id"]
+                launched_at[row["tag"]] = row["updated"]
+
+    if verbose:
+        print "Pipelining %d instances..." % len(tags)
+    for tag in tags:
+        if phases[tag] == "launched":
+            move(tag, "booting")
+        else:
+            move(tag, "connecting")
+            connector.start(tag)
+    check_booting()
+    loop.run()
+
+    for tag in tags:
+        tracing.add_span("pipeline:%s" % states[tag], entered[tag],
+                         entered[tag], tag)
+
+    if failed:
+        print " Could not connect to, set up or dispatch to %d instances:" % (
+            len(failed))
+        for tag in failed:
+            print "    %s" % tag
+    return dispatched_at, failed
+
+
+def look_up_booting(tags, instance_ids):
+    """
+    Look up the instances of tags that are booting, so that those which are
+    running are in cloud_setup.INSTANCE_INDEX. Returns a dictionary of tag
+    -> state for the tags whose instance (from instance_ids, tag -> instance
+    ID) has stopped or gone away instead.
+    """
+    cloud_setup.INSTANCE_INDEX.refresh(tags)
+    known = [tag for tag in tags if instance_ids.get(tag)]
+    states = cloud_setup.get_instance_states(
+        [instance_ids[tag] for tag in known])
+    return dict((tag, states[instance_ids[tag]]) for tag in known
+                if states.get(instance_ids[tag]) in BOOT_FAILED_STATES)
 
 
 def extract_job_details(jobfile):
+    """
+    Read the jobfile. Besides the required instance_type and command columns
+    it may have optional vcpus and memory (GiB) columns giving the resources
+    each command needs, which are used when packing commands onto instances.
+    Returns:
+      commands        List of commands
+      instance_types  List of instance types
+      requirements    List of (vcpus, memory) tuples, defaulting to (1, 0.0)
+    """
     commands = []
     instance_types = []
+    requirements = []
     with open(jobfile, "rU") as f:
         reader = csv.reader(f)
         header_line = reader.next()
-        if header_line[0] != "instance_type" or header_line[1] != "command":
+        if (len(header_line) < 2 or header_line[0] != "instance_type" or
+                header_line[1] != "command"):
             print "Error reading specified jobfile: %s" % jobfile
             print ""
             print "Make sure the jobfile is a csv file with instance types "
             print "in the first column and commands in the second."
             print "The headers should be 'instance_type' and 'command'."
             exit(1)
+        for col in header_line[2:]:
+            if col not in ["vcpus", "memory"]:
+                print "Error reading specified jobfile: %s" % jobfile
+                print ""
+                print "The only optional columns allowed after 'command' are "
+                print "'vcpus' and 'memory'. Found column '%s'." % col
+                exit(1)
 
         for line in reader:
-            if len(line) > 2:
+            if len(line) > len(header_line):
                 print "Error reading specified jobfile: %s" % jobfile
                 print ""
                 print "Make sure the jobfile is a csv file with instance types "
                 print "in the first column and commands in the second."
-                print "A row had more than two columns."
+                print "A row had more columns than the header."
                 exit(1)
             instance_types.append(line[0])
             commands.append(line[1])
-    return commands, instance_types
+            values = dict(zip(header_line[2:], line[2:]))
+            try:
+                vcpus = int(values.get("vcpus") or 1)
+                memory = float(values.get("memory") or 0.0)
+            except ValueError:
+                print "Error reading specified jobfile: %s" % jobfile
+                print ""
+                print "Could not read the vcpus/memory for command:"
+                print "    %s" % line[1]
+                exit(1)
+            requirements.append((vcpus, memory))
+    return commands, instance_types, requirements
+
+
+def pack_commands(commands, instance_types, requirements):
+    """
+    Bin-pack commands onto as few instances as possible. Commands are only
+    packed together with other commands asking for the same instance type,
+    using first-fit decreasing on (vcpus, memory) against the capacities in
+    cloud_setup.INSTANCE_SPECS.
+    Returns:
+      packed_commands  List of lists of commands, one list per instance
+      packed_types     List of instance types, one per instance
+    """
+    packed_commands = []
+    packed_types = []
+
+    for inst_type in sorted(set(instance_types)):
+        if inst_type not in cloud_setup.INSTANCE_SPECS:
+            print "Can't pack commands onto instance type %s as its" % inst_type
+            print "size is unknown. Add it to INSTANCE_SPECS in cloud_setup.py"
+            exit(1)
+        max_vcpus, max_memory = cloud_setup.INSTANCE_SPECS[inst_type]
+
+        indices = [i for i, t in enumerate(instance_types) if t == inst_type]
+        indices.sort(key=lambda i: requirements[i], reverse=True)
+
+        # Each bin is [free vcpus, free memory, list of commands]
+        bins = []
+        for i in indices:
+            vcpus, memory = requirements[i]
+            if vcpus > max_vcpus or memory > max_memory:
+                print "Command needs more resources than a %s has:" % inst_type
+                print "    %s" % commands[i]
+                exit(1)
+            for b in bins:
+                if b[0] >= vcpus and b[1] >= memory:
+                    break
+            else:
+                b = [max_vcpus, max_memory, []]
+                bins.append(b)
+            b[0] -= vcpus
+            b[1] -= memory
+            b[2].append(commands[i])
+
+        for b in bins:
+            packed_commands.append(b[2])
+            packed_types.append(inst_type)
+
+    return packed_commands, packed_types
+
+
+def resume_from_ledger(job_ledger, verbose=True):
+    """
+    Load the tags of a previous run of the job from its ledger, to carry on
+    from where it stopped. Tags that were already dispatched are left alone,
+    and tags whose instance has gone away before being dispatched go back to
+    being planned so they are launched again. Planned tags that do have an
+    instance (the previous run stopped between launching and recording it)
+    are picked up as launched rather than launched twice.
+    Returns:
+      tags, instance_types, commands  As planned by the previous run
+      phases                          Dictionary of tag -> phase
+    """
+    rows = job_ledger.get_all()
+    if not rows:
+        print "Nothing was recorded for job %s, so there is nothing" % (
+            job_ledger.job),
+        print "to resume"
+        exit(1)
+
+    states = cloud_setup.get_instance_states(
+        [row["instance_id"] for row in rows if row["instance_id"]])
+
+    tags = []
+    instance_types = []
+    commands = []
+    phases = {}
+    for row in rows:
+        tag = row["tag"]
+        phase = row["phase"]
+        if ledger.phase_reached(phase, "dispatched"):
+            if verbose:
+                print "  %s was already dispatched" % tag
+            continue
+        if (ledger.phase_reached(phase, "launched") and
+                states.get(row["instance_id"]) not in ["pending", "running"]):
+            print "  %s's instance has gone, it will be launched again" % tag
+            phase = "planned"
+            job_ledger.set_phase(tag, phase)
+        elif verbose:
+            print "  %s resuming from %s" % (tag, phase)
+        tags.append(tag)
+        instance_types.append(row["instance_type"])
+        commands.append(row["commands"])
+        phases[tag] = phase
+
+    found = cloud_setup.find_instances_by_tag(
+        [planned for planned in tags if phases[planned] == "planned"])
+    for tag, inst in sorted(found.items()):
+        print "  %s was launched as %s but not recorded, picking it up" % (
+            tag, inst.id)
+        phases[tag] = "launched"
+        job_ledger.set_phase(tag, "launched", inst.id)
+    return tags, instance_types, commands, phases
 
 
 def run_dispatch(job, commands, instance_types, install_file, codepath,
                  extra_code_paths, results_file, extra_output_files, create,
-                 dispatch, verbose, tag_offset):
+                 dispatch, verbose, tag_offset, requirements=None, pack=False,
+                 num_queue_instances=0, num_workers=32, connect_timeout=1800,
+                 excludes=(), stage_s3=False, sync=False, sync_delete=False,
+                 bake_ami=False, resume=False, spot_prices=None,
+                 spot_wait=300, compress=None, sdb=False, pipeline=False,
+                 depot_cache=False):
     """
     Setup machines, run jobs, monitor, then tear them down again.
+    With pipeline, each instance goes through the steps on its own (see
+    run_pipeline) rather than all of them going through each step together.
+    With depot_cache, install steps with a cache option are shared between
+    the instances through the job's S3 bucket.
     """
 
     if (not len(commands) == len(instance_types)):
         print "Different number of commands and instance types"
         exit(1)
+    if pipeline and sync:
+        print "Syncing can't be used when pipelining"
+        exit(1)
+    if spot_prices and not num_queue_instances:
+        # Only queue mode puts the command of a reclaimed instance back
+        print "Spot instances can only be used in queue mode (--queue), so"
+        print "that commands on reclaimed instances are run elsewhere"
+        exit(1)
+
+    # Work out which commands go on which instance
+    queued_commands = None
+    if num_queue_instances:
+        if pack:
+            print "Queue mode and packing can't be used together"
+            exit(1)
+        if len(set(instance_types)) != 1:
+            print "All commands must use the same instance type in queue mode"
+            exit(1)
+        queued_commands = commands
+        commands = [["<from queue>"]] * num_queue_instances
+        instance_types = instance_types[:1] * num_queue_instances
+    elif pack:
+        if requirements is None:
+            requirements = [(1, 0.0)] * len(commands)
+        commands, instance_types = pack_commands(commands, instance_types,
+                                                 requirements)
+    else:
+        commands = [[command] for command in commands]
 
     # Validate that required files exist
     if (not os.path.exists(".boto") and
@@ -376,9 +1780,25 @@ def run_dispatch(job, commands, instance_types, install_file, codepath,
 
     tags = ["%s%d" % (job, i + tag_offset) for i in range(len(commands))]
 
+    # Record what we're doing as we go, or pick up where a previous run left
+    # off
+    job_ledger = ledger.JobLedger(job)
+    if resume:
+        tags, instance_types, commands, phases = resume_from_ledger(
+            job_ledger, verbose)
+    else:
+        job_ledger.record_plan(tags, instance_types, commands)
+        phases = dict((tag, "planned") for tag in tags)
+
     print "Overview for job %s" % job
-    for tag, inst_type, command in zip(tags, instance_types, commands):
-        print "   %s%s%s" % (tag.ljust(20), inst_type.ljust(20), command)
+    for tag, inst_type, tag_commands in zip(tags, instance_types, commands):
+        for i, command in enumerate(tag_commands):
+            if i == 0:
+                print "   %s%s%s" % (tag.ljust(20), inst_type.ljust(20), command)
+            else:
+                print "   %s%s" % ("".ljust(40), command)
+    if queued_commands is not None:
+        print "   %d commands will be run from the queue" % len(queued_commands)
 
     # Get the Gurobi AMI for the selected AWS region
     resolver = gurobi_aws.AMIResolver()
@@ -394,6 +1814,21 @@ def run_dispatch(job, commands, instance_types, install_file, codepath,
     print "Using Gurobi AMI:"
     print "    %s" % ami_name
 
+    # Launch from an already installed AMI if we have one cached
+    installed = False
+    if bake_ami:
+        ami_backend = ami_cache.get_backend()
+        install_hash = ami_cache.install_hash(install_file, ami_name)
+        cached_ami, cached_state = ami_backend.find_image(install_hash)
+        if cached_state == "available":
+            print "Using cached AMI with everything installed:"
+            print "    %s" % cached_ami
+            ami_name = cached_ami
+            installed = True
+        elif cached_state == "pending":
+            print "Cached AMI %s is still being created, so" % cached_ami,
+            print "installing from scratch this time"
+
     cloudkey = gurobi_aws.get_cloudkey()
     user_data = gurobi_aws.generate_user_data(cloudkey, job)
 
@@ -409,27 +1844,133 @@ def run_dispatch(job, commands, instance_types, install_file, codepath,
     cloud_setup.clean_known_hosts()
     cloud_setup.wait_for_shutdown()
 
+    if pipeline:
+        # Ask for all the instances, but don't wait for them to be running
+        to_launch = [i for i, tag in enumerate(tags)
+                     if phases[tag] == "planned"]
+        if create and to_launch:
+            with tracing.span("phase:launch", count=len(to_launch)):
+                tags_launched = request_instances(
+                    job, [tags[i] for i in to_launch], ami_name, user_data,
+                    [instance_types[i] for i in to_launch], verbose,
+                    job_ledger, spot_prices, spot_wait)[0]
+            for tag in tags_launched:
+                phases[tag] = "launched"
+        if dispatch and queued_commands is not None:
+            fill_queue(job, queued_commands, verbose, resume)
+            commands = None
+
+        # Snapshot the first instance to finish installing
+        baked = []
+        baking = threading.Lock()
+
+        def on_ready(tag, inst, cmd):
+            with baking:
+                if not bake_ami or cached_state is not None or baked:
+                    return
+                baked.append(tag)
+            image_id = bake_image(ami_backend, tag, cmd, inst, install_hash,
+                                  remotepaths)
+            print "Creating cached AMI %s from %s" % (image_id, tag)
+
+        with tracing.span("phase:pipeline", count=len(tags)):
+            dispatched_at, failed = run_pipeline(
+                job, tags, commands, phases, install_file, localpaths,
+                remotepaths, results_file, extra_output_files, create,
+                dispatch, verbose, num_workers, connect_timeout, excludes,
+                job if stage_s3 else None, not installed, job_ledger,
+                compress, sdb, on_ready, job if depot_cache else None)
+        report_failed(failed)
+        return
+
     # Create instances if desired
     if create:
-        create_instances(job, tags, ami_name, user_data, instance_types,
-                         verbose)
-
-    # Connect to all the instances
-    if create or dispatch:
-        insts, cmds = connect_instances(job, tags, verbose)
-
-    # Set them up (if desired)
+        to_launch = [i for i, tag in enumerate(tags)
+                     if phases[tag] == "planned"]
+        if to_launch:
+            with tracing.span("phase:launch", count=len(to_launch)):
+                create_instances(job, [tags[i] for i in to_launch], ami_name,
+                                 user_data,
+                                 [instance_types[i] for i in to_launch],
+                                 verbose, job_ledger, spot_prices, spot_wait)
+
+    # Connect to all the instances, carrying on without any we can't reach
+    failed = []
+    if create or dispatch or sync:
+        with tracing.span("phase:connect", count=len(tags)):
+            insts, cmds, failed = connect_instances(job, tags, verbose,
+                                                    num_workers,
+                                                    connect_timeout,
+                                                    job_ledger)
+        connected = [i for i, tag in enumerate(tags) if tag in cmds]
+        tags = [tags[i] for i in connected]
+        commands = [commands[i] for i in connected]
+
+    # Set them up (if desired), skipping any that already are
     if create:
-        setup_instances(tags, cmds, insts, install_file, localpaths,
-                        remotepaths, verbose)
+        for tag in tags:
+            if phases[tag] == "setup" and is_ready_on_instance(cmds[tag]):
+                phases[tag] = "ready"
+                job_ledger.advance(tag, "ready")
+        to_setup = [tag for tag in tags
+                    if not ledger.phase_reached(phases[tag], "ready")]
+        setup_failed = []
+        fresh = []
+        if to_setup:
+            with tracing.span("phase:setup", count=len(to_setup)):
+                setup_failed, fresh = setup_instances(
+                    to_setup, cmds, insts, install_file, localpaths,
+                    remotepaths, verbose, num_workers, excludes,
+                    job if stage_s3 else None, not installed, job_ledger,
+                    job if depot_cache else None,
+                    [tag for tag in to_setup if phases[tag] == "setup"])
+        failed += setup_failed
+        set_up = [i for i, tag in enumerate(tags) if tag not in setup_failed]
+        tags = [tags[i] for i in set_up]
+        commands = [commands[i] for i in set_up]
+
+    # Snapshot a freshly installed instance so later runs can skip INSTALL
+    if create and bake_ami and cached_state is None and fresh:
+        image_id = bake_image(ami_backend, fresh[0], cmds[fresh[0]],
+                              insts[fresh[0]], install_hash, remotepaths)
+        print "Creating cached AMI %s from %s" % (image_id, fresh[0])
+        print "    It will be used by later runs with the same install script"
+        print "    once it becomes available in a few minutes."
+
+    # Push code changes to instances that are already set up (if desired)
+    if sync and not create:
+        with tracing.span("phase:sync", count=len(tags)):
+            sync_failed = sync_instances(tags, cmds, localpaths, remotepaths,
+                                         verbose, num_workers, excludes,
+                                         sync_delete)
+        failed += sync_failed
+        synced = [i for i, tag in enumerate(tags) if tag not in sync_failed]
+        tags = [tags[i] for i in synced]
+        commands = [commands[i] for i in synced]
 
     # Send out jobs and start machines working (if desired)
     if dispatch:
-        dispatch_and_run(job, tags, cmds, commands, results_file,
-                         extra_output_files, verbose)
+        if queued_commands is not None:
+            fill_queue(job, queued_commands, verbose, resume)
+            commands = None
+        with tracing.span("phase:dispatch", count=len(tags)):
+            failed += dispatch_and_run(job, tags, cmds, commands,
+                                       results_file, extra_output_files,
+                                       verbose, job_ledger, compress, sdb,
+                                       num_workers)
+
+    report_failed(failed)
 
+
+def report_failed(failed):
     print ""
-    print "All dispatcher tasks successfully completed."
+    if failed:
+        print "Dispatcher tasks completed, except on these instances which",
+        print "could not be connected to, set up, synced or dispatched to:"
+        for tag in failed:
+            print "    %s" % tag
+    else:
+        print "All dispatcher tasks successfully completed."
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -470,6 +2011,84 @@ if __name__ == "__main__":
                              "this to a number that is greater than the tag "
                              "number of all currently running machines. "
                              "Defaults to 0.")
+    parser.add_argument("-p", "--pack", action="store_true",
+                        help="Pack several commands onto each instance, "
+                             "using the optional `vcpus` and `memory` "
+                             "columns of the jobfile, and run them "
+                             "concurrently.")
+    parser.add_argument("-q", "--queue", type=int, default=0,
+                        metavar="NUM_INSTANCES",
+                        help="Put all the commands in a shared queue and "
+                             "launch this many instances, each of which runs "
+                             "commands from the queue until it is empty.")
+    parser.add_argument("-w", "--workers", type=int, default=32,
+                        help="Maximum number of instances to work on at once "
+                             "when connecting to and setting up instances. "
+                             "Defaults to 32.")
+    parser.add_argument("--connect_timeout", type=int, default=1800,
+                        help="Seconds to keep trying to connect to instances "
+                             "before giving up on them. Defaults to 1800.")
+    parser.add_argument("-x", "--exclude", action="append", type=str,
+                        help="A .gitignore-style pattern for files to leave "
+                             "out when copying code folders to the machines. "
+                             "Patterns can also be listed in a .awsignore "
+                             "file in each code folder.")
+    parser.add_argument("--stage_s3", action="store_true",
+                        help="Upload code folders to the job's S3 bucket once "
+                             "and have the machines download them from "
+                             "there, rather than copying them to each "
+                             "machine from this computer.")
+    parser.add_argument("-s", "--sync", action="store_true",
+                        help="Push changes to the code folders to machines "
+                             "that are already set up, copying only the "
+                             "files that changed. Ignored with --create.")
+    parser.add_argument("--sync_delete", action="store_true",
+                        help="When syncing, also delete files from the "
+                             "machines that have been deleted locally.")
+    parser.add_argument("--bake_ami", action="store_true",
+                        help="Cache a fully installed machine as a private "
+                             "AMI, and launch from it (skipping the install "
+                             "script) on later runs with the same install "
+                             "script.")
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help="Carry on with a previous run of this job that "
+                             "stopped part way through, using what it "
+                             "recorded about each machine.")
+    parser.add_argument("--spot_price", action="append", type=str,
+                        help="Launch instances of a type as spot instances, "
+                             "paying at most the given price per hour, as "
+                             "`--spot_price t2.small=0.01`. Can be given for "
+                             "several instance types. Needs --queue.")
+    parser.add_argument("--spot_wait", type=int, default=300,
+                        help="Seconds to wait for spot requests to be "
+                             "fulfilled before launching on-demand instances "
+                             "instead. Defaults to 300.")
+    parser.add_argument("--compress", type=str, default=None,
+                        choices=["gzip", "zstd"],
+                        help="Compress the results and extra output files "
+                             "before uploading them to S3. zstd needs the "
+                             "zstandard package on the machines.")
+    parser.add_argument("--sdb", action="store_true",
+                        help="Also write each row of the results files to "
+                             "SimpleDB as soon as it is saved, so results "
+                             "can be looked at with get_results.py while "
+                             "the job is running.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Take each machine through connecting, setting "
+                             "up and dispatching as soon as it is ready, "
+                             "without waiting for the others or asking to "
+                             "continue between steps.")
+    parser.add_argument("--trace_file", type=str, default=None,
+                        help="Write timings of each step for each machine "
+                             "to this file, as JSON lines.")
+    parser.add_argument("--chrome_trace", type=str, default=None,
+                        help="Write timings of each step for each machine "
+                             "to this file in the Chrome trace format.")
+    parser.add_argument("--depot_cache", action="store_true",
+                        help="Share what install steps marked with a cache "
+                             "option (e.g. the Julia packages) make between "
+                             "the machines through the job's S3 bucket, so "
+                             "only the first machine to get there runs them.")
     args = parser.parse_args()
 
     jobname = args.jobname
@@ -485,9 +2104,52 @@ if __name__ == "__main__":
     extra_output_files = (args.extra_output_file if args.extra_output_file
                           else [])
     tag_offset = args.tag_offset
+    pack = args.pack
+    num_queue_instances = args.queue
+    num_workers = args.workers
+    connect_timeout = args.connect_timeout
+    excludes = args.exclude if args.exclude else []
+    stage_s3 = args.stage_s3
+    sync = args.sync
+    sync_delete = args.sync_delete
+    bake_ami = args.bake_ami
+    resume = args.resume
+    spot_wait = args.spot_wait
+    compress = args.compress
+    sdb = args.sdb
+    trace_file = args.trace_file
+    chrome_trace = args.chrome_trace
+    pipeline = args.pipeline
+    depot_cache = args.depot_cache
+    spot_prices = {}
+    for spot_price in (args.spot_price if args.spot_price else []):
+        split_price = spot_price.split("=")
+        try:
+            spot_prices[split_price[0]] = float(split_price[1])
+        except (IndexError, ValueError):
+            print "The following spot price was malformed. It needs to be in",
+            print "the form instance_type=price"
+            print "    %s" % spot_price
+            exit(1)
 
-    commands, instance_types = extract_job_details(jobfile)
+    commands, instance_types, requirements = extract_job_details(jobfile)
 
-    run_dispatch(jobname, commands, instance_types, install_file,
-                 codepath, extra_code_paths, results_file, extra_output_files,
-                 create, dispatch, verbose, tag_offset)
+    if trace_file or chrome_trace:
+        tracing.TRACER.enable()
+    try:
+        run_dispatch(jobname, commands, instance_types, install_file,
+                     codepath, extra_code_paths, results_file,
+                     extra_output_files, create, dispatch, verbose,
+                     tag_offset, requirements, pack, num_queue_instances,
+                     num_workers, connect_timeout, excludes, stage_s3, sync,
+                     sync_delete, bake_ami, resume, spot_prices, spot_wait,
+                     compress, sdb, pipeline, depot_cache)
+    finally:
+        ssh_pool.POOL.close_all()
+        # Write out whatever was traced, even if we stopped part way through
+        if trace_file:
+            tracing.TRACER.write_json_lines(trace_file)
+            print "Wrote trace to %s" % trace_file
+        if chrome_trace:
+            tracing.TRACER.write_chrome_trace(chrome_trace)
+            print "Wrote Chrome trace to %s" % chrome_trace
@@ -1,36 +1,214 @@
 # python get_results.py
 import csv
+import itertools
+import os
+import shutil
 import sys
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+import boto.s3.key
+
 import cloud_setup
+import results_db
+
+# Columns added to every merged row saying where it came from
+AWS_COLUMNS = ["AWS_job", "AWS_tag", "AWS_timestamp"]
+MERGE_BATCH_SIZE = 64  # Results files fetched from S3 ahead of merging
 
 
 def write_results(results, results_file):
-    header_line = None
+    """
+    Write rows (dictionaries) to a CSV file. Rows don't all have to have the
+    same columns, so as in merge_results they are spooled to a temporary
+    file while the full set of columns is collected, rather than all being
+    held in memory.
+    """
+    columns = []
+    seen = set()
+    schemas = {}  # tuple of columns -> index into schema_list
+    schema_list = []
+    spool = tempfile.TemporaryFile()
+    spool_writer = csv.writer(spool)
+    for result in results:
+        header_line = tuple(sorted(result.keys()))
+        if header_line not in schemas:
+            schemas[header_line] = len(schema_list)
+            schema_list.append(header_line)
+            for col in header_line:
+                if col not in seen:
+                    seen.add(col)
+                    columns.append(col)
+        spool_writer.writerow([schemas[header_line]] +
+                              [result[col] for col in header_line])
 
+    positions = column_positions(schema_list, columns)
+    spool.seek(0)
     with open(results_file, "w") as f:
         writer = csv.writer(f)
+        writer.writerow(columns)
+        for line in csv.reader(spool):
+            writer.writerow(arrange(line[1:], positions[int(line[0])]))
+    spool.close()
 
-        for result in results:
-            if not header_line:
-                header_line = result.keys()
-                writer.writerow(header_line)
 
-            output_line = []
-            for col in header_line:
-                output_line.append(result[col])
-            writer.writerow(output_line)
+def column_positions(schema_list, columns):
+    """
+    Where each of columns is in each header in schema_list (None if it
+    isn't).
+    """
+    positions = []
+    for header_line in schema_list:
+        index = dict((col, i) for i, col in enumerate(header_line))
+        positions.append([index.get(col) for col in columns])
+    return positions
+
+
+def arrange(values, positions):
+    """
+    The values of a row, rearranged into the output columns (see
+    column_positions), with blanks for the columns it doesn't have.
+    """
+    return ["" if i is None or i >= len(values) else values[i]
+            for i in positions]
+
+
+def parse_result_key(keyname, results_file, job):
+    """
+    Split the name of a results file saved to S3 by save_results
+    (<results_file>-<job>-<tag>-<time>, plus a suffix if it was compressed)
+    into (tag, time, compression method or None). Returns None for keys that
+    aren't results files.
+    """
+    keyname, compress = cloud_setup.split_compression_suffix(keyname)
+    prefix = "%s-%s-" % (results_file, job)
+    if not keyname.startswith(prefix):
+        return None
+    tag, sep, timestamp = keyname[len(prefix):].rpartition("-")
+    if not sep or not tag:
+        return None
+    try:
+        float(timestamp)
+    except ValueError:
+        return None
+    return tag, timestamp, compress
+
+
+def merge_results(job, results_file, output_file, num_workers=16,
+                  batch_size=MERGE_BATCH_SIZE):
+    """
+    Combine every copy of results_file the instances saved to S3 into one
+    CSV. The header is the union of the headers of all the files, and each
+    row gets the job, tag and time it was saved with. Compressed files are
+    decompressed as they are fetched. Each file is read
+    once: rows are spooled to a temporary file while the full set of columns
+    is collected, so memory use doesn't grow with the number of files.
+    Returns (number of files, number of rows).
+    """
+    s3, bucket = cloud_setup.setup_s3_bucket(job)
+    keys = ((key, parse_result_key(key.key, results_file, job))
+            for key in bucket.list(prefix="%s-%s-" % (results_file, job)))
+    keys = ((key, parsed) for key, parsed in keys if parsed is not None)
+
+    columns = []
+    seen = set(AWS_COLUMNS)
+    schemas = {}  # header tuple -> index into schema_list
+    schema_list = []
+    num_files = 0
+    num_rows = 0
+
+    # boto connections can't be shared between threads
+    local = threading.local()
+    fetch_folder = tempfile.mkdtemp(prefix="aws-runner-merge-")
+
+    def fetch(item):
+        i, (key, (tag, timestamp, compress)) = item
+        if not hasattr(local, "bucket"):
+            local.s3, local.bucket = cloud_setup.setup_s3_bucket(job)
+        filename = os.path.join(fetch_folder, "%d" % i)
+        local_key = boto.s3.key.Key(local.bucket, key.key)
+        local_key.size = key.size
+        cloud_setup.download_s3_key(local_key, filename)
+        if compress is not None:
+            cloud_setup.decompress_file(filename, compress, filename + ".csv")
+            os.rename(filename + ".csv", filename)
+        return filename, tag, timestamp
+
+    spool = tempfile.TemporaryFile()
+    pool = ThreadPool(num_workers)
+    try:
+        spool_writer = csv.writer(spool)
+        while True:
+            batch = list(itertools.islice(keys, batch_size))
+            if not batch:
+                break
+            for filename, tag, timestamp in pool.map(fetch,
+                                                     enumerate(batch)):
+                num_files += 1
+                with open(filename, "rU") as f:
+                    reader = csv.reader(f)
+                    header_line = next(reader, None)
+                    if header_line is None:
+                        continue  # Empty file
+                    header_line = tuple(header_line)
+                    if header_line not in schemas:
+                        schemas[header_line] = len(schema_list)
+                        schema_list.append(header_line)
+                        for col in header_line:
+                            if col not in seen:
+                                seen.add(col)
+                                columns.append(col)
+                    schema = schemas[header_line]
+                    for line in reader:
+                        if not any(line):
+                            continue  # Blank line
+                        spool_writer.writerow([schema, tag, timestamp] + line)
+                        num_rows += 1
+                os.remove(filename)
+            print "  Read %d files (%d rows)" % (num_files, num_rows)
+    finally:
+        pool.close()
+        shutil.rmtree(fetch_folder, ignore_errors=True)
+
+    # Where each column of the output comes from in each header seen
+    positions = column_positions(schema_list, columns)
+
+    spool.seek(0)
+    with open(output_file, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns + AWS_COLUMNS)
+        for line in csv.reader(spool):
+            schema, tag, timestamp = int(line[0]), line[1], line[2]
+            writer.writerow(arrange(line[3:], positions[schema]) +
+                            [job, tag, timestamp])
+    spool.close()
+    return num_files, num_rows
 
 if __name__ == "__main__":
     # Validate command-line arguments
-    if len(sys.argv) == 3:
-        job = sys.argv[1]
-        sdb, dom = cloud_setup.setup_sdb_domain(job)
-        rs = dom.select('select * from `%s`' % job)
-        write_results(rs, sys.argv[2])
-    elif len(sys.argv) == 2:
+    args = sys.argv[1:]
+    local_results = None
+    if len(args) > 1 and args[0] == "--local_results":
+        local_results = args[1]
+        args = args[2:]
+    if len(args) == 4 and args[0] == "--merge":
+        job = args[1]
+        num_files, num_rows = merge_results(job, args[2], args[3])
+        print "Merged %d rows from %d files into %s" % (num_rows, num_files,
+                                                        args[3])
+    elif len(args) >= 2 and all("=" in arg for arg in args[2:]):
+        job = args[0]
+        where = dict(arg.split("=", 1) for arg in args[2:])
+        results = results_db.get_backend(job, local_results)
+        write_results(results.select(where), args[1])
+    elif len(args) == 1:
         print "No outfile specified: dumping to stdout"
-        cloud_setup.dump_sdb_domain(sys.argv[1])
+        cloud_setup.dump_sdb_domain(args[0])
         exit(0)
     else:
-        print "Usage: python get_results.py jobname [output_file]"
+        print "Usage: python get_results.py [--local_results file] jobname",
+        print "[output_file [attribute=value...]]"
+        print "       python get_results.py --merge jobname results_file",
+        print "output_file"
         exit(1)
@@ -1,13 +1,48 @@
 # python get_s3_files.py
-import sys
+import argparse
+
 import cloud_setup
+import results_store
 
 if __name__ == "__main__":
-    # Validate command-line arguments
-    if len(sys.argv) == 3:
-        job = sys.argv[1]
-        output_folder = sys.argv[2]
-        cloud_setup.download_s3_bucket(job, output_folder)
-    else:
-        print "Usage: python get_s3_files.py jobname output_folder"
+    parser = argparse.ArgumentParser(
+        description="Download the files saved to S3 by a job. Files that "
+                    "were already downloaded and haven't changed are "
+                    "skipped, so this can be re-run to fetch new results."
+    )
+    parser.add_argument("jobname", type=str,
+                        help="The name of the job to download files for.")
+    parser.add_argument("output_folder", type=str,
+                        help="Folder to put the files in.")
+    parser.add_argument("--prefix", type=str, default="",
+                        help="Only download files whose S3 keys start with "
+                             "this, e.g. the results file name.")
+    parser.add_argument("--tag", type=str, default=None,
+                        help="Only download files saved by the machine with "
+                             "this tag, e.g. `myjob3`.")
+    parser.add_argument("-w", "--workers", type=int, default=16,
+                        help="Number of files to download at once. Defaults "
+                             "to 16.")
+    parser.add_argument("--store", type=str, default=None,
+                        help="Also add the downloaded results files to the "
+                             "local results store in this folder (see "
+                             "results_store.py). Needs --results_file.")
+    parser.add_argument("--results_file", type=str, default=None,
+                        help="The results file name given to "
+                             "dispatcher.py, for --store.")
+    args = parser.parse_args()
+    if args.store and not args.results_file:
+        print "--store needs --results_file"
         exit(1)
+
+    num_downloaded, num_skipped = cloud_setup.download_s3_bucket(
+        args.jobname, args.output_folder, args.prefix, args.tag, args.workers)
+    print "Downloaded %d files, %d were already up to date" % (num_downloaded,
+                                                               num_skipped)
+
+    if args.store:
+        store = results_store.ResultsStore(args.store)
+        num_files, num_rows = store.ingest_folder(
+            args.jobname, args.output_folder, args.results_file)
+        print "Added %d rows from %d files to the results store" % (num_rows,
+                                                                    num_files)
@@ -0,0 +1,115 @@
+# Local record of every tag in a job and how far the dispatcher has got with
+# it, so a dispatcher run that dies part way through can be resumed without
+# launching duplicate instances or redoing work.
+import json
+import os
+import sqlite3
+import threading
+import time
+
+LEDGER_FOLDER = os.path.expanduser("~/.aws-runner/ledgers")
+
+# The phases a tag goes through, in order
+PHASES = ["planned", "launched", "connected", "setup", "ready", "dispatched"]
+
+
+def phase_reached(phase, target):
+    """
+    Whether a tag in the given phase has got at least as far as target.
+    """
+    return PHASES.index(phase) >= PHASES.index(target)
+
+
+class JobLedger(object):
+    """
+    SQLite-backed record of the tags in a job: their instance ID, instance
+    type, commands, phase and when they were created and last updated.
+    Safe to update from several threads.
+    """
+
+    def __init__(self, job, path=None):
+        if path is None:
+            if not os.path.exists(LEDGER_FOLDER):
+                os.makedirs(LEDGER_FOLDER)
+            path = os.path.join(LEDGER_FOLDER, job + ".sqlite")
+        self.job = job
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tags ("
+            "    tag TEXT PRIMARY KEY,"
+            "    instance_id TEXT,"
+            "    instance_type TEXT,"
+            "    commands TEXT,"
+            "    phase TEXT,"
+            "    created REAL,"
+            "    updated REAL)")
+        self.db.commit()
+
+    def record_plan(self, tags, instance_types, commands):
+        """
+        Record a fresh plan for these tags, replacing anything recorded for
+        them before.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO tags VALUES (?, NULL, ?, ?, ?, ?, ?)",
+                [(tag, inst_type, json.dumps(tag_commands), "planned", now,
+                  now)
+                 for tag, inst_type, tag_commands in zip(tags, instance_types,
+                                                         commands)])
+            self.db.commit()
+
+    def set_phase(self, tag, phase, instance_id=None):
+        with self.lock:
+            if instance_id is None:
+                self.db.execute(
+                    "UPDATE tags SET phase = ?, updated = ? WHERE tag = ?",
+                    (phase, time.time(), tag))
+            else:
+                self.db.execute(
+                    "UPDATE tags SET phase = ?, instance_id = ?, updated = ? "
+                    "WHERE tag = ?", (phase, instance_id, time.time(), tag))
+            self.db.commit()
+
+    def advance(self, tag, phase, instance_id=None):
+        """
+        Move a tag on to the given phase, unless it has already got further.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT phase FROM tags WHERE tag = ?",
+                                  (tag,)).fetchone()
+            if row is None:
+                return
+            if instance_id is not None:
+                self.db.execute(
+                    "UPDATE tags SET instance_id = ? WHERE tag = ?",
+                    (instance_id, tag))
+            if not phase_reached(row[0], phase):
+                self.db.execute(
+                    "UPDATE tags SET phase = ?, updated = ? WHERE tag = ?",
+                    (phase, time.time(), tag))
+            self.db.commit()
+
+    def get_all(self):
+        """
+        Every tag in the ledger, in the order they were planned, as dicts.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT tag, instance_id, instance_type, commands, phase, "
+                "created, updated FROM tags ORDER BY rowid").fetchall()
+        return [{"tag": str(row[0]),
+                 "instance_id": str(row[1]) if row[1] else None,
+                 "instance_type": str(row[2]), "commands": json.loads(row[3]),
+                 "phase": row[4], "created": row[5], "updated": row[6]}
+                for row in rows]
+
+    def phases(self):
+        return dict((row["tag"], row["phase"]) for row in self.get_all())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,134 @@
+# Event loop for the dispatcher. All the bookkeeping for a run (which tag is
+# doing what, retries, timeouts) happens on one thread, which hands the
+# blocking calls (EC2 requests, SSH sessions, SFTP transfers) to a small pool
+# of threads for each kind of call and gets their results back through a
+# queue. The number of threads depends only on the limit for each kind of
+# call, not on the number of instances, so one dispatcher can look after
+# thousands of instances.
+import heapq
+import itertools
+import Queue
+import sys
+import threading
+import time
+
+# Default number of calls of each kind allowed at once
+DEFAULT_LIMITS = {
+    "ec2": 8,  # EC2 API requests
+    "ssh": 32,  # Connecting and running commands over SSH
+    "sftp": 32,  # Copying files to instances
+}
+
+
+class Orchestrator(object):
+    """
+    Runs functions on bounded per-resource worker threads, and their
+    callbacks and any timers on the thread that calls run(), one at a time,
+    so the callbacks don't need any locking. Calls waiting for a worker are
+    started in order of priority (lowest first), then in the order they
+    were submitted.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.queues = {}  # resource -> queue of calls waiting for a worker
+        self.workers = []
+        self.done = Queue.Queue()  # Finished calls, for the loop to handle
+        self.timers = []  # Heap of (time due, sequence number, function)
+        self.sequence = itertools.count()
+        self.pending = 0  # Calls submitted whose callback hasn't run yet
+        self.stopped = False
+
+    def submit(self, resource, function, args=(), callback=None,
+               priority=0):
+        """
+        Call function(*args) on one of resource's workers. When it returns,
+        callback(result, error) is called on the loop's thread, with error
+        the exception it raised (and result None) if it failed.
+        """
+        if resource not in self.queues:
+            self.queues[resource] = Queue.PriorityQueue()
+            for i in range(self.limits[resource]):
+                worker = threading.Thread(target=self._work,
+                                          args=(self.queues[resource],),
+                                          name="%s-%d" % (resource, i))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        self.pending += 1
+        self.queues[resource].put((priority, next(self.sequence), function,
+                                   args, callback))
+
+    def _work(self, queue):
+        while True:
+            priority, sequence, function, args, callback = queue.get()
+            if function is None:
+                return
+            try:
+                result, error = function(*args), None
+            except:
+                result, error = None, sys.exc_info()[1]
+            self.done.put((callback, result, error))
+
+    def call_later(self, delay, function, *args):
+        """
+        Call function(*args) on the loop's thread after delay seconds.
+        """
+        heapq.heappush(self.timers, (time.time() + delay,
+                                     next(self.sequence), function, args))
+
+    def call_soon(self, function, *args):
+        self.call_later(0, function, *args)
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        """
+        Run callbacks and timers as they come due, until stop() is called or
+        there are no calls or timers left.
+        """
+        try:
+            while not self.stopped and (self.pending or self.timers):
+                now = time.time()
+                while (self.timers and self.timers[0][0] <= now and
+                       not self.stopped):
+                    function, args = heapq.heappop(self.timers)[2:]
+                    function(*args)
+                if self.stopped or not (self.pending or self.timers):
+                    break
+                # Wait for a call to finish or the next timer to be due,
+                # waking up now and again so Ctrl-C still works
+                wait = 1.0
+                if self.timers:
+                    wait = max(0.0, min(wait,
+                                        self.timers[0][0] - time.time()))
+                try:
+                    callback, result, error = self.done.get(timeout=wait)
+                except Queue.Empty:
+                    continue
+                self.pending -= 1
+                if isinstance(error, (SystemExit, KeyboardInterrupt)):
+                    raise error
+                if callback:
+                    callback(result, error)
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop the workers once the calls they are running finish. Calls still
+        waiting for a worker are dropped.
+        """
+        for resource, queue in self.queues.items():
+            for i in range(self.limits[resource]):
+                queue.put((-1, next(self.sequence), None, None, None))
+        workers = self.workers
+        self.queues = {}
+        self.workers = []
+        if not self.pending:
+            # They are all idle, so wait for them to stop, in case we are
+            # about to exit while they are still being woken up
+            for worker in workers:
+                worker.join()
@@ -0,0 +1,144 @@
+# python ~/queue_runner.py
+# Runs on an instance in queue mode: claims commands from the job's shared
+# queue, runs them and saves their results until the queue is empty, then
+# self-terminates. Should be run from the code folder.
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import cloud_setup
+import results_db
+import save_results
+import spot
+import work_queue
+
+# Seconds between checks on commands other instances have claimed, once
+# there is nothing left to claim
+CLAIMED_POLL = 60
+
+
+def run_queue(queue, job, tag, results_file, extra_output_files, save=True,
+              interruption=None, compress=None, results=None):
+    """
+    Work through the queue until it is empty. Returns the number of commands
+    run by this instance.
+    If interruption says this (spot) instance is about to be reclaimed, the
+    running command is stopped and put back in the queue for another
+    instance, and we stop taking commands.
+    If results (a results_db backend) is given, the rows of each results
+    file are written to it as each command finishes.
+    Our claim on the running command is renewed as it runs. Once there is
+    nothing left to claim we wait while other instances still have commands
+    claimed, in case one of them stops before finishing its command and the
+    claim runs out (see work_queue.CLAIM_LEASE).
+    """
+    num_run = 0
+    while True:
+        item = queue.claim(tag)
+        if item is None:
+            if not queue.counts()["claimed"]:
+                return num_run
+            time.sleep(CLAIMED_POLL)
+            continue
+        item_id, command = item
+        print "Running %s: %s" % (item_id, command)
+
+        # Make sure we never upload the results of a previous command
+        for output_file in [results_file] + extra_output_files:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+
+        with open(os.path.expanduser("~/screen_output_%s.txt" % item_id),
+                  "w") as f:
+            # Run in its own process group so it can be stopped along with
+            # anything it started
+            p = subprocess.Popen(command, shell=True, stdout=f,
+                                 stderr=subprocess.STDOUT,
+                                 preexec_fn=os.setsid)
+            renewed = time.time()
+            while p.poll() is None:
+                if time.time() - renewed >= work_queue.CLAIM_RENEW_INTERVAL:
+                    renewed = time.time()
+                    if not queue.renew(item_id, tag):
+                        print "Our claim on %s ran out, another" % item_id,
+                        print "instance may run it too"
+                if interruption is not None and interruption.pending():
+                    print "Interruption notice, putting %s back" % item_id
+                    os.killpg(p.pid, signal.SIGTERM)
+                    p.wait()
+                    queue.release(item_id)
+                    return num_run
+                time.sleep(1)
+
+        if save:
+            save_results.save_results(job, tag, results_file,
+                                      extra_output_files, terminate=False,
+                                      compress=compress, results=results)
+        elif results is not None:
+            save_results.record_results(results, job, tag, results_file,
+                                        time.time())
+        queue.complete(item_id)
+        num_run += 1
+
+
+if __name__ == "__main__":
+    # Validate command-line arguments
+    args = sys.argv[1:]
+    local_path = None
+    compress = None
+    use_sdb = False
+    local_results = None
+    interrupt_after = None
+    while args and args[0].startswith("--"):
+        if args[0] == "--sdb":
+            use_sdb = True
+            args = args[1:]
+        elif len(args) > 1 and args[0] == "--local_queue":
+            local_path = args[1]
+            args = args[2:]
+        elif len(args) > 1 and args[0] == "--local_results":
+            local_results = args[1]
+            args = args[2:]
+        elif len(args) > 1 and args[0] == "--interrupt_after":
+            interrupt_after = float(args[1])
+            args = args[2:]
+        elif len(args) > 1 and args[0] == "--compress":
+            compress = args[1]
+            args = args[2:]
+        else:
+            break
+    if len(args) < 3:
+        print "Usage: python queue_runner.py [--local_queue folder] [--sdb]",
+        print "[--local_results file] [--compress gzip|zstd]",
+        print "[--interrupt_after seconds] job tag results_file",
+        print "[extra_output_files...]"
+        exit(1)
+    if interrupt_after is not None and local_path is None:
+        print "--interrupt_after is only for trying out --local_queue"
+        exit(1)
+    job, tag, results_file = args[:3]
+    extra_output_files = args[3:]
+
+    queue = work_queue.get_queue(job, local_path)
+    results = None
+    if local_results is not None or use_sdb:
+        results = results_db.get_backend(job, local_results)
+    interruption = None
+    if local_path is None:
+        interruption = spot.MetadataInterruptionSource()
+    elif interrupt_after is not None:
+        # Pretend to be a spot instance that gets reclaimed
+        interruption = spot.FakeInterruptionSource(interrupt_after)
+    num_run = run_queue(queue, job, tag, results_file, extra_output_files,
+                        save=local_path is None, interruption=interruption,
+                        compress=compress, results=results)
+    print "Finished after running %d commands" % num_run
+
+    # Self-terminate once there is nothing left to do
+    if local_path is None:
+        try:
+            cloud_setup.terminate_instance(tag)
+        except:
+            cloud_setup.add_tag(tag, "dataset", "finished")
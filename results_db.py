@@ -0,0 +1,161 @@
+# Structured per-row results, written by the instances as each command
+# finishes so they can be queried while a job is still running, rather than
+# waiting to download the results files from S3. Rows are stored in a
+# SimpleDB domain named after the job, or in a local SQLite file for trying
+# things out.
+import sqlite3
+import threading
+
+import cloud_setup
+
+SDB_BATCH_SIZE = 25  # Maximum number of items in a SimpleDB batch put
+SDB_MAX_ATTRIBUTES = 256  # Maximum number of attributes on a SimpleDB item
+SDB_MAX_VALUE_BYTES = 1024  # Longest attribute name or value SimpleDB takes
+LOCAL_PAGE_SIZE = 500  # Rows read from SQLite at a time
+
+
+def where_clause(where):
+    """
+    SimpleDB select condition for a dictionary of attribute -> value
+    equality filters.
+    """
+    if not where:
+        return ""
+    return " where " + " and ".join(
+        "`%s` = '%s'" % (name.replace("`", "``"),
+                         str(value).replace("'", "''"))
+        for name, value in sorted(where.items()))
+
+
+class SDBResults(object):
+    """
+    Results stored as one SimpleDB item per row.
+    """
+
+    def __init__(self, job):
+        self.domain_name = job
+        self.sdb, self.dom = cloud_setup.setup_sdb_domain(job)
+
+    def put_rows(self, rows):
+        """
+        Store rows, given as a dictionary of item name -> attributes, in
+        batches of the most items SimpleDB accepts at once. Throttled
+        batches are retried. Rows SimpleDB would refuse are reported before
+        any are stored, as retrying wouldn't help.
+        """
+        for name, row in rows.items():
+            if len(row) > SDB_MAX_ATTRIBUTES:
+                raise ValueError("Row %s has %d columns, SimpleDB only "
+                                 "allows %d" % (name, len(row),
+                                                SDB_MAX_ATTRIBUTES))
+            for attribute, value in row.items():
+                if max(len(attribute), len(str(value))) > SDB_MAX_VALUE_BYTES:
+                    raise ValueError("Column %s of row %s is longer than the "
+                                     "%d bytes SimpleDB allows" % (
+                                         attribute[:40], name,
+                                         SDB_MAX_VALUE_BYTES))
+        items = {}
+        for name, row in sorted(rows.items()):
+            items[name] = dict((attribute, str(value))
+                               for attribute, value in row.items())
+            if len(items) == SDB_BATCH_SIZE:
+                cloud_setup.sdb_call(self.dom.batch_put_attributes, items)
+                items = {}
+        if items:
+            cloud_setup.sdb_call(self.dom.batch_put_attributes, items)
+
+    def select(self, where=None, consistent_read=False):
+        """
+        Yield the rows (as dictionaries) matching the attribute -> value
+        filters in where, a page at a time.
+        """
+        query = "select * from `%s`%s" % (self.domain_name,
+                                          where_clause(where))
+        for item in cloud_setup.sdb_select(self.sdb, self.dom, query,
+                                           consistent_read):
+            yield dict(item)
+
+    def count(self, where=None):
+        query = "select count(*) from `%s`%s" % (self.domain_name,
+                                                 where_clause(where))
+        return sum(int(res[u"Count"]) for res in
+                   cloud_setup.sdb_select(self.sdb, self.dom, query))
+
+
+class LocalResults(object):
+    """
+    SQLite stand-in for SDBResults, storing each row's attributes like
+    SimpleDB does (every value is a string).
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS attributes ("
+            "    item TEXT,"
+            "    attribute TEXT,"
+            "    value TEXT,"
+            "    PRIMARY KEY (item, attribute))")
+        self.db.commit()
+
+    def put_rows(self, rows):
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO attributes VALUES (?, ?, ?)",
+                [(name, attribute, str(value))
+                 for name, row in sorted(rows.items())
+                 for attribute, value in row.items()])
+            self.db.commit()
+
+    def _matching_items(self, where):
+        """
+        SQL for the names of the items matching the filters, and its
+        parameters.
+        """
+        if not where:
+            return "SELECT DISTINCT item FROM attributes", []
+        query = " INTERSECT ".join(
+            ["SELECT item FROM attributes WHERE attribute = ? AND value = ?"]
+            * len(where))
+        params = []
+        for name, value in sorted(where.items()):
+            params += [name, str(value)]
+        return query, params
+
+    def select(self, where=None, consistent_read=False):
+        items, params = self._matching_items(where)
+        last_item = ""
+        while True:
+            # Read a page of items at a time so the lock isn't held while
+            # the caller works through them
+            with self.lock:
+                names = [row[0] for row in self.db.execute(
+                    "SELECT item FROM (%s) WHERE item > ? ORDER BY item "
+                    "LIMIT ?" % items,
+                    params + [last_item, LOCAL_PAGE_SIZE]).fetchall()]
+                if not names:
+                    return
+                rows = dict((name, {}) for name in names)
+                for name, attribute, value in self.db.execute(
+                        "SELECT item, attribute, value FROM attributes "
+                        "WHERE item >= ? AND item <= ?",
+                        (names[0], names[-1])):
+                    if name in rows:
+                        rows[name][attribute.encode("utf-8")] = \
+                            value.encode("utf-8")
+            for name in names:
+                yield rows[name]
+            last_item = names[-1]
+
+    def count(self, where=None):
+        items, params = self._matching_items(where)
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM (%s)" % items,
+                                   params).fetchone()[0]
+
+
+def get_backend(job, local_path=None):
+    if local_path:
+        return LocalResults(local_path)
+    return SDBResults(job)
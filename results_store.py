@@ -0,0 +1,559 @@
+# Local columnar store for results, so a sweep can be analysed without
+# re-reading every results CSV. Results files downloaded by get_s3_files.py
+# are ingested into one partition per job and tag, with each column stored
+# as a typed binary array, and can then be filtered and aggregated with the
+# query command.
+#
+#   python results_store.py ingest store_folder jobname download_folder \
+#       results_file
+#   python results_store.py query store_folder --job jobname \
+#       --where "gap<=0.01" --group_by seed --agg mean:objective
+import argparse
+import array
+import csv
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+import cloud_setup
+import get_results
+
+SCHEMA_FILE = "schema.json"
+MANIFEST_FILE = "manifest.json"  # Results files already ingested, per job
+
+# Column types, from narrowest to widest, and the array type codes they are
+# stored with. Strings are stored as codes into a per-column dictionary.
+TYPES = ["int", "float", "str"]
+TYPE_CODES = {"int": "l", "float": "d", "str": "l"}
+
+OPERATORS = ["<=", ">=", "!=", "=", "<", ">"]  # Longest first for parsing
+AGGREGATES = ["count", "sum", "mean", "min", "max"]
+
+
+def infer_type(values):
+    """
+    The narrowest type that can hold all the values. Empty values are
+    missing, which ints can't represent, so they make a column at least
+    float.
+    """
+    vtype = "int"
+    for value in values:
+        if vtype == "int":
+            try:
+                int(value)
+                continue
+            except ValueError:
+                vtype = "float"
+        if vtype == "float":
+            if value == "":
+                continue
+            try:
+                float(value)
+            except ValueError:
+                return "str"
+    return vtype
+
+
+def wider_type(type_a, type_b):
+    return TYPES[max(TYPES.index(type_a), TYPES.index(type_b))]
+
+
+class Partition(object):
+    """
+    The results for one job and tag: a folder with one array file per
+    column and a schema.json describing the columns (name, type, min and
+    max for numeric columns, and the dictionary for string columns) and the
+    number of rows.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        schema_path = os.path.join(path, SCHEMA_FILE)
+        if os.path.exists(schema_path):
+            with open(schema_path, "r") as f:
+                schema = json.load(f)
+            self.num_rows = schema["num_rows"]
+            self.columns = schema["columns"]
+        else:
+            self.num_rows = 0
+            self.columns = []
+        self.index = dict((column["name"], i)
+                          for i, column in enumerate(self.columns))
+
+    def _save_schema(self):
+        schema_path = os.path.join(self.path, SCHEMA_FILE)
+        with open(schema_path + ".tmp", "w") as f:
+            json.dump({"num_rows": self.num_rows, "columns": self.columns}, f)
+        os.rename(schema_path + ".tmp", schema_path)
+
+    def _column_path(self, i):
+        return os.path.join(self.path, "c%d.col" % i)
+
+    def column_type(self, name):
+        return self.columns[self.index[name]]["type"]
+
+    def read_column(self, name):
+        """
+        The values of a column as a list of ints, floats (NaN if missing) or
+        strings ("" if missing). Columns the partition doesn't have are all
+        missing.
+        """
+        if name not in self.index:
+            return [None] * self.num_rows
+        i = self.index[name]
+        column = self.columns[i]
+        values = array.array(TYPE_CODES[column["type"]])
+        with open(self._column_path(i), "rb") as f:
+            values.fromfile(f, self.num_rows)
+        if column["type"] == "str":
+            # json gives back unicode, but rows are read and written as
+            # UTF-8 strings
+            dictionary = [value.encode("utf-8")
+                          for value in column["dictionary"]]
+            return [dictionary[code] for code in values]
+        return values.tolist()
+
+    def _encode(self, column, values):
+        """
+        Turn CSV strings into the array stored for a column, keeping its
+        statistics up to date.
+        """
+        if column["type"] == "str":
+            dictionary = column["dictionary"]
+            codes = dict((value, code) for code, value in
+                         enumerate(dictionary))
+            encoded = array.array(TYPE_CODES["str"])
+            for value in values:
+                if value not in codes:
+                    codes[value] = len(dictionary)
+                    dictionary.append(value)
+                encoded.append(codes[value])
+            return encoded
+        if column["type"] == "int":
+            encoded = array.array("l", [int(value) for value in values])
+        else:
+            encoded = array.array("d", [float(value) if value != "" else
+                                        float("nan") for value in values])
+        present = [value for value in encoded if not math.isnan(value)]
+        if present:
+            low, high = min(present), max(present)
+            if column["min"] is not None:
+                low = min(low, column["min"])
+                high = max(high, column["max"])
+            column["min"], column["max"] = low, high
+        return encoded
+
+    def _new_column(self, name, vtype):
+        column = {"name": name, "type": vtype, "min": None, "max": None}
+        if vtype == "str":
+            column["dictionary"] = []
+        return column
+
+    def _write_column(self, i, values, mode):
+        column = self.columns[i]
+        encoded = self._encode(column, values)
+        with open(self._column_path(i), mode) as f:
+            encoded.tofile(f)
+
+    def _retype(self, i, vtype):
+        """
+        Rewrite a column as a wider type.
+        """
+        old = self.columns[i]
+        values = self.read_column(old["name"])
+        if vtype == "float":
+            values = ["" if value is None else repr(float(value))
+                      for value in values]
+        else:
+            values = ["" if isinstance(value, float) and math.isnan(value)
+                      else str(value) for value in values]
+        self.columns[i] = self._new_column(old["name"], vtype)
+        self._write_column(i, values, "wb")
+
+    def append(self, header, rows):
+        """
+        Add rows (lists of CSV strings, in the order of header) to the
+        partition. Columns the rows don't have are left missing, and columns
+        are widened if the new values don't fit their type.
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        num_new = len(rows)
+        new_values = {}
+        for j, name in enumerate(header):
+            new_values[name] = [row[j] if j < len(row) else "" for row in rows]
+
+        for name in header:
+            if name in self.index:
+                continue
+            vtype = infer_type(new_values[name])
+            if self.num_rows > 0:
+                # Earlier rows don't have this column, so it needs to be able
+                # to hold missing values
+                vtype = wider_type(vtype, "float")
+            self.columns.append(self._new_column(name, vtype))
+            self.index[name] = len(self.columns) - 1
+            self._write_column(self.index[name], [""] * self.num_rows, "wb")
+
+        for i, column in enumerate(self.columns):
+            values = new_values.get(column["name"], [""] * num_new)
+            vtype = wider_type(column["type"], infer_type(values))
+            if vtype != column["type"]:
+                self._retype(i, vtype)
+            self._write_column(i, values, "ab")
+
+        self.num_rows += num_new
+        self._save_schema()
+
+    def may_match(self, name, op, value):
+        """
+        Whether any row could satisfy the filter, going by the column's
+        minimum and maximum, so partitions can be skipped without reading
+        them.
+        """
+        if name not in self.index:
+            return False
+        column = self.columns[self.index[name]]
+        if column["type"] == "str" or column["min"] is None:
+            return column["type"] == "str"
+        low, high = column["min"], column["max"]
+        return {"<": low < value, "<=": low <= value,
+                ">": high > value, ">=": high >= value,
+                "=": low <= value <= high, "!=": True}[op]
+
+
+class ResultsStore(object):
+    """
+    A folder of partitions laid out as job=<job>/tag=<tag>/.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def partition(self, job, tag):
+        return Partition(os.path.join(self.root, "job=%s" % job,
+                                      "tag=%s" % tag))
+
+    def partitions(self, job=None, tag=None):
+        """
+        (job, tag, Partition) for every partition, or only those for the
+        given job and tag.
+        """
+        if not os.path.exists(self.root):
+            return
+        for job_folder in sorted(os.listdir(self.root)):
+            if not job_folder.startswith("job="):
+                continue
+            if job is not None and job_folder != "job=%s" % job:
+                continue
+            job_path = os.path.join(self.root, job_folder)
+            for tag_folder in sorted(os.listdir(job_path)):
+                if not tag_folder.startswith("tag="):
+                    continue
+                if tag is not None and tag_folder != "tag=%s" % tag:
+                    continue
+                yield (job_folder[len("job="):], tag_folder[len("tag="):],
+                       Partition(os.path.join(job_path, tag_folder)))
+
+    def _load_manifest(self):
+        path = os.path.join(self.root, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest):
+        path = os.path.join(self.root, MANIFEST_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.rename(path + ".tmp", path)
+
+    def ingest_folder(self, job, folder, results_file):
+        """
+        Add the results files in a folder downloaded by get_s3_files.py to
+        the store. Files that were ingested before and haven't changed since
+        are skipped. Returns (number of files, number of rows) ingested.
+        """
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        manifest = self._load_manifest()
+        ingested = manifest.setdefault(job, {})
+        num_files = 0
+        num_rows = 0
+        try:
+            for dirpath, dirnames, filenames in os.walk(folder):
+                for filename in sorted(filenames):
+                    path = os.path.join(dirpath, filename)
+                    relpath = os.path.relpath(path, folder).replace(os.sep,
+                                                                    "/")
+                    parsed = get_results.parse_result_key(relpath,
+                                                          results_file, job)
+                    if parsed is None:
+                        continue
+                    st = os.stat(path)
+                    stamp = [st.st_size, int(st.st_mtime)]
+                    if ingested.get(relpath) == stamp:
+                        continue
+                    tag, timestamp, compress = parsed
+                    num_rows += self._ingest_file(job, tag, timestamp, path,
+                                                  compress)
+                    ingested[relpath] = stamp
+                    num_files += 1
+        finally:
+            self._save_manifest(manifest)
+        return num_files, num_rows
+
+    def _ingest_file(self, job, tag, timestamp, path, compress):
+        tmp_folder = None
+        if compress is not None:
+            tmp_folder = tempfile.mkdtemp(prefix="aws-runner-store-")
+            csv_path = os.path.join(tmp_folder, "results.csv")
+            cloud_setup.decompress_file(path, compress, csv_path)
+            path = csv_path
+        try:
+            with open(path, "rU") as f:
+                reader = csv.reader(f)
+                header_line = next(reader, None)
+                if header_line is None:
+                    return 0
+                rows = [line + [timestamp] for line in reader if line]
+        finally:
+            if tmp_folder is not None:
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+        if rows:
+            self.partition(job, tag).append(header_line + ["AWS_timestamp"],
+                                            rows)
+        return len(rows)
+
+    def query(self, job=None, tag=None, where=(), columns=None, group_by=(),
+              aggregates=()):
+        """
+        Filter the stored rows and either return the requested columns of
+        the rows that match, or aggregate them.
+          where       (column, operator, value) filters that all have to hold
+          group_by    Columns to group by when aggregating
+          aggregates  (function, column) pairs, e.g. ("mean", "objective").
+                      The column is ignored for count.
+        AWS_job and AWS_tag can be used like any other column.
+        Returns (header, rows).
+        """
+        partitions = list(self.partitions(job, tag))
+        if columns is None:
+            columns = []
+            for part_job, part_tag, partition in partitions:
+                for column in partition.columns:
+                    if column["name"] not in columns:
+                        columns.append(column["name"])
+            columns += ["AWS_job", "AWS_tag"]
+        if aggregates:
+            header = list(group_by) + ["%s(%s)" % (function, name)
+                                       if function != "count" else "count"
+                                       for function, name in aggregates]
+            needed = list(group_by) + [name for function, name in aggregates
+                                       if function != "count"]
+        else:
+            header = list(columns)
+            needed = list(columns)
+        needed += [name for name, op, value in where]
+
+        groups = {}
+        rows = []
+        for part_job, part_tag, partition in partitions:
+            where_values = []
+            skip = False
+            for name, op, value in where:
+                if name in ["AWS_job", "AWS_tag"]:
+                    where_values.append((name, op, value))
+                    continue
+                try:
+                    value = float(value)
+                except ValueError:
+                    if (name in partition.index and
+                            partition.column_type(name) != "str"):
+                        skip = True  # No number equals a string
+                        break
+                if not partition.may_match(name, op, value):
+                    skip = True
+                    break
+                where_values.append((name, op, value))
+            if skip or partition.num_rows == 0:
+                continue
+
+            data = {"AWS_job": [part_job] * partition.num_rows,
+                    "AWS_tag": [part_tag] * partition.num_rows}
+            for name in needed:
+                if name not in data:
+                    data[name] = partition.read_column(name)
+
+            for r in xrange(partition.num_rows):
+                if not all(_compare(data[name][r], op, value)
+                           for name, op, value in where_values):
+                    continue
+                if not aggregates:
+                    rows.append([_format(data[name][r]) for name in columns])
+                    continue
+                key = tuple(_format(data[name][r]) for name in group_by)
+                if key not in groups:
+                    groups[key] = [[] for aggregate in aggregates]
+                for values, (function, name) in zip(groups[key], aggregates):
+                    if function == "count":
+                        values.append(1)
+                    else:
+                        value = data[name][r]
+                        if value is None or value == "" or (
+                                isinstance(value, float) and math.isnan(value)):
+                            continue
+                        if (isinstance(value, str) and
+                                function in ["sum", "mean"]):
+                            try:
+                                value = float(value)
+                            except ValueError:
+                                continue  # Can't add up text
+                        values.append(value)
+
+        if aggregates:
+            for key in sorted(groups):
+                rows.append(list(key) + [
+                    _format(_aggregate(function, values))
+                    for values, (function, name) in zip(groups[key],
+                                                        aggregates)])
+        return header, rows
+
+
+def _compare(left, op, right):
+    if left is None or (isinstance(left, float) and math.isnan(left)):
+        return False
+    if isinstance(right, float) and isinstance(left, str):
+        # A string column compared with a number, e.g. if some results
+        # files had text in a numeric column
+        try:
+            left = float(left)
+        except ValueError:
+            return False
+    if op == "=":
+        return left == right
+    if op == "!=":
+        return left != right
+    if op == "<":
+        return left < right
+    if op == "<=":
+        return left <= right
+    if op == ">":
+        return left > right
+    return left >= right
+
+
+def _aggregate(function, values):
+    if function == "count":
+        return len(values)
+    if not values:
+        return None
+    if function == "sum":
+        return sum(values)
+    if function == "mean":
+        return float(sum(values)) / len(values)
+    if function == "min":
+        return min(values)
+    return max(values)
+
+
+def _format(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, float):
+        return repr(value)
+    return value
+
+
+def parse_where(text):
+    """
+    Turn "column<=value" into (column, "<=", value).
+    """
+    for op in OPERATORS:
+        if op in text:
+            name, value = text.split(op, 1)
+            return name.strip(), op, value.strip()
+    raise ValueError(text)
+
+
+def parse_aggregate(text):
+    """
+    Turn "mean:objective" into ("mean", "objective"), and "count" into
+    ("count", None).
+    """
+    function, sep, name = text.partition(":")
+    if function not in AGGREGATES or (function != "count" and not name):
+        raise ValueError(text)
+    return function, name or None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Store results locally in a compact columnar format and "
+                    "query them.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    ingest_parser = subparsers.add_parser(
+        "ingest", help="Add downloaded results files to the store. Files "
+                       "that were added before are skipped.")
+    ingest_parser.add_argument("store_folder", type=str,
+                               help="Folder the store is kept in.")
+    ingest_parser.add_argument("jobname", type=str,
+                               help="The name of the job the results are "
+                                    "from.")
+    ingest_parser.add_argument("download_folder", type=str,
+                               help="Folder the results were downloaded to "
+                                    "with get_s3_files.py.")
+    ingest_parser.add_argument("results_file", type=str,
+                               help="The results file name given to "
+                                    "dispatcher.py.")
+
+    query_parser = subparsers.add_parser(
+        "query", help="Filter and aggregate the stored results, writing a "
+                      "CSV to stdout.")
+    query_parser.add_argument("store_folder", type=str,
+                              help="Folder the store is kept in.")
+    query_parser.add_argument("--job", type=str, default=None,
+                              help="Only query results from this job.")
+    query_parser.add_argument("--tag", type=str, default=None,
+                              help="Only query results from this tag.")
+    query_parser.add_argument("--where", action="append", type=str,
+                              help="Only include rows where this holds, e.g. "
+                                   "`gap<=0.01` or `method=barrier`. Can be "
+                                   "given multiple times.")
+    query_parser.add_argument("--columns", type=str, default=None,
+                              help="Comma-separated columns to output. "
+                                   "Defaults to all of them.")
+    query_parser.add_argument("--group_by", type=str, default=None,
+                              help="Comma-separated columns to group by when "
+                                   "aggregating.")
+    query_parser.add_argument("--agg", action="append", type=str,
+                              help="Aggregate to compute, as function:column "
+                                   "(functions are %s), or just count. Can "
+                                   "be given multiple times." %
+                                   ", ".join(AGGREGATES))
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store_folder)
+    if args.command == "ingest":
+        num_files, num_rows = store.ingest_folder(
+            args.jobname, args.download_folder, args.results_file)
+        print "Ingested %d rows from %d files" % (num_rows, num_files)
+        exit(0)
+
+    try:
+        where = [parse_where(text) for text in (args.where or [])]
+        aggregates = [parse_aggregate(text) for text in (args.agg or [])]
+    except ValueError, err:
+        print "Could not understand the following filter or aggregate:"
+        print "    %s" % err
+        exit(1)
+    columns = args.columns.split(",") if args.columns else None
+    group_by = args.group_by.split(",") if args.group_by else []
+    header, rows = store.query(args.job, args.tag, where, columns, group_by,
+                               aggregates)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(header)
+    writer.writerows(rows)
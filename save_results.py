@@ -1,7 +1,14 @@
 import csv
+import os
+import tempfile
 import time
 import sys
+from multiprocessing.pool import ThreadPool
+
 import cloud_setup
+import results_db
+
+UPLOAD_WORKERS = 4  # Files uploaded at once
 
 
 def get_results_from_csv(key, job, tag, results_file, current_time):
@@ -12,6 +19,9 @@ def get_results_from_csv(key, job, tag, results_file, current_time):
 
     results = {}
     for row_num, line in enumerate(reader):
+        # Skip blank lines, e.g. at the end of the file
+        if not any(line):
+            continue
         rowkey = "%s-%d" % (key, row_num)
         values = {
             "AWS_job": job,
@@ -20,47 +30,103 @@ def get_results_from_csv(key, job, tag, results_file, current_time):
             "AWS_row_num": row_num,
         }
         for col in xrange(num_cols):
-            values[header_line[col]] = line[col]
+            # Short rows are padded with empty values
+            values[header_line[col]] = line[col] if col < len(line) else ""
         results[rowkey] = values
     return results
 
 
-def save_results(job, tag, results_file, extra_output_files):
-    try:
-        current_time = time.time()
-        key = "%s-%s-%f" % (job, tag, current_time)
+def record_results(results, job, tag, results_file, current_time):
+    """
+    Write the rows of the results file to a results_db backend.
+    """
+    key = "%s-%s-%f" % (job, tag, current_time)
+    results.put_rows(get_results_from_csv(key, job, tag, results_file,
+                                          current_time))
 
-        # Save file to s3
-        s3, bucket = cloud_setup.setup_s3_bucket(job)
-        cloud_setup.add_file_to_s3_bucket(bucket, key, results_file)
 
-        # Save extra files to s3
-        for extra_output_file in extra_output_files:
-            cloud_setup.add_file_to_s3_bucket(bucket, key, extra_output_file)
+def upload_output_file(job, key, output_file, compress=None):
+    """
+    Upload one output file under the name add_file_to_s3_bucket would give
+    it, compressing it first if asked to (which adds a suffix to the name).
+    """
+    keyname = output_file + "-" + key
+    if compress is None:
+        cloud_setup.upload_file_to_s3(job, keyname, output_file)
+        return
+    handle, compressed_file = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        cloud_setup.compress_file(output_file, compress, compressed_file)
+        cloud_setup.upload_file_to_s3(
+            job, keyname + cloud_setup.COMPRESSION_SUFFIXES[compress],
+            compressed_file)
+    finally:
+        os.remove(compressed_file)
+
 
-        # # Get ready for SimpleDB comms
-        # sdb, dom = cloud_setup.setup_sdb_domain(job)
+def save_results(job, tag, results_file, extra_output_files, terminate=True,
+                 compress=None, results=None):
+    try:
+        current_time = time.time()
+        key = "%s-%s-%f" % (job, tag, current_time)
 
-        # results = get_results_from_csv(key, job, tag, results_file,
-        #                                current_time)
+        # Save the results file and extra files to s3, all at once. Each
+        # upload is checked before we go on to terminate.
+        cloud_setup.setup_s3_bucket(job)  # Make sure the bucket exists
+        output_files = [results_file] + extra_output_files
+        pool = ThreadPool(min(UPLOAD_WORKERS, len(output_files)))
+        try:
+            pool.map(lambda output_file: upload_output_file(
+                job, key, output_file, compress), output_files)
+        finally:
+            pool.close()
 
-        # # Write to SDB
-        # dom.batch_put_attributes(results)
+        # Write the rows to SimpleDB (or wherever results points) too. The
+        # files are safely in S3 by now, so a problem with the rows mustn't
+        # stop the instance from terminating.
+        if results is not None:
+            try:
+                record_results(results, job, tag, results_file, current_time)
+            except Exception as e:
+                print "Could not record the rows of %s: %s" % (results_file, e)
 
-        # Self-terminate at completion
-        cloud_setup.terminate_instance(tag)
+        # Self-terminate at completion (unless other commands are still
+        # running on this instance)
+        if terminate:
+            cloud_setup.terminate_instance(tag)
     except:
         cloud_setup.add_tag(tag, "dataset", "finished")
 
 if __name__ == "__main__":
     # Validate command-line arguments
-    if len(sys.argv) < 4:
-        print "Usage: python save_results.py job tag results_file"
+    args = sys.argv[1:]
+    terminate = True
+    compress = None
+    results = None
+    while args and args[0].startswith("--"):
+        if args[0] == "--no_terminate":
+            terminate = False
+            args = args[1:]
+        elif args[0] == "--sdb":
+            results = True
+            args = args[1:]
+        elif args[0] == "--compress" and len(args) > 1:
+            compress = args[1]
+            args = args[2:]
+        else:
+            break
+    if len(args) < 3:
+        print "Usage: python save_results.py [--no_terminate] [--sdb]",
+        print "[--compress gzip|zstd] job tag results_file",
         print "[extra_output_files...]"
         exit(1)
-    if len(sys.argv) > 4:
-        extra_output_files = sys.argv[4:]
+    if len(args) > 3:
+        extra_output_files = args[3:]
     else:
         extra_output_files = []
 
-    save_results(sys.argv[1], sys.argv[2], sys.argv[3], extra_output_files)
+    if results:
+        results = results_db.SDBResults(args[0])
+    save_results(args[0], args[1], args[2], extra_output_files, terminate,
+                 compress, results)
@@ -0,0 +1,19 @@
+# python ~/self_terminate.py
+# Terminates the instance this is run on. Used by runners that call
+# save_results.py with --no_terminate for each of several commands.
+import os
+
+import cloud_setup
+
+instance_tag = os.environ.get('TAG')
+
+if instance_tag:
+  try:
+    cloud_setup.terminate_instance(instance_tag)
+  except:
+    cloud_setup.add_tag(instance_tag, "dataset", "finished")
+else:
+  print "**************************************************"
+  print "* ERROR: Unable to find TAG environment variable *"
+  print "**************************************************"
+  exit(1)
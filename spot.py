@@ -0,0 +1,209 @@
+# Spot instance support: launching instances on the spot market (falling
+# back to on-demand if they aren't fulfilled in time), and noticing on an
+# instance that it is about to be interrupted. The EC2 and instance metadata
+# calls go through backends so the logic can be tried against local fakes.
+import itertools
+import time
+import urllib2
+
+import boto.ec2
+
+import cloud_setup
+
+SPOT_POLL_INTERVAL = 5  # Seconds between checks on spot requests
+# Returns 404 until the instance is marked for interruption
+INSTANCE_ACTION_URL = ("http://169.254.169.254/latest/meta-data/spot/"
+                       "instance-action")
+INTERRUPTION_CHECK_INTERVAL = 5
+
+
+class EC2SpotBackend(object):
+    """
+    Spot requests made through EC2.
+    """
+
+    def __init__(self):
+        self.ec2 = boto.ec2.connect_to_region(cloud_setup.AWS_REGION)
+
+    def request(self, count, price, ami_name, key_name, group_name,
+                inst_type):
+        """
+        Ask for count spot instances. Returns the spot request IDs.
+        """
+        requests = self.ec2.request_spot_instances(
+            str(price), ami_name,
+            count=count,
+            key_name=key_name,
+            security_groups=[group_name],
+            instance_type=inst_type,
+            user_data=None)
+        return [request.id for request in requests]
+
+    def get_requests(self, request_ids):
+        """
+        Returns a dictionary of request ID -> instance ID (None if not yet
+        fulfilled).
+        """
+        requests = self.ec2.get_all_spot_instance_requests(
+            request_ids=request_ids)
+        return dict((request.id, request.instance_id) for request in requests)
+
+    def cancel(self, request_ids):
+        self.ec2.cancel_spot_instance_requests(request_ids)
+
+    def get_instances(self, instance_ids):
+        reservations = self.ec2.get_all_instances(instance_ids=instance_ids)
+        instances = dict((inst.id, inst) for res in reservations
+                         for inst in res.instances)
+        return [instances[instance_id] for instance_id in instance_ids]
+
+    def tag_instances(self, instances, tags):
+        cloud_setup.tag_instances(self.ec2, instances, tags)
+
+
+class FakeInstance(object):
+    def __init__(self, instance_id):
+        self.id = instance_id
+        self.state = "running"
+        self.tags = {}
+
+
+class FakeSpotBackend(object):
+    """
+    Local stand-in for EC2SpotBackend. Each request is fulfilled
+    fulfil_after seconds after it is made, but only the first
+    fulfil_fraction of the requests in each call are ever fulfilled. The
+    instances are made by new_instance(), if given, e.g. to have them in
+    benchmark.py's fake cloud.
+    """
+
+    def __init__(self, fulfil_after=0.0, fulfil_fraction=1.0,
+                 new_instance=None):
+        self.fulfil_after = fulfil_after
+        self.fulfil_fraction = fulfil_fraction
+        self.new_instance = new_instance
+        self.requests = {}  # request ID -> [made at, fulfillable, instance]
+        self.instances = {}  # instance ID -> instance
+        self.cancelled = set()
+        self.ids = itertools.count()
+
+    def request(self, count, price, ami_name, key_name, group_name,
+                inst_type):
+        request_ids = []
+        now = time.time()
+        for i in range(count):
+            request_id = "sir-fake%05d" % next(self.ids)
+            fulfillable = i < int(round(count * self.fulfil_fraction))
+            self.requests[request_id] = [now, fulfillable, None]
+            request_ids.append(request_id)
+        return request_ids
+
+    def get_requests(self, request_ids):
+        now = time.time()
+        result = {}
+        for request_id in request_ids:
+            request = self.requests[request_id]
+            if (request[2] is None and request[1] and
+                    request_id not in self.cancelled and
+                    now - request[0] >= self.fulfil_after):
+                if self.new_instance is None:
+                    instance = FakeInstance("i-fake%05d" % next(self.ids))
+                else:
+                    instance = self.new_instance()
+                self.instances[instance.id] = instance
+                request[2] = instance.id
+            result[request_id] = request[2]
+        return result
+
+    def cancel(self, request_ids):
+        self.cancelled.update(request_ids)
+
+    def get_instances(self, instance_ids):
+        return [self.instances[instance_id] for instance_id in instance_ids]
+
+    def tag_instances(self, instances, tags):
+        for instance, tag in zip(instances, tags):
+            instance.tags["tag"] = tag
+
+
+def launch_spot_instances(backend, tags, key_name, group_name, inst_type,
+                          ami_name, price, wait_seconds,
+                          poll_interval=SPOT_POLL_INTERVAL):
+    """
+    Request a spot instance for each tag at the given maximum price, waiting
+    up to wait_seconds for the requests to be fulfilled. Requests that
+    haven't been fulfilled by then are cancelled.
+    Returns:
+      instances    The spot instances, tagged with the first len(instances)
+                   tags
+      remaining    The tags that didn't get a spot instance
+    """
+    request_ids = backend.request(len(tags), price, ami_name, key_name,
+                                  group_name, inst_type)
+    deadline = time.time() + wait_seconds
+    fulfilled = {}
+    while True:
+        try:
+            fulfilled = backend.get_requests(request_ids)
+        except Exception, err:
+            # New requests can take a moment to be visible
+            print "    ** Checking spot requests failed: %s" % err
+        num_fulfilled = len([i for i in fulfilled.values() if i])
+        if num_fulfilled == len(request_ids) or time.time() >= deadline:
+            break
+        time.sleep(poll_interval)
+
+    unfulfilled = [r for r in request_ids if not fulfilled.get(r)]
+    if unfulfilled:
+        backend.cancel(unfulfilled)
+        # Some may have been fulfilled while we were cancelling them
+        fulfilled = backend.get_requests(request_ids)
+
+    instance_ids = [fulfilled[r] for r in request_ids if fulfilled.get(r)]
+    instances = backend.get_instances(instance_ids) if instance_ids else []
+    backend.tag_instances(instances, tags[:len(instances)])
+    return instances, tags[len(instances):]
+
+
+def get_backend():
+    return EC2SpotBackend()
+
+
+###############################################################################
+
+
+class MetadataInterruptionSource(object):
+    """
+    Checks the instance metadata for a spot interruption notice, which EC2
+    posts two minutes before reclaiming the instance.
+    """
+
+    def __init__(self, check_interval=INTERRUPTION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.last_check = 0
+        self.notice = False
+
+    def pending(self):
+        if self.notice or time.time() - self.last_check < self.check_interval:
+            return self.notice
+        self.last_check = time.time()
+        try:
+            urllib2.urlopen(INSTANCE_ACTION_URL, timeout=2).read()
+            self.notice = True
+        except Exception:
+            pass  # 404 (no notice), or not on a spot instance at all
+        return self.notice
+
+
+class FakeInterruptionSource(object):
+    """
+    Stand-in for MetadataInterruptionSource that reports an interruption
+    after the given number of seconds (or never, if None).
+    """
+
+    def __init__(self, after=None):
+        self.after = after
+        self.start = time.time()
+
+    def pending(self):
+        return self.after is not None and time.time() - self.start >= self.after
@@ -0,0 +1,175 @@
+# One SSH connection per instance, shared by everything the dispatcher does
+# on it. Commands, SFTP and the channel INSTALL.py reports on are all
+# channels of the same transport, so each instance costs one handshake
+# however many steps there are. The transports send keepalives so that idle
+# connections (e.g. during a long install) aren't dropped by firewalls, and
+# a connection that does drop is opened again the next time it is used.
+import sys
+import threading
+
+# Seconds between keepalive packets on each connection
+KEEPALIVE_INTERVAL = 30
+# Times a call is tried again on a new connection if the connection drops
+RECONNECT_ATTEMPTS = 2
+
+
+class PooledShell(object):
+    """
+    The connection to one instance. Has the run and open_sftp methods of a
+    cmdshell, plus exec_command for starting commands in the background. A
+    single SFTP session is opened the first time it's needed and shared.
+    connect() opens a new (instance, cmdshell), and is called again if the
+    connection has dropped. A call that fails because the connection dropped
+    part way through is tried again on a new one, up to RECONNECT_ATTEMPTS
+    times, unless it was asked not to be because running it twice would do
+    harm (e.g. starting a background job).
+    """
+
+    def __init__(self, tag, connect, keepalive=KEEPALIVE_INTERVAL):
+        self.tag = tag
+        self.connect = connect
+        self.keepalive = keepalive
+        self.instance = None
+        self.shell = None
+        self.sftp = None
+        self.connections = 0  # Number of times we've connected
+        self.lock = threading.RLock()
+
+    def is_active(self):
+        if self.shell is None:
+            return False
+        transport = self.shell._ssh_client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def get_shell(self):
+        """
+        The cmdshell, connecting first if there isn't an open connection.
+        """
+        with self.lock:
+            if not self.is_active():
+                self.close()
+                self.instance, self.shell = self.connect()
+                self.connections += 1
+                transport = self.shell._ssh_client.get_transport()
+                if transport is not None and self.keepalive:
+                    transport.set_keepalive(self.keepalive)
+            return self.shell
+
+    def _call(self, function, retry=True):
+        attempts = RECONNECT_ATTEMPTS + 1 if retry else 1
+        for attempt in range(attempts):
+            shell = self.get_shell()
+            try:
+                return function(shell)
+            except Exception:
+                error = sys.exc_info()
+                with self.lock:
+                    if ((self.shell is shell and self.is_active()) or
+                            attempt == attempts - 1):
+                        # Either the connection is fine, so it was the call
+                        # that failed, or we've run out of attempts
+                        raise error[0], error[1], error[2]
+
+    def _get_sftp(self, shell):
+        with self.lock:
+            if self.sftp is None or self.sftp[0] is not shell:
+                self.sftp = (shell, shell.open_sftp())
+            return self.sftp[1]
+
+    def run(self, command, retry=True):
+        """
+        Run a command and wait for it to finish. Returns (exit status,
+        stdout, stderr) like cmdshell. Pass retry=False if the command
+        mustn't be run again when the connection drops, as it may already
+        have been run.
+        """
+        return self._call(lambda shell: shell.run(command), retry)
+
+    def exec_command(self, command, retry=False):
+        """
+        Start a command without waiting for it. Returns (stdin, stdout,
+        stderr) like paramiko. As these are mostly commands that start
+        something, they are only tried again after the connection drops
+        with retry=True.
+        """
+        return self._call(
+            lambda shell: shell._ssh_client.exec_command(command), retry)
+
+    def open_sftp(self):
+        return SharedSFTP(self)
+
+    def close(self):
+        with self.lock:
+            if self.sftp is not None:
+                try:
+                    self.sftp[1].close()
+                except Exception:
+                    pass
+                self.sftp = None
+            if self.shell is not None:
+                try:
+                    self.shell._ssh_client.close()
+                except Exception:
+                    pass
+                self.shell = None
+
+
+class SharedSFTP(object):
+    """
+    What PooledShell.open_sftp returns: forwards to the instance's shared
+    SFTP session (reopening it if the connection dropped), and leaves it
+    open when closed.
+    """
+
+    def __init__(self, pooled_shell):
+        self.pooled_shell = pooled_shell
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            return self.pooled_shell._call(
+                lambda shell: getattr(self.pooled_shell._get_sftp(shell),
+                                      name)(*args, **kwargs))
+        return call
+
+    def close(self):
+        pass
+
+
+class SSHPool(object):
+    """
+    The PooledShell for each tag, so each instance is only connected to once
+    however many times it is asked for.
+    """
+
+    def __init__(self, keepalive=KEEPALIVE_INTERVAL):
+        self.keepalive = keepalive
+        self.shells = {}
+        self.lock = threading.Lock()
+
+    def connect(self, tag, connect):
+        """
+        The tag's PooledShell, connected with connect() (see PooledShell) if
+        it isn't already.
+        """
+        with self.lock:
+            if tag not in self.shells:
+                self.shells[tag] = PooledShell(tag, connect, self.keepalive)
+            pooled_shell = self.shells[tag]
+        pooled_shell.connect = connect
+        pooled_shell.get_shell()
+        return pooled_shell
+
+    def forget(self, tag):
+        with self.lock:
+            pooled_shell = self.shells.pop(tag, None)
+        if pooled_shell is not None:
+            pooled_shell.close()
+
+    def close_all(self):
+        with self.lock:
+            shells, self.shells = self.shells.values(), {}
+        for pooled_shell in shells:
+            pooled_shell.close()
+
+
+POOL = SSHPool()
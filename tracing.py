@@ -0,0 +1,119 @@
+# Timing spans for what the dispatcher does to each tag (EC2 requests,
+# connection attempts, uploads, INSTALL, starting the runner), so a slow
+# launch can be broken down by host and by phase. Spans are only recorded
+# once tracing is enabled, and can be written out as JSON lines or in the
+# Chrome trace format (load it at chrome://tracing or ui.perfetto.dev).
+import contextlib
+import json
+import threading
+import time
+
+
+class Tracer(object):
+    """
+    Collects spans from any number of threads. Each span has a name, the tag
+    it belongs to (None for the dispatcher as a whole), start and end times
+    and any other attributes given.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def enable(self):
+        self.enabled = True
+        self.started = time.time()
+
+    def add_span(self, name, start, end, tag=None, **attrs):
+        """
+        Record a span that was timed elsewhere.
+        """
+        if not self.enabled:
+            return
+        span = {"name": name, "tag": tag, "start": start, "end": end,
+                "thread": threading.current_thread().name, "attrs": attrs}
+        with self.lock:
+            self.spans.append(span)
+
+    def event(self, name, tag=None, **attrs):
+        """
+        Record something that happened at a single point in time.
+        """
+        now = time.time()
+        self.add_span(name, now, now, tag, **attrs)
+
+    @contextlib.contextmanager
+    def span(self, name, tag=None, **attrs):
+        """
+        Time the with block. The block gets the span's attributes, so it can
+        add to them, and an exception is recorded in the span as "error".
+        """
+        start = time.time()
+        try:
+            yield attrs
+        except Exception, err:
+            attrs["error"] = str(err)
+            raise
+        finally:
+            self.add_span(name, start, time.time(), tag, **attrs)
+
+    def get_spans(self):
+        with self.lock:
+            return sorted(self.spans, key=lambda span: span["start"])
+
+    def write_json_lines(self, path):
+        """
+        One JSON object per span, with times in seconds since the epoch.
+        """
+        with open(path, "w") as f:
+            for span in self.get_spans():
+                record = dict(span)
+                record["duration"] = span["end"] - span["start"]
+                f.write(json.dumps(record, sort_keys=True))
+                f.write("\n")
+
+    def write_chrome_trace(self, path):
+        """
+        Chrome trace format, with one row per tag (plus one for the
+        dispatcher as a whole) so the slow hosts and phases stand out.
+        """
+        spans = self.get_spans()
+        tags = sorted(set(span["tag"] for span in spans
+                          if span["tag"] is not None))
+        tids = dict((tag, i + 1) for i, tag in enumerate(tags))
+        events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": 0,
+                   "args": {"name": "dispatcher"}}]
+        for tag in tags:
+            events.append({"name": "thread_name", "ph": "M", "pid": 1,
+                           "tid": tids[tag], "args": {"name": tag}})
+        for span in spans:
+            event = {"name": span["name"], "cat": span["name"].split(":")[0],
+                     "pid": 1, "tid": tids.get(span["tag"], 0),
+                     "ts": int((span["start"] - self.started) * 1e6),
+                     "args": span["attrs"]}
+            if span["end"] > span["start"]:
+                event["ph"] = "X"
+                event["dur"] = int((span["end"] - span["start"]) * 1e6)
+            else:
+                event["ph"] = "i"
+                event["s"] = "t"
+            events.append(event)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+TRACER = Tracer()
+
+
+def add_span(name, start, end, tag=None, **attrs):
+    TRACER.add_span(name, start, end, tag, **attrs)
+
+
+def event(name, tag=None, **attrs):
+    TRACER.event(name, tag, **attrs)
+
+
+def span(name, tag=None, **attrs):
+    return TRACER.span(name, tag, **attrs)
@@ -0,0 +1,252 @@
+# Shared queue of commands for the queue-driven runner mode. The dispatcher
+# fills the queue with every command from the jobfile and each instance then
+# claims commands one at a time until the queue is empty.
+import os
+import random
+import time
+
+import boto.exception
+
+import cloud_setup
+
+SDB_BATCH_SIZE = 25  # Maximum number of items in a SimpleDB batch put
+CLAIM_CANDIDATES = 20  # Pending items to choose between when claiming
+# Seconds a claim lasts without being renewed, after which its command is
+# assumed lost with its instance and goes back to pending. Runners renew
+# their claim every CLAIM_RENEW_INTERVAL seconds while the command runs.
+CLAIM_LEASE = 900
+CLAIM_RENEW_INTERVAL = 60
+STATUSES = ["pending", "claimed", "done"]
+
+
+def queue_domain_name(job):
+    return "%s-queue" % job
+
+
+class SDBQueue(object):
+    """
+    Queue backed by a SimpleDB domain with one item per command. Claims use
+    a conditional put on the status attribute so two instances can never
+    claim the same command.
+    """
+
+    def __init__(self, job):
+        self.domain_name = queue_domain_name(job)
+        self.sdb, self.dom = cloud_setup.setup_sdb_domain(self.domain_name)
+
+    def counts(self):
+        """
+        Number of commands with each status.
+        """
+        counts = {}
+        for status in STATUSES:
+            rs = cloud_setup.sdb_select(
+                self.sdb, self.dom,
+                "select count(*) from `%s` where status = '%s'" %
+                (self.domain_name, status), consistent_read=True)
+            counts[status] = sum(int(res[u"Count"]) for res in rs)
+        return counts
+
+    def clear_done(self):
+        """
+        Remove the commands that have been run, e.g. by an earlier run of
+        the job.
+        """
+        items = {}
+        for item in cloud_setup.sdb_select(
+                self.sdb, self.dom,
+                "select itemName() from `%s` where status = 'done'" %
+                self.domain_name, consistent_read=True):
+            items[item.name] = None
+            if len(items) == SDB_BATCH_SIZE:
+                cloud_setup.sdb_call(self.dom.batch_delete_attributes, items)
+                items = {}
+        if items:
+            cloud_setup.sdb_call(self.dom.batch_delete_attributes, items)
+
+    def put_all(self, commands):
+        items = {}
+        for i, command in enumerate(commands):
+            items["cmd-%05d" % i] = {"command": command, "status": "pending"}
+            if len(items) == SDB_BATCH_SIZE:
+                cloud_setup.sdb_call(self.dom.batch_put_attributes, items)
+                items = {}
+        if items:
+            cloud_setup.sdb_call(self.dom.batch_put_attributes, items)
+
+    def claim(self, tag):
+        """
+        Claim the next pending command. Returns (item_id, command), or None
+        if there is nothing left to claim. Commands whose claim has run out
+        (see CLAIM_LEASE) are pending again.
+        """
+        while True:
+            candidates = list(cloud_setup.sdb_call(
+                self.sdb.select, self.dom,
+                "select * from `%s` where status = 'pending' limit %d" %
+                (self.domain_name, CLAIM_CANDIDATES), consistent_read=True))
+            if not candidates:
+                if self.requeue_expired():
+                    continue
+                return None
+            # Spread instances over the candidates to reduce contention
+            random.shuffle(candidates)
+            for item in candidates:
+                try:
+                    cloud_setup.sdb_call(
+                        self.dom.put_attributes, item.name,
+                        {"status": "claimed", "owner": tag,
+                         "claimed_at": claim_time()},
+                        replace=True,
+                        expected_value=["status", "pending"])
+                except boto.exception.SDBResponseError:
+                    continue  # Someone else got there first
+                return item.name, item["command"]
+
+    def renew(self, item_id, tag):
+        """
+        Extend our claim on a command we are still running. Returns False if
+        it isn't ours any more, because the claim ran out.
+        """
+        try:
+            cloud_setup.sdb_call(self.dom.put_attributes, item_id,
+                                 {"claimed_at": claim_time()}, replace=True,
+                                 expected_value=["owner", tag])
+        except boto.exception.SDBResponseError:
+            return False
+        return True
+
+    def requeue_expired(self):
+        """
+        Put back the commands whose claim hasn't been renewed for
+        CLAIM_LEASE seconds. Returns how many were.
+        """
+        requeued = 0
+        for item in cloud_setup.sdb_select(
+                self.sdb, self.dom,
+                "select claimed_at from `%s` where status = 'claimed' and "
+                "claimed_at < '%s'" % (self.domain_name,
+                                       claim_time(-CLAIM_LEASE)),
+                consistent_read=True):
+            try:
+                # Only if nobody has renewed or requeued it in the meantime
+                cloud_setup.sdb_call(
+                    self.dom.put_attributes, item.name,
+                    {"status": "pending", "owner": ""}, replace=True,
+                    expected_value=["claimed_at", item["claimed_at"]])
+            except boto.exception.SDBResponseError:
+                continue
+            print "Putting %s back, its claim ran out" % item.name
+            requeued += 1
+        return requeued
+
+    def complete(self, item_id):
+        cloud_setup.sdb_call(self.dom.put_attributes, item_id,
+                             {"status": "done"}, replace=True)
+
+    def release(self, item_id):
+        """
+        Put a claimed command back so another instance can pick it up.
+        """
+        cloud_setup.sdb_call(self.dom.put_attributes, item_id,
+                             {"status": "pending", "owner": ""},
+                             replace=True)
+
+
+class LocalQueue(object):
+    """
+    File-based stand-in for SDBQueue, for testing runners locally. Each
+    command is a file that moves between the pending, claimed and done
+    folders; claiming relies on os.rename being atomic.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for state in STATUSES:
+            folder = os.path.join(path, state)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+    def _folder(self, state, item_id=""):
+        return os.path.join(self.path, state, item_id)
+
+    def counts(self):
+        return dict((status, len(os.listdir(self._folder(status))))
+                    for status in STATUSES)
+
+    def clear_done(self):
+        for item_id in os.listdir(self._folder("done")):
+            os.remove(self._folder("done", item_id))
+
+    def put_all(self, commands):
+        for i, command in enumerate(commands):
+            with open(self._folder("pending", "cmd-%05d" % i), "w") as f:
+                f.write(command)
+
+    def claim(self, tag):
+        while True:
+            candidates = sorted(os.listdir(self._folder("pending")))
+            if not candidates:
+                if self.requeue_expired():
+                    continue
+                return None
+            for item_id in candidates:
+                try:
+                    os.rename(self._folder("pending", item_id),
+                              self._folder("claimed", item_id))
+                except OSError:
+                    continue  # Someone else got there first
+                with open(self._folder("claimed", item_id), "r") as f:
+                    return item_id, f.read()
+
+    def renew(self, item_id, tag):
+        # The time a claimed file was last modified stands in for claimed_at
+        try:
+            os.utime(self._folder("claimed", item_id), None)
+        except OSError:
+            return False
+        return True
+
+    def requeue_expired(self):
+        requeued = 0
+        for item_id in os.listdir(self._folder("claimed")):
+            try:
+                if (os.path.getmtime(self._folder("claimed", item_id)) >
+                        time.time() - CLAIM_LEASE):
+                    continue
+                os.rename(self._folder("claimed", item_id),
+                          self._folder("pending", item_id))
+            except OSError:
+                continue  # Someone else got there first
+            print "Putting %s back, its claim ran out" % item_id
+            requeued += 1
+        return requeued
+
+    def complete(self, item_id):
+        # It may have been put back if our claim ran out
+        for state in ["claimed", "pending"]:
+            try:
+                os.rename(self._folder(state, item_id),
+                          self._folder("done", item_id))
+                return
+            except OSError:
+                pass
+
+    def release(self, item_id):
+        os.rename(self._folder("claimed", item_id),
+                  self._folder("pending", item_id))
+
+
+def claim_time(offset=0):
+    """
+    The time now (plus offset seconds) as stored in claimed_at, which
+    compares in the same order as the times when SimpleDB compares them as
+    strings.
+    """
+    return "%.3f" % (time.time() + offset)
+
+
+def get_queue(job, local_path=None):
+    if local_path:
+        return LocalQueue(local_path)
+    return SDBQueue(job)